@@ -1,15 +1,23 @@
 import createhero.handler as h
+from createhero.graph_runner import GraphRunner
+from createhero.scheduler import RunQueue
 from createhero.util import VideoReformatTask
 
+import asyncio
+from contextlib import asynccontextmanager
 from tornado.web import Application
-from tornado.ioloop import PeriodicCallback
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Semaphore
 import logging
 import os
+import queue
+import socket
+import time
 
 class CreateHeroAPI(Application):
 
     def __init__(self, settings):
-        super().__init__(**settings)
+        super().__init__(static_handler_class=h.VideoStaticFileHandler, **settings)
         self.log = logging.getLogger('CreateHeroAPI')
         self.add_routes()
         self.log.info('CreateHero API ready')
@@ -17,8 +25,13 @@ class CreateHeroAPI(Application):
     def add_routes(self):
         route_list = [
                 (r"/api/tasks/(.*)/captions", h.api.VideoCaptionHandler),
+                (r"/api/tasks/(.*)/progress", h.api.VideoReformatProgressHandler),
+                (r"/api/tasks/(.*)/trace", h.api.VideoReformatTraceHandler),
                 (r"/api/tasks/(.*)", h.api.VideoReformatResultHandler),
                 (r"/api/tasks", h.api.VideoReformatHandler),
+                (r"/api/workers", h.api.WorkerPoolHandler),
+                (r"/api/storage", h.api.StorageHandler),
+                (r"/metrics", h.api.MetricsHandler),
                 (r"/", h.VideoReformatUIBaseHandler),
                 (r"/tasks/create", h.ui.VideoReformatPostTaskUIHandler),
                 (r"/tasks/(.*)/progress", h.ui.VideoReformatTaskProgressSocket),
@@ -32,35 +45,307 @@ class CreateHeroAPI(Application):
         ### FALLBACK
         # route_list.append((r"/.*", h.VideoReformatBaseHandler))
         self.add_handlers(r".*", route_list)
+        # request latencies are reported per route pattern, every handler serves one route
+        self.route_patterns = {handler: pattern for pattern, handler in route_list}
 
+    def log_request(self, handler):
+        super().log_request(handler)
+        metrics = self.settings.get('metrics')
+        if metrics is not None:
+            metrics.observe('createhero_http_request_seconds', handler.request.request_time(),
+                            route=self.route_patterns.get(type(handler), 'other'), method=handler.request.method)
 
 
-class TaskExecutor(PeriodicCallback):
+
+def default_pool_size(cpu_share):
+    """ Number of concurrent autoflip runs the machine can host, given the CPU share of one run. """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return max(1, int(cpus // cpu_share))
+
+
+class WorkerSlot(object):
+    """ Bookkeeping for a single execution slot of the worker pool. """
+
+    def __init__(self, index):
+        self.index = index
+        self.task_id = None
+        self.started = None
+        self.jobs_done = 0
+        self.busy_seconds = 0.0
+
+    def acquire(self, task_id):
+        self.task_id = task_id
+        self.started = time.time()
+
+    def release(self):
+        self.busy_seconds += time.time() - self.started
+        self.jobs_done += 1
+        self.task_id = None
+        self.started = None
+
+    def to_dict(self):
+        return {
+            'slot': self.index,
+            'task_id': self.task_id,
+            'started': self.started,
+            'jobs_done': self.jobs_done,
+            'busy_seconds': round(self.busy_seconds, 1)
+        }
+
+
+class WorkerPool(object):
+    """
+    Fixed number of slots for running reformat tasks. Tasks wait for a free
+    slot, the slot usage is published to the shared status dict so the HTTP
+    workers can report it.
+
+    A freed slot goes to the waiting task the run queue ranks first. Waiters
+    it does not know, like the helpers of segmented tasks, get the slots no
+    queued task waits for, in the order they asked.
+    """
+
+    def __init__(self, size, status, run_queue=None):
+        self.slots = [WorkerSlot(i) for i in range(size)]
+        self.status = status
+        self.run_queue = run_queue
+        self._idle = list(self.slots)
+        self._waiters = {}
+        self.publish()
+
+    @property
+    def busy(self):
+        return sum(1 for slot in self.slots if slot.task_id is not None)
+
+    def publish(self):
+        self.status.update({
+            'size': len(self.slots),
+            'busy': self.busy,
+            'free': len(self.slots) - self.busy,
+            'slots': [slot.to_dict() for slot in self.slots]
+        })
+
+    def _hand_over(self, slot):
+        """ Passes the freed slot on to the next waiter, or keeps it idle. """
+        while self._waiters:
+            task_id = None
+            if self.run_queue is not None:
+                task_id = self.run_queue.next(self._waiters)
+            if task_id is None:
+                task_id = next(iter(self._waiters))
+            waiting = self._waiters.pop(task_id)
+            if not waiting.done():
+                waiting.set_result(slot)
+                return
+        self._idle.append(slot)
+
+    @asynccontextmanager
+    async def slot(self, task_id):
+        if self._idle:
+            slot = self._idle.pop()
+        else:
+            waiting = asyncio.get_event_loop().create_future()
+            self._waiters[task_id] = waiting
+            try:
+                slot = await waiting
+            except asyncio.CancelledError:
+                self._waiters.pop(task_id, None)
+                # cancelled right after the slot was handed over, give it back
+                if waiting.done() and not waiting.cancelled():
+                    self._hand_over(waiting.result())
+                raise
+        slot.acquire(task_id)
+        self.publish()
+        try:
+            yield slot
+        finally:
+            slot.release()
+            self._hand_over(slot)
+            self.publish()
+
+
+def repair_task_index(tasks, data_dir):
+    """
+    Brings the task store in line with the task directories: tasks without a
+    directory are dropped, directories unknown to the store are loaded from
+    their task_data files. Walks the whole working directory, so this only
+    runs on request (service.py --repair) or to fill an empty store.
+    """
+    log = logging.getLogger('TaskExecutor')
+    on_disk = {f.name for f in os.scandir(data_dir) if f.is_dir() and not f.name.startswith('.')}
+    tasks.reindex()
+    known = set(tasks.keys())
+    for task_id in known - on_disk:
+        log.info(f'dropping task {task_id} without directory')
+        del tasks[task_id]
+    for task_id in on_disk - known:
+        log.debug(f'loading task {task_id}')
+        VideoReformatTask(task_id, data_dir, tasks)
+    log.info(f'task index repaired, {len(on_disk - known)} tasks added, {len(known - on_disk)} dropped')
+
+
+class TaskExecutor(object):
+    """
+    Event driven task scheduler. On startup the unfinished tasks are looked
+    up in the task index and put on the run queue. The executor claims the
+    tasks from the run queue, as many as it has slots and preparation
+    capacity for, and renews the leases of its tasks while it works on them.
+    Several executors, on this node or worker nodes (service.py --worker),
+    can share the run queue. The shared task queue only wakes the executor
+    up, which also polls the run queue for tasks added on other nodes.
+    """
 
     def __init__(self, settings):
         self.q = settings['task_queue']
         self.d = settings['tasks']
         self.data_dir = settings['working_directory']
+        self.event_hub = settings.get('event_hub')
         self.log = logging.getLogger("TaskExecutor")
-        super().__init__(self._do, 1e3)
+        pool_size = settings.get('worker_slots') or default_pool_size(settings.get('autoflip_cpu_share', 4))
+        self.run_queue = settings['run_queue']
+        self.pool = WorkerPool(pool_size, settings['executor_status'], self.run_queue)
+        # the name leases are taken under, stable across restarts to take the own leases back right away
+        self.worker_id = settings.get('worker_id') or f'{socket.gethostname()}:executor'
+        self.lease = settings.get('lease_duration', 60)
+        self.poll_interval = settings.get('poll_interval', 5)
+        self.backlog = pool_size + settings.get('prepare_concurrency', 2)
+        self._claimed = set()
+        self._heartbeat = None
+        # graph workers for the in-process backend, one per slot so every running task finds one
+        self.graph_runner = GraphRunner(pool_size) if settings.get('autoflip_backend') == 'inprocess' else None
+        self.task_options = {
+            'audio_mode': settings.get('audio_mode', VideoReformatTask.AUDIO_DIRECT),
+            'segment_duration': settings.get('segment_duration', 0),
+            'segment_overlap': settings.get('segment_overlap', 0),
+            'graph_runner': self.graph_runner,
+            'result_cache': settings.get('result_cache'),
+            'storage': settings.get('storage'),
+            'metrics': settings.get('metrics')
+        }
+        # preparation does not occupy a worker slot, it overlaps with running tasks
+        self.preparing = Semaphore(settings.get('prepare_concurrency', 2))
+        # evicts the artifacts of old tasks, every retention_interval seconds
+        self.retention = settings.get('retention')
+        self.retention_interval = settings.get('retention_interval', 600)
+        self._collector = None
+        self.log.info(f'running up to {pool_size} tasks concurrently')
+        self._running = False
 
-    async def review_old_tasks(self):
-        task_id_list = [f.name for f in os.scandir(self.data_dir) if f.is_dir()]
-        for task_id in task_id_list:
-            if task_id not in self.d:
-                self.log.debug(f'loading task {task_id}')
-                await self._load_or_create_and_run_task(task_id)
+    def start(self):
+        self._running = True
+        IOLoop.current().spawn_callback(self._do)
+        if self.retention is not None:
+            self._collector = PeriodicCallback(self._collect, self.retention_interval * 1000)
+            self._collector.start()
+            IOLoop.current().spawn_callback(self._collect)
+        self._heartbeat = PeriodicCallback(self._renew_leases, self.lease * 1000 / 3)
+        self._heartbeat.start()
+
+    def stop(self):
+        self._running = False
+        # wake up the dispatcher waiting on the queue
+        self.q.put(None)
+        if self._collector is not None:
+            self._collector.stop()
+        if self._heartbeat is not None:
+            self._heartbeat.stop()
+        # other executors can take over right away
+        self.run_queue.release(self.worker_id)
+        if self.graph_runner is not None:
+            self.graph_runner.stop()
+
+    def resume_tasks(self):
+        if not len(self.d) and any(not f.name.startswith('.') for f in os.scandir(self.data_dir)):
+            # first start with an existing working directory
+            repair_task_index(self.d, self.data_dir)
+        listed = time.time()
+        unfinished = self.d.find([VideoReformatTask.STATUS_SUBMITTED, VideoReformatTask.STATUS_INIT,
+                                  VideoReformatTask.STATUS_RUNNING])
+        # queued tasks keep their waiting time, tasks deleted meanwhile leave the queue
+        self.run_queue.prune(unfinished, listed)
+        queued = self.run_queue.queued()
+        for task_id in unfinished:
+            if task_id not in queued:
+                self.run_queue.push(task_id, self.d.get_fields(task_id, RunQueue.TASK_FIELDS))
+        # the tasks this executor worked on before the restart are claimed again right away
+        self.run_queue.release(self.worker_id)
+        self.claim_tasks()
+
+    def claim_tasks(self):
+        """ Claims tasks from the run queue as long as the executor has room for them. """
+        while self._running and len(self._claimed) < self.backlog:
+            task_id = self.run_queue.claim(self.worker_id, self.lease)
+            if task_id is None:
+                return
+            self.log.debug(f'[{task_id}] claimed')
+            self._claimed.add(task_id)
+            self.dispatch(task_id)
+
+    def _renew_leases(self):
+        try:
+            self.run_queue.renew(self.worker_id, self.lease)
+        except Exception:
+            self.log.exception('could not renew the leases')
+
+    def dispatch(self, task_id):
+        """ Runs the task concurrently to the ones already in flight, as soon as a slot is free. """
+        IOLoop.current().spawn_callback(self._load_or_create_and_run_task, task_id)
+
+    def _wait_for_task(self):
+        """ Waits up to the poll interval for a task added on this node, its ID only wakes the executor up. """
+        try:
+            self.q.get(timeout=self.poll_interval)
+        except queue.Empty:
+            return
+        self.q.task_done()
 
     async def _do(self):
-        await self.review_old_tasks()
-        while not self.q.empty():
-            try:
-                task_id = self.q.get()
-                await self._load_or_create_and_run_task(task_id)
-            finally:
-                self.q.task_done()
+        self.resume_tasks()
+        while self._running:
+            # block in a worker thread, so the IOLoop stays free while idle
+            await IOLoop.current().run_in_executor(None, self._wait_for_task)
+            if not self._running:
+                break
+            self.claim_tasks()
+
+    async def _collect(self):
+        """ Runs a retention collection off the IOLoop, it stats and deletes files of many tasks. """
+        try:
+            _, evicted = await IOLoop.current().run_in_executor(None, self.retention.collect)
+            self.retention.mark_evicted(evicted)
+        except Exception:
+            self.log.exception('artifact collection failed')
 
     async def _load_or_create_and_run_task(self, task_id):
-        task = VideoReformatTask(task_id, self.data_dir, self.d)
-        if self.d[task_id]['status'] == VideoReformatTask.STATUS_INIT:
-            await task.start()
+        completed = False
+        task = None
+        try:
+            if task_id not in self.d:
+                # deleted while it was queued
+                self.log.debug(f'[{task_id}] not found, dropping it')
+                return
+            task = VideoReformatTask(task_id, self.data_dir, self.d, self.event_hub, self.task_options)
+            # the task is leased to this executor now, whoever worked on it before is gone
+            task.reclaim()
+            if task.task_data['status'] not in (VideoReformatTask.STATUS_SUBMITTED, VideoReformatTask.STATUS_INIT):
+                return
+            async with self.preparing:
+                await task.prepare()
+            # the probe refines the cost estimate
+            self.run_queue.push(task_id, task.task_data)
+            async with self.pool.slot(task_id) as slot:
+                self.log.debug(f'[{task_id}] running in slot {slot.index}')
+                self.run_queue.start(task_id)
+                await task.start(self.pool)
+            completed = task.task_data['status'] == VideoReformatTask.STATUS_SUCCESS
+        except Exception:
+            self.log.exception(f'[{task_id}] task failed')
+            if task is not None:
+                # it leaves the run queue, left as running or initialized nothing would pick it up again
+                task.abort()
+        finally:
+            self._claimed.discard(task_id)
+            self.run_queue.finish(task_id, completed, self.worker_id)
+            self.claim_tasks()
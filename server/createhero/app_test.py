@@ -0,0 +1,96 @@
+import asyncio
+import os
+import queue
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from createhero.app import TaskExecutor
+from createhero.journal import TaskJournal
+from createhero.scheduler import RunQueue
+from createhero.store import TaskStore
+from createhero.util import VideoReformatTask
+
+
+class TaskExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        state = os.path.join(self.directory, '.state')
+        os.makedirs(state)
+        self.tasks = TaskStore(os.path.join(state, 'tasks.db'))
+        self.run_queue = RunQueue(os.path.join(state, 'tasks.db'))
+        self.executor = TaskExecutor({
+            'task_queue': queue.Queue(),
+            'tasks': self.tasks,
+            'working_directory': self.directory,
+            'executor_status': {},
+            'run_queue': self.run_queue,
+            'worker_slots': 1
+        })
+
+    def _add_task(self, task_id, status):
+        task_dir = os.path.join(self.directory, task_id)
+        os.makedirs(task_dir)
+        input_file = os.path.join(task_dir, 'input.mp4')
+        with open(input_file, 'wb') as f:
+            f.write(b'video')
+        self.tasks[task_id] = {'status': status, 'task_name': task_id, 'action': 'resize',
+                               'input_file_name': 'input.mp4', 'input_file': input_file,
+                               'target_quality': 'high', 'target_size': 'original'}
+        self.run_queue.push(task_id, self.tasks[task_id])
+        self.assertEqual(self.run_queue.claim(self.executor.worker_id, 60), task_id)
+
+    def _run(self, task_id):
+        asyncio.run(self.executor._load_or_create_and_run_task(task_id))
+
+    def test_failed_start_stops_task(self):
+        self._add_task('t1', VideoReformatTask.STATUS_INIT)
+
+        async def start(task, pool=None):
+            task.set_status(VideoReformatTask.STATUS_RUNNING)
+            raise RuntimeError('graph failed')
+
+        with mock.patch.object(VideoReformatTask, 'start', start):
+            self._run('t1')
+        self.assertEqual(self.tasks.get_field('t1', 'status'), VideoReformatTask.STATUS_STOPPED)
+        self.assertEqual(TaskJournal(os.path.join(self.directory, 't1')).load()['status'],
+                         VideoReformatTask.STATUS_STOPPED)
+        self.assertEqual(self.run_queue.queued(), set())
+
+    def test_failed_prepare_stops_task(self):
+        self._add_task('t1', VideoReformatTask.STATUS_SUBMITTED)
+
+        async def prepare(task):
+            raise OSError('input missing')
+
+        with mock.patch.object(VideoReformatTask, 'prepare', prepare):
+            self._run('t1')
+        self.assertEqual(self.tasks.get_field('t1', 'status'), VideoReformatTask.STATUS_STOPPED)
+        self.assertEqual(self.run_queue.queued(), set())
+
+    def test_deleted_task_is_dropped(self):
+        self._add_task('t1', VideoReformatTask.STATUS_SUBMITTED)
+        del self.tasks['t1']
+        self._run('t1')
+        self.assertNotIn('t1', self.tasks)
+        self.assertEqual(self.run_queue.queued(), set())
+
+    def test_resume_queues_and_claims_unfinished_tasks(self):
+        for task_id, status in (('t1', VideoReformatTask.STATUS_RUNNING), ('t2', VideoReformatTask.STATUS_SUBMITTED),
+                                ('t3', VideoReformatTask.STATUS_SUCCESS)):
+            self.tasks[task_id] = {'status': status, 'task_name': task_id}
+        # left in the queue by a task deleted while the executor was down
+        self.run_queue.push('gone', {})
+        self.executor._running = True
+        dispatched = []
+        with mock.patch.object(self.executor, 'dispatch', dispatched.append):
+            self.executor.resume_tasks()
+        self.assertEqual(self.run_queue.queued(), {'t1', 't2'})
+        self.assertEqual(sorted(dispatched), ['t1', 't2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
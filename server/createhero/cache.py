@@ -0,0 +1,130 @@
+from .store import SQLiteStore
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+
+def link_file(source, target):
+    """ Hard links source to target (replacing it), copies if the file system does not allow the link. """
+    tmp = target + '.tmp'
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, target)
+
+
+class ResultCache(SQLiteStore):
+    """
+    Content addressed store for inputs and reformat results. Inputs are kept
+    once per content hash, results under a key derived from the input hash,
+    the scenario graph, its version and the task parameters. Task directories
+    hard link the cached files, so a cache entry costs no extra disk space
+    while a task still uses it. The least recently used entries are evicted
+    once the cached files exceed the quota.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS cache_entries ('
+        'key TEXT PRIMARY KEY, kind TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, '
+        'created REAL NOT NULL, last_used REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS cache_entries_lru ON cache_entries (last_used)'
+    )
+    KIND_INPUT = 'input'
+    KIND_RESULT = 'result'
+    PARAMETERS = ('action', 'target_size', 'target_quality', 'target_format')
+
+    def __init__(self, path, cache_dir, quota):
+        super().__init__(path)
+        self.cache_dir = cache_dir
+        self.quota = quota
+        self.log = logging.getLogger('ResultCache')
+        self._graph_versions = {}
+
+    def graph_version(self, graph_file):
+        """ Hash of the graph description, results of an edited graph do not match anymore. """
+        mtime = os.path.getmtime(graph_file)
+        cached = self._graph_versions.get(graph_file)
+        if cached is None or cached[0] != mtime:
+            with open(graph_file, 'rb') as f:
+                cached = (mtime, hashlib.sha256(f.read()).hexdigest())
+            self._graph_versions[graph_file] = cached
+        return cached[1]
+
+    def result_key(self, input_hash, graph_file, task_data):
+        try:
+            version = self.graph_version(graph_file)
+        except OSError:
+            return None
+        description = {
+            'input_hash': input_hash,
+            'graph': graph_file,
+            'graph_version': version,
+            'parameters': {name: task_data.get(name) for name in self.PARAMETERS}
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def _entry_path(self, kind, key, ext=''):
+        return os.path.join(self.cache_dir, kind + 's', key[:2], key + ext)
+
+    def _lookup(self, key):
+        row = self.conn.execute('SELECT path FROM cache_entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if not os.path.isfile(row[0]):
+            self._write([('DELETE FROM cache_entries WHERE key = ?', [(key,)])])
+            return None
+        self._write([('UPDATE cache_entries SET last_used = ? WHERE key = ?', [(time.time(), key)])])
+        return row[0]
+
+    def _add(self, kind, key, source, ext=''):
+        path = self._entry_path(kind, key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_file(source, path)
+        now = time.time()
+        self._write([('INSERT OR REPLACE INTO cache_entries (key, kind, path, size, created, last_used) '
+                      'VALUES (?, ?, ?, ?, ?, ?)', [(key, kind, path, os.path.getsize(path), now, now)])])
+        self.evict()
+        return path
+
+    def store_input(self, input_hash, path):
+        """
+        Keeps the uploaded input once per content hash. An input seen before
+        replaces the upload by a link to the stored copy.
+        """
+        cached = self._lookup(input_hash)
+        if cached is not None:
+            link_file(cached, path)
+            return
+        self._add(self.KIND_INPUT, input_hash, path, os.path.splitext(path)[1])
+
+    def get_result(self, key):
+        """ Path of the cached result for the key, None if there is none. """
+        return self._lookup(key)
+
+    def add_result(self, key, path):
+        self._add(self.KIND_RESULT, key, path, os.path.splitext(path)[1])
+
+    def evict(self):
+        """ Drops the least recently used entries until the cached files fit into the quota. """
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache_entries').fetchone()[0]
+        if total <= self.quota:
+            return
+        evicted = []
+        for key, path, size in self.conn.execute('SELECT key, path, size FROM cache_entries '
+                                                'ORDER BY last_used').fetchall():
+            if total <= self.quota:
+                break
+            evicted.append((key,))
+            total -= size
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self._write([('DELETE FROM cache_entries WHERE key = ?', evicted)])
+        self.log.info(f'evicted {len(evicted)} cache entries')
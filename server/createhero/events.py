@@ -0,0 +1,101 @@
+from tornado.ioloop import IOLoop
+import json
+import logging
+import os
+import socket
+import time
+
+
+class EventHub(object):
+    """
+    In-process publish/subscribe for task events like status changes and new
+    progress lines. Callbacks subscribe per task ID. Every server process
+    listens on a unix datagram socket in the socket directory, so an event
+    published once by the executor reaches the subscribers of all processes.
+    Datagrams are never waited for, a process that falls behind loses events
+    and its subscribers catch up from the progress log.
+
+    Unix sockets only connect on the host that bound them, so the socket
+    directory must belong to one host. Any socket in it that refuses a
+    connection is taken for the leftover of a dead process and removed.
+    """
+    MAX_DATAGRAM = 65000
+    PEER_REFRESH = 5
+
+    def __init__(self, socket_dir):
+        self.socket_dir = socket_dir
+        self.path = None
+        self.log = logging.getLogger('EventHub')
+        self._subscribers = {}
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._peers = []
+        self._peers_checked = 0
+
+    def listen(self):
+        os.makedirs(self.socket_dir, exist_ok=True)
+        self.path = os.path.join(self.socket_dir, f'{os.getpid()}.sock')
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock.bind(self.path)
+        IOLoop.current().add_handler(self._sock.fileno(), self._on_readable, IOLoop.READ)
+
+    def subscribe(self, task_id, callback):
+        self._subscribers.setdefault(task_id, set()).add(callback)
+
+    def unsubscribe(self, task_id, callback):
+        callbacks = self._subscribers.get(task_id, set())
+        callbacks.discard(callback)
+        if not callbacks:
+            self._subscribers.pop(task_id, None)
+
+    def publish(self, task_id, event):
+        event = dict(event, task_id=task_id)
+        self._deliver(event)
+        data = json.dumps(event).encode()
+        if len(data) > self.MAX_DATAGRAM:
+            # too large for a datagram, let remote subscribers read it from the log
+            data = json.dumps({'task_id': task_id, 'type': event['type'], 'gap': True}).encode()
+        for peer in self._get_peers():
+            try:
+                self._sock.sendto(data, peer)
+            except BlockingIOError:
+                pass
+            except (ConnectionRefusedError, FileNotFoundError):
+                # nobody listens anymore, the process is gone
+                self._remove_peer(peer)
+
+    def _get_peers(self):
+        if time.monotonic() - self._peers_checked > self.PEER_REFRESH:
+            self._peers_checked = time.monotonic()
+            try:
+                self._peers = [f.path for f in os.scandir(self.socket_dir)
+                               if f.name.endswith('.sock') and f.path != self.path]
+            except FileNotFoundError:
+                self._peers = []
+        return self._peers
+
+    def _remove_peer(self, peer):
+        self._peers = [p for p in self._peers if p != peer]
+        try:
+            os.unlink(peer)
+        except FileNotFoundError:
+            pass
+
+    def _on_readable(self, fd, events):
+        while True:
+            try:
+                data = self._sock.recv(self.MAX_DATAGRAM + 1024)
+            except BlockingIOError:
+                return
+            try:
+                self._deliver(json.loads(data))
+            except ValueError:
+                self.log.error(f'dropping malformed event {data[:100]}')
+
+    def _deliver(self, event):
+        for callback in list(self._subscribers.get(event['task_id'], ())):
+            try:
+                callback(event)
+            except Exception:
+                self.log.exception(f'subscriber failed on event {event["type"]}')
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import re
+
+# nodes that exist once per output format, everything before them is shared
+BRANCH_CALCULATORS = ('SceneCroppingCalculator', 'VideoPreStreamCalculator', 'OpenCvVideoEncoderCalculator')
+CALCULATOR = re.compile(r'^\s*calculator:\s*"(\w+)"', re.M)
+CONNECTION = re.compile(r'^(\s*(input_stream|output_stream|input_side_packet|output_side_packet):\s*"(?:\w+:)?)(\w+)(")',
+                        re.M)
+# a quoted string, in double or single quotes, escaped quotes do not end it
+STRING = re.compile(r'"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\'')
+
+
+def _split_nodes(text):
+    """ Splits a graph text proto into (text before the node, node block or None) pieces. """
+    pieces = []
+    pos = 0
+    for m in re.finditer(r'^node\s*\{', text, re.M):
+        if m.start() < pos:
+            continue
+        depth = 0
+        end = m.end() - 1
+        while end < len(text):
+            c = text[end]
+            if c == '#':
+                end = text.find('\n', end)
+                if end < 0:
+                    end = len(text)
+                continue
+            if c in '"\'':
+                end = _string_end(text, end)
+            elif c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+                if depth == 0:
+                    break
+            end += 1
+        pieces.append((text[pos:m.start()], text[m.start():end + 1]))
+        pos = end + 1
+    pieces.append((text[pos:], None))
+    return pieces
+
+
+def _string_end(text, start):
+    """ Position of the quote closing the string opened at start, skipping escaped quotes. """
+    m = STRING.match(text, start)
+    return m.end() - 1 if m else len(text)
+
+
+def fan_out_graph(text, count):
+    """
+    Rewrites a single output scenario graph into one producing count outputs.
+    Decoding, detection and shot boundaries stay shared, the cropping and
+    encoding nodes are repeated per output. Their streams get the output index
+    as suffix, as do the side packets they read, so output i is configured by
+    aspect_ratio_i and output_video_path_i. A single output keeps the graph
+    as it is.
+    """
+    if count < 2:
+        return text
+    pieces = _split_nodes(text)
+    branch = [node for _, node in pieces if node is not None
+              and CALCULATOR.search(node) and CALCULATOR.search(node).group(1) in BRANCH_CALCULATORS]
+    renamed = set()
+    for node in branch:
+        for m in CONNECTION.finditer(node):
+            if m.group(2) in ('output_stream', 'input_side_packet', 'output_side_packet'):
+                renamed.add(m.group(3))
+
+    def branch_copy(node, index):
+        return CONNECTION.sub(lambda m: m.group(1) + (f'{m.group(3)}_{index}' if m.group(3) in renamed
+                                                       else m.group(3)) + m.group(4), node)
+
+    result = []
+    for before, node in pieces:
+        result.append(before)
+        if node is None:
+            continue
+        if node in branch:
+            result.append('\n\n'.join(branch_copy(node, i) for i in range(count)))
+        else:
+            result.append(node)
+    return ''.join(result)
+
+
+def fan_out_graph_file(graph_file, count, graph_dir):
+    """
+    Writes the fanned out graph to graph_dir once per graph version and output
+    count, returns its path. A single output runs the graph file itself.
+    """
+    if count < 2:
+        return graph_file
+    with open(graph_file, 'r') as f:
+        text = f.read()
+    version = hashlib.sha256(text.encode()).hexdigest()[:12]
+    name = os.path.splitext(os.path.basename(graph_file))[0]
+    path = os.path.join(graph_dir, f'{name}_{count}x_{version}.pbtxt')
+    if not os.path.exists(path):
+        os.makedirs(graph_dir, exist_ok=True)
+        with open(path + f'.{os.getpid()}.tmp', 'w') as f:
+            f.write(fan_out_graph(text, count))
+        os.replace(path + f'.{os.getpid()}.tmp', path)
+    return path
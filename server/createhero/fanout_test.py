@@ -0,0 +1,157 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from createhero.fanout import _split_nodes, fan_out_graph, fan_out_graph_file
+
+GRAPH = '''# a scenario graph { with a brace in a comment
+max_queue_size: -1
+
+node {
+  calculator: "OpenCvVideoDecoderCalculator"
+  input_side_packet: "INPUT_FILE_PATH:input_video_path"
+  output_stream: "VIDEO:video_raw"
+  output_stream: "VIDEO_PRESTREAM:video_header"
+#  output_side_packet: "SAVED_AUDIO_PATH:audio_path" }
+}
+
+node {
+  calculator: "SignalFusingCalculator"
+  input_stream: "VIDEO:video_raw"
+  output_stream: "salient_regions"
+  options: {
+    [mediapipe.autoflip.SignalFusingCalculatorOptions.ext]: {
+      label: "a } brace and a \\" quote"
+      note: 'single { quoted'
+    }
+  }
+}
+
+node {
+  calculator: "SceneCroppingCalculator"
+  input_side_packet: "EXTERNAL_ASPECT_RATIO:aspect_ratio"
+  input_stream: "VIDEO_FRAMES:video_raw"
+  input_stream: "SALIENT_REGIONS:salient_regions"
+  output_stream: "CROPPED_FRAMES:cropped_frames"
+}
+
+node {
+  calculator: "VideoPreStreamCalculator"
+  input_stream: "FRAME:cropped_frames"
+  input_stream: "VIDEO_PRESTREAM:video_header"
+  output_stream: "output_frames_video_header"
+}
+
+node {
+  calculator: "OpenCvVideoEncoderCalculator"
+  input_stream: "VIDEO:cropped_frames"
+  input_stream: "VIDEO_PRESTREAM:output_frames_video_header"
+  input_side_packet: "OUTPUT_FILE_PATH:output_video_path"
+}
+'''
+
+CALCULATOR = re.compile(r'calculator:\s*"(\w+)"')
+
+
+def _calculators(text):
+    return CALCULATOR.findall(text)
+
+
+class SplitNodesTest(unittest.TestCase):
+
+    def test_nodes(self):
+        pieces = _split_nodes(GRAPH)
+        nodes = [node for _, node in pieces if node is not None]
+        self.assertEqual([_calculators(node) for node in nodes],
+                         [['OpenCvVideoDecoderCalculator'], ['SignalFusingCalculator'], ['SceneCroppingCalculator'],
+                          ['VideoPreStreamCalculator'], ['OpenCvVideoEncoderCalculator']])
+        # nothing is lost or duplicated
+        self.assertEqual(''.join(before + (node or '') for before, node in pieces), GRAPH)
+
+    def test_braces_in_comments_and_strings(self):
+        nodes = [node for _, node in _split_nodes(GRAPH) if node is not None]
+        self.assertTrue(nodes[0].endswith('"SAVED_AUDIO_PATH:audio_path" }\n}'))
+        self.assertIn("note: 'single { quoted'", nodes[1])
+        self.assertTrue(nodes[1].rstrip().endswith('}\n  }\n}'))
+
+    def test_unterminated_string(self):
+        pieces = _split_nodes('node {\n  calculator: "Broken\n}\n')
+        self.assertEqual(''.join(before + (node or '') for before, node in pieces), 'node {\n  calculator: "Broken\n}\n')
+
+
+class FanOutGraphTest(unittest.TestCase):
+
+    def test_shared_and_branch_nodes(self):
+        text = fan_out_graph(GRAPH, 3)
+        self.assertEqual(_calculators(text),
+                         ['OpenCvVideoDecoderCalculator', 'SignalFusingCalculator'] + ['SceneCroppingCalculator'] * 3
+                         + ['VideoPreStreamCalculator'] * 3 + ['OpenCvVideoEncoderCalculator'] * 3)
+        self.assertEqual(text.count('output_stream: "VIDEO:video_raw"'), 1)
+
+    def test_renames_per_output(self):
+        text = fan_out_graph(GRAPH, 2)
+        for i in range(2):
+            self.assertEqual(text.count(f'input_side_packet: "EXTERNAL_ASPECT_RATIO:aspect_ratio_{i}"'), 1)
+            self.assertEqual(text.count(f'input_side_packet: "OUTPUT_FILE_PATH:output_video_path_{i}"'), 1)
+            self.assertEqual(text.count(f'output_stream: "CROPPED_FRAMES:cropped_frames_{i}"'), 1)
+            self.assertEqual(text.count(f'input_stream: "VIDEO:cropped_frames_{i}"'), 1)
+            self.assertEqual(text.count(f'output_stream: "output_frames_video_header_{i}"'), 1)
+            self.assertEqual(text.count(f'input_stream: "VIDEO_PRESTREAM:output_frames_video_header_{i}"'), 1)
+        # streams of the shared nodes keep their names in the branches reading them
+        self.assertEqual(text.count('input_stream: "VIDEO_FRAMES:video_raw"'), 2)
+        self.assertEqual(text.count('input_stream: "SALIENT_REGIONS:salient_regions"'), 2)
+        self.assertEqual(text.count('input_stream: "VIDEO_PRESTREAM:video_header"'), 2)
+        self.assertNotIn('aspect_ratio"', text)
+        self.assertNotIn('output_video_path"', text)
+
+    def test_single_output_passthrough(self):
+        self.assertEqual(fan_out_graph(GRAPH, 1), GRAPH)
+
+    def test_scenario_graph(self):
+        graph_file = os.path.join(os.path.dirname(__file__), '..', '..', 'mediapipe', 'examples', 'desktop',
+                                  'autoflip', 'scenarios', 'flip', 'adjusted.pbtxt')
+        if not os.path.exists(graph_file):
+            self.skipTest('scenario graphs not found')
+        with open(graph_file, 'r') as f:
+            text = f.read()
+        fanned_out = fan_out_graph(text, 2)
+        calculators = _calculators(text)
+        for calculator in ('SceneCroppingCalculator', 'VideoPreStreamCalculator', 'OpenCvVideoEncoderCalculator'):
+            self.assertEqual(_calculators(fanned_out).count(calculator), 2 * calculators.count(calculator))
+        self.assertEqual(len(_calculators(fanned_out)), len(calculators) + 3)
+        for i in range(2):
+            self.assertIn(f'aspect_ratio_{i}"', fanned_out)
+            self.assertIn(f'output_video_path_{i}"', fanned_out)
+
+
+class FanOutGraphFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.graph_file = os.path.join(self.directory, 'adjusted.pbtxt')
+        with open(self.graph_file, 'w') as f:
+            f.write(GRAPH)
+
+    def test_written_once_per_version(self):
+        graph_dir = os.path.join(self.directory, '.graphs')
+        path = fan_out_graph_file(self.graph_file, 2, graph_dir)
+        with open(path, 'r') as f:
+            self.assertEqual(f.read(), fan_out_graph(GRAPH, 2))
+        self.assertEqual(fan_out_graph_file(self.graph_file, 2, graph_dir), path)
+        self.assertNotEqual(fan_out_graph_file(self.graph_file, 3, graph_dir), path)
+        with open(self.graph_file, 'a') as f:
+            f.write('\n')
+        self.assertNotEqual(fan_out_graph_file(self.graph_file, 2, graph_dir), path)
+        self.assertEqual(len(os.listdir(graph_dir)), 3)
+
+    def test_single_output_passthrough(self):
+        graph_dir = os.path.join(self.directory, '.graphs')
+        self.assertEqual(fan_out_graph_file(self.graph_file, 1, graph_dir), self.graph_file)
+        self.assertFalse(os.path.exists(graph_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
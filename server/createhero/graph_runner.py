@@ -0,0 +1,226 @@
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.queues import LifoQueue
+import asyncio
+import logging
+import multiprocessing
+import os
+import re
+import time
+
+
+class GraphUnavailable(Exception):
+    """ The in-process backend cannot run the graph, the caller falls back to the run_autoflip binary. """
+    pass
+
+
+# the encoder consumes every frame of the output, counting them yields the progress
+ENCODER_INPUT = re.compile(r'calculator:\s*"OpenCvVideoEncoderCalculator".*?input_stream:\s*"VIDEO:(\w+)"', re.S)
+
+
+def _serve(conn, progress_interval):
+    """
+    Main loop of a graph worker process. Graphs are validated once and kept
+    for later runs, so neither the config nor the mediapipe runtime is set up
+    again per task. Answers every job with progress messages and a final
+    'done' or 'unsupported' message.
+    """
+    try:
+        import mediapipe as mp
+    except ImportError as e:
+        conn.send({'type': 'unavailable', 'error': str(e)})
+        return
+    conn.send({'type': 'ready'})
+    graphs = {}
+    while True:
+        job = conn.recv()
+        if job is None:
+            return
+        key = (job['graph_file'], os.path.getmtime(job['graph_file']))
+        if key not in graphs:
+            try:
+                graphs[key] = _load_graph(mp, job['graph_file'], conn, progress_interval)
+            except Exception as e:
+                conn.send({'type': 'unsupported', 'error': str(e)})
+                continue
+        graph, run = graphs[key]
+        run.update(frames=0, sent=time.monotonic())
+        try:
+            graph.start_run({name: mp.packet_creator.create_string(value)
+                             for name, value in job['side_packets'].items()})
+            graph.wait_until_done()
+        except Exception as e:
+            # start over with a fresh graph next time
+            del graphs[key]
+            conn.send({'type': 'done', 'status': 1, 'frames': run['frames'], 'error': str(e)})
+            continue
+        conn.send({'type': 'done', 'status': 0, 'frames': run['frames']})
+
+
+def _load_graph(mp, graph_file, conn, progress_interval):
+    with open(graph_file, 'r') as f:
+        text = f.read()
+    config = mp.ValidatedGraphConfig()
+    config.initialize(graph_config=text)
+    graph = mp.CalculatorGraph(validated_graph_config=config)
+    run = {'frames': 0, 'sent': 0}
+    m = ENCODER_INPUT.search(text)
+    if m:
+        def on_frame(stream_name, packet):
+            run['frames'] += 1
+            if time.monotonic() - run['sent'] >= progress_interval:
+                run['sent'] = time.monotonic()
+                conn.send({'type': 'progress', 'frames': run['frames']})
+        graph.observe_output_stream(m.group(1), on_frame)
+    return graph, run
+
+
+class GraphWorker(object):
+    """ A long-lived process running one graph at a time, started on first use and again after it died. """
+
+    def __init__(self, index, progress_interval):
+        self.index = index
+        self.progress_interval = progress_interval
+        self.log = logging.getLogger('GraphWorker')
+        self.process = None
+        self.bindings_missing = False
+        self._conn = None
+        self._ready = None
+        self._job = None
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    async def _ensure_started(self):
+        if not self.alive:
+            context = multiprocessing.get_context('spawn')
+            self._conn, child_conn = context.Pipe()
+            self.process = context.Process(target=_serve, args=(child_conn, self.progress_interval),
+                                           name=f'graph-worker-{self.index}', daemon=True)
+            self.process.start()
+            child_conn.close()
+            self._ready = Future()
+            IOLoop.current().add_handler(self._conn.fileno(), self._on_readable, IOLoop.READ)
+        return await self._ready
+
+    async def run(self, graph_file, side_packets, on_progress=None, timeout=None):
+        """ Runs the graph with the given string side packets, returns the exit status. """
+        ready = await self._ensure_started()
+        if ready is not True:
+            self.bindings_missing = True
+            raise GraphUnavailable(f'mediapipe bindings unavailable: {ready}')
+        self._job = {'done': Future(), 'on_progress': on_progress}
+        self._conn.send({'graph_file': graph_file, 'side_packets': side_packets})
+        try:
+            message = await asyncio.wait_for(self._job['done'], timeout)
+        except asyncio.TimeoutError:
+            self.log.warning(f'graph run exceeded {timeout}s, killing worker {self.index}')
+            self.kill()
+            return -9
+        except asyncio.CancelledError:
+            # the graph would keep running for nobody, the next run starts a fresh worker
+            self.kill()
+            raise
+        finally:
+            self._job = None
+        if message['type'] == 'unsupported':
+            raise GraphUnavailable(message['error'])
+        if message.get('error'):
+            self.log.warning(f'graph run failed: {message["error"]}')
+        return message['status']
+
+    def _on_readable(self, fd, events):
+        try:
+            while self._conn.poll():
+                self._handle(self._conn.recv())
+        except (EOFError, OSError):
+            self._closed()
+
+    def _handle(self, message):
+        if message['type'] == 'ready':
+            self._ready.set_result(True)
+        elif message['type'] == 'unavailable':
+            self._ready.set_result(message['error'])
+        elif self._job is None:
+            return
+        elif message['type'] == 'progress':
+            if self._job['on_progress'] is not None:
+                self._job['on_progress'](message['frames'])
+        elif not self._job['done'].done():
+            self._job['done'].set_result(message)
+
+    def _closed(self):
+        IOLoop.current().remove_handler(self._conn.fileno())
+        self._conn.close()
+        if not self._ready.done():
+            self._ready.set_result('graph worker exited during startup')
+        if self._job is not None and not self._job['done'].done():
+            self._job['done'].set_result({'type': 'done', 'status': 1, 'error': 'graph worker died'})
+        self.process = None
+
+    def kill(self):
+        if self.alive:
+            self.process.kill()
+            self.process.join()
+        if self._conn is not None and not self._conn.closed:
+            self._closed()
+
+    def stop(self):
+        if self.alive:
+            self._conn.send(None)
+
+
+class GraphRunner(object):
+    """
+    Runs scenario graphs through the mediapipe python bindings instead of
+    spawning run_autoflip per task. One worker process per worker pool slot
+    keeps the loaded runtime and validated graphs across tasks. Graph workers
+    report the encoded frames, so progress no longer depends on parsing logs.
+    Raises GraphUnavailable when the bindings (or the autoflip calculators
+    linked into them) are missing. Graphs a worker could not load are
+    remembered per file, until the file changes, so later tasks go straight
+    to the run_autoflip binary.
+    """
+
+    def __init__(self, size, progress_interval=0.5):
+        self.workers = [GraphWorker(i, progress_interval) for i in range(size)]
+        self.available = True
+        # graph file: modification time of the version that could not be loaded
+        self._unsupported = {}
+        # hand out the most recently used worker first, it is the warmest
+        self._idle = LifoQueue()
+        for worker in self.workers:
+            self._idle.put_nowait(worker)
+
+    @staticmethod
+    def _mtime(graph_file):
+        try:
+            return os.path.getmtime(graph_file)
+        except OSError:
+            return None
+
+    def supports(self, graph_file):
+        """ False if the bindings are missing or the graph file could not be loaded before. """
+        return self.available and self._unsupported.get(graph_file, -1) != self._mtime(graph_file)
+
+    async def run(self, graph_file, side_packets, on_progress=None, timeout=None):
+        if not self.available:
+            raise GraphUnavailable('mediapipe bindings unavailable')
+        if not self.supports(graph_file):
+            raise GraphUnavailable(f'graph {graph_file} cannot be loaded in-process')
+        worker = await self._idle.get()
+        try:
+            return await worker.run(graph_file, side_packets, on_progress, timeout)
+        except GraphUnavailable:
+            if worker.bindings_missing:
+                self.available = False
+            else:
+                self._unsupported[graph_file] = self._mtime(graph_file)
+            raise
+        finally:
+            self._idle.put_nowait(worker)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
@@ -0,0 +1,239 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from tornado.queues import LifoQueue
+from tornado.testing import AsyncTestCase, gen_test
+
+from createhero import graph_runner
+from createhero.graph_runner import GraphRunner, GraphUnavailable, GraphWorker
+from createhero.store import TaskStore
+from createhero.util import VideoReformatTask
+
+
+def fake_serve(conn, progress_interval):
+    """ Stands in for the mediapipe graph worker, the graph file name tells it what to do. """
+    conn.send({'type': 'ready'})
+    while True:
+        job = conn.recv()
+        if job is None:
+            return
+        name = os.path.basename(job['graph_file'])
+        if name == 'crash':
+            os._exit(1)
+        if name == 'unsupported':
+            conn.send({'type': 'unsupported', 'error': 'unknown calculator'})
+            continue
+        conn.send({'type': 'progress', 'frames': 10})
+        conn.send({'type': 'done', 'status': 0, 'frames': 20})
+
+
+def fake_serve_without_bindings(conn, progress_interval):
+    conn.send({'type': 'unavailable', 'error': "No module named 'mediapipe'"})
+
+
+class StubWorker(object):
+    """ A graph worker answering every run with the given exit status or GraphUnavailable. """
+
+    def __init__(self, status=0, unsupported=(), bindings_missing=False):
+        self.status = status
+        self.unsupported = unsupported
+        self.bindings_missing = bindings_missing
+        self.runs = []
+
+    async def run(self, graph_file, side_packets, on_progress=None, timeout=None):
+        self.runs.append(graph_file)
+        if self.bindings_missing:
+            raise GraphUnavailable('mediapipe bindings unavailable')
+        if graph_file in self.unsupported:
+            raise GraphUnavailable('unknown calculator')
+        return self.status
+
+    def stop(self):
+        pass
+
+
+def _runner(*workers):
+    runner = GraphRunner(0)
+    runner.workers = list(workers)
+    runner._idle = LifoQueue()
+    for worker in workers:
+        runner._idle.put_nowait(worker)
+    return runner
+
+
+class GraphWorkerTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.worker = GraphWorker(0, 0.1)
+
+    def tearDown(self):
+        self.worker.kill()
+        super().tearDown()
+
+    @gen_test(timeout=30)
+    async def test_run(self):
+        with mock.patch.object(graph_runner, '_serve', fake_serve):
+            progress = []
+            self.assertEqual(await self.worker.run('graph', {}, on_progress=progress.append), 0)
+            self.assertEqual(progress, [10])
+            pid = self.worker.process.pid
+            # the worker is kept for the next run
+            self.assertEqual(await self.worker.run('graph', {}), 0)
+            self.assertEqual(self.worker.process.pid, pid)
+
+    @gen_test(timeout=30)
+    async def test_restart_after_crash(self):
+        with mock.patch.object(graph_runner, '_serve', fake_serve):
+            self.assertEqual(await self.worker.run('graph', {}), 0)
+            pid = self.worker.process.pid
+            self.assertEqual(await self.worker.run('crash', {}), 1)
+            self.assertFalse(self.worker.alive)
+            self.assertEqual(await self.worker.run('graph', {}), 0)
+            self.assertNotEqual(self.worker.process.pid, pid)
+
+    @gen_test(timeout=30)
+    async def test_unsupported_graph(self):
+        with mock.patch.object(graph_runner, '_serve', fake_serve):
+            with self.assertRaises(GraphUnavailable):
+                await self.worker.run('unsupported', {})
+            self.assertFalse(self.worker.bindings_missing)
+            self.assertEqual(await self.worker.run('graph', {}), 0)
+
+    @gen_test(timeout=30)
+    async def test_bindings_missing(self):
+        with mock.patch.object(graph_runner, '_serve', fake_serve_without_bindings):
+            with self.assertRaises(GraphUnavailable):
+                await self.worker.run('graph', {})
+            self.assertTrue(self.worker.bindings_missing)
+
+
+class GraphRunnerTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.graph_file = os.path.join(self.directory, 'adjusted.pbtxt')
+        self.other_graph_file = os.path.join(self.directory, 'original.pbtxt')
+        for path in (self.graph_file, self.other_graph_file):
+            with open(path, 'w') as f:
+                f.write('node {}')
+
+    @gen_test
+    async def test_run(self):
+        worker = StubWorker(status=3)
+        runner = _runner(worker)
+        self.assertEqual(await runner.run(self.graph_file, {}), 3)
+        self.assertEqual(worker.runs, [self.graph_file])
+        self.assertTrue(runner.supports(self.graph_file))
+
+    @gen_test
+    async def test_bindings_missing(self):
+        worker = StubWorker(bindings_missing=True)
+        runner = _runner(worker)
+        with self.assertRaises(GraphUnavailable):
+            await runner.run(self.graph_file, {})
+        self.assertFalse(runner.available)
+        self.assertFalse(runner.supports(self.other_graph_file))
+        with self.assertRaises(GraphUnavailable):
+            await runner.run(self.other_graph_file, {})
+        self.assertEqual(len(worker.runs), 1)
+
+    @gen_test
+    async def test_unsupported_graph_is_remembered(self):
+        worker = StubWorker(unsupported=[self.graph_file])
+        runner = _runner(worker)
+        with self.assertRaises(GraphUnavailable):
+            await runner.run(self.graph_file, {})
+        self.assertTrue(runner.available)
+        self.assertFalse(runner.supports(self.graph_file))
+        with self.assertRaises(GraphUnavailable):
+            await runner.run(self.graph_file, {})
+        self.assertEqual(worker.runs, [self.graph_file])
+        # other graphs still run in-process
+        self.assertEqual(await runner.run(self.other_graph_file, {}), 0)
+
+    @gen_test
+    async def test_changed_graph_is_tried_again(self):
+        worker = StubWorker(unsupported=[self.graph_file])
+        runner = _runner(worker)
+        with self.assertRaises(GraphUnavailable):
+            await runner.run(self.graph_file, {})
+        os.utime(self.graph_file, (0, 0))
+        self.assertTrue(runner.supports(self.graph_file))
+
+    @gen_test
+    async def test_worker_returned_after_error(self):
+        worker = StubWorker(unsupported=[self.graph_file])
+        runner = _runner(worker)
+        with self.assertRaises(GraphUnavailable):
+            await runner.run(self.graph_file, {})
+        self.assertEqual(runner._idle.qsize(), 1)
+
+
+class AutoflipFallbackTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        graphs = os.path.join(self.directory, 'graphs')
+        os.makedirs(os.path.join(graphs, 'scenarios', 'resize'))
+        with open(os.path.join(graphs, 'scenarios', 'resize', 'original.pbtxt'), 'w') as f:
+            f.write('node {}')
+        patcher = mock.patch.object(VideoReformatTask, 'AUTOFLIP_GRAPHS', graphs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tasks = TaskStore(os.path.join(self.directory, 'tasks.db'))
+        self.commands = []
+
+    def _task(self, task_id, runner):
+        self.tasks[task_id] = {'status': VideoReformatTask.STATUS_INIT, 'task_name': task_id, 'action': 'resize',
+                               'target_quality': 'high', 'target_size': 'original'}
+        task = VideoReformatTask(task_id, self.directory, self.tasks, options={'graph_runner': runner})
+
+        async def run_process(command, **kwargs):
+            self.commands.append(command)
+            return 0
+
+        task._run_process = run_process
+        return task
+
+    async def _run_autoflip(self, task):
+        return await task._run_autoflip('input.mp4', ['output.mp4'], timeout=10)
+
+    @gen_test
+    async def test_in_process(self):
+        worker = StubWorker()
+        self.assertEqual(await self._run_autoflip(self._task('t1', _runner(worker))), 0)
+        self.assertEqual(len(worker.runs), 1)
+        self.assertEqual(self.commands, [])
+
+    @gen_test
+    async def test_falls_back_without_bindings(self):
+        worker = StubWorker(bindings_missing=True)
+        runner = _runner(worker)
+        for task_id in ('t1', 't2'):
+            self.assertEqual(await self._run_autoflip(self._task(task_id, runner)), 0)
+        self.assertEqual(len(worker.runs), 1)
+        self.assertEqual([command[0] for command in self.commands], [VideoReformatTask.AUTOFLIP_BINARY] * 2)
+
+    @gen_test
+    async def test_falls_back_for_unsupported_graph(self):
+        task = self._task('t1', None)
+        worker = StubWorker(unsupported=[task._graph_file()])
+        runner = _runner(worker)
+        for task_id in ('t2', 't3'):
+            self.assertEqual(await self._run_autoflip(self._task(task_id, runner)), 0)
+        # the second task goes straight to the binary
+        self.assertEqual(len(worker.runs), 1)
+        self.assertEqual(len(self.commands), 2)
+        self.assertIn(f'--calculator_graph_config_file={task._graph_file()}', self.commands[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,17 @@
+import datetime
+import email.utils
 import os
+import re
+import time
+import urllib.parse as up
+
+from ..progress import ProgressLog
+from ..scheduler import RunQueue
 
 from adhero_utils.handlers import GenericHandler
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.web import HTTPError, StaticFileHandler
 
 
 class VideoBaseHandler(GenericHandler):
@@ -24,12 +35,130 @@ class VideoBaseHandler(GenericHandler):
     def get_task_dir(self, task_id):
         return os.path.join(self.settings['working_directory'], task_id)
 
-    def _send_file(self, filename, open_as='r'):
-        with open(filename, open_as) as of:
-            while 1:
-                data = of.read(16384)
-                if not data: break
-                self.write(data)
+    def _list_tasks(self, fields, limit=50, max_limit=500):
+        """
+        One page of tasks selected by the query arguments: status (repeated or
+        comma separated), created_after and created_before (unix time or ISO
+        date), name (substring of the task name), sort (a sortable summary
+        field, prefixed with '-' for descending order), limit, and the cursor
+        returned with the previous page. Returns the given fields of the tasks
+        and the cursor of the next page.
+        """
+        statuses = [status.strip() for value in self.get_query_arguments('status')
+                    for status in value.split(',') if status.strip()]
+        sort = self.get_query_argument('sort', '-created')
+        try:
+            limit = min(max(int(self.get_query_argument('limit', limit)), 1), max_limit)
+            task_ids, cursor = self.settings['tasks'].page(
+                limit, cursor=self.get_query_argument('cursor', None) or None, statuses=statuses,
+                created_after=self._parse_time(self.get_query_argument('created_after', None)),
+                created_before=self._parse_time(self.get_query_argument('created_before', None)),
+                name=self.get_query_argument('name', None), sort=sort.lstrip('-'), descending=sort.startswith('-'))
+        except ValueError as e:
+            self._exit_error(f'Invalid task listing: {e}', status=400)
+        return self.settings['tasks'].get_many(task_ids, fields), cursor
+
+    @staticmethod
+    def _parse_time(value):
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return datetime.datetime.fromisoformat(value).timestamp()
+
+    def _queue_task(self, task_id):
+        # the queue wait of the task counts from here
+        self.settings['tasks'].update(task_id, {'enqueued': time.time()})
+        self.settings['run_queue'].push(task_id, self.settings['tasks'].get_fields(task_id, RunQueue.TASK_FIELDS))
+        self.settings['task_queue'].put(task_id)
+
+    async def _enqueue_task(self, task_id):
+        """ Adds the task to the run queue and wakes up the executor, off the IOLoop as both can block. """
+        await IOLoop.current().run_in_executor(None, self._queue_task, task_id)
+
+    def _parse_range(self, size):
+        """
+        Returns the (start, end) byte span of a single-range Range header, or
+        None if there is none or it is invalid, which means serving the whole
+        file (RFC 7233 2.1). A span with start >= end cannot be satisfied.
+        """
+        range_header = self.request.headers.get('Range')
+        if_range = self.request.headers.get('If-Range')
+        if not range_header or (if_range and if_range != self._headers.get('Etag')):
+            return None
+        m = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip())
+        if not m or not any(m.groups()):
+            return None
+        first, last = m.groups()
+        if not first:
+            # suffix range, the last n bytes
+            return max(0, size - int(last)), size
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        end = min(size, int(last) + 1) if last else size
+        return start, end
+
+    async def _stream_file(self, filename, content_type='application/octet-stream', chunk_size=262144):
+        """
+        Streams the file to the client, waiting for every chunk to be flushed
+        before reading the next one off the IOLoop. Answers conditional requests
+        via ETag / If-None-Match and serves single byte ranges with 206.
+        """
+        stat = os.stat(filename)
+        size = stat.st_size
+        self.set_header('Content-Type', content_type)
+        self.set_header('Accept-Ranges', 'bytes')
+        self.set_header('ETag', f'"{stat.st_mtime_ns:x}-{size:x}"')
+        self.set_header('Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True))
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+        start, end = 0, size
+        requested = self._parse_range(size)
+        if requested is not None:
+            start, end = requested
+            if start >= end:
+                self.set_status(416)
+                self.set_header('Content-Range', f'bytes */{size}')
+                self.finish()
+                return
+            self.set_status(206)
+            self.set_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+        self.set_header('Content-Length', end - start)
+        loop = IOLoop.current()
+        sent = 0
+        try:
+            with open(filename, 'rb') as of:
+                of.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    data = await loop.run_in_executor(None, of.read, min(chunk_size, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    self.write(data)
+                    try:
+                        await self.flush()
+                    except StreamClosedError:
+                        return
+                    sent += len(data)
+        finally:
+            if self.settings.get('metrics') is not None:
+                self.settings['metrics'].inc('createhero_bytes_total', sent, direction='download')
+        self.finish()
+
+
+class VideoStaticFileHandler(StaticFileHandler):
+    """ Serves static files, but never hidden ones like the task store in the working directory. """
+
+    def validate_absolute_path(self, root, absolute_path):
+        relative_path = os.path.relpath(absolute_path, root)
+        if any(part.startswith('.') for part in relative_path.split(os.sep)):
+            raise HTTPError(404)
+        return super().validate_absolute_path(root, absolute_path)
 
 
 class VideoUIMixin(VideoBaseHandler):
@@ -40,6 +169,23 @@ class VideoUIMixin(VideoBaseHandler):
     def render(self, template, **kwargs):
         super().render(template, deploy_path=self.settings['deploy_path'], **kwargs)
 
+    # fields shown in the task list, the full records are never read for it
+    TASK_LIST_FIELDS = ('task_id', 'action', 'task_name', 'input_file_name', 'source_file_name', 'input_file_size',
+                        'target_quality', 'target_size', 'target_format', 'target_formats', 'status',
+                        'output_file_size', 'captions', 'evicted')
+
+    def render_tasks(self, messages=()):
+        """ Renders the page of the task list selected by the query arguments, with a link to the next one. """
+        tasks, cursor = self._list_tasks(self.TASK_LIST_FIELDS)
+        filters = {name: self.get_query_argument(name, '') for name in ('status', 'name', 'created_after', 'sort')}
+        next_url = None
+        if cursor is not None:
+            query = {name: value for name, value in filters.items() if value}
+            query.update(limit=self.get_query_argument('limit', ''), cursor=cursor)
+            next_url = f'{self.settings["deploy_path"]}/tasks?{up.urlencode({k: v for k, v in query.items() if v})}'
+        self.render('tasks/show_tasks.html', tasks=tasks, filters=filters, next_url=next_url,
+                    messages=list(messages))
+
 
 class VideoReformatBaseHandler(VideoBaseHandler):
 
@@ -60,19 +206,48 @@ class VideoTaskBaseHandler(VideoBaseHandler):
     def prepare(self):
         super().prepare()
         self.task_id = self.path_args[0]
-        if self.task_id not in self.settings['tasks']:
+        self.task_data = self.settings['tasks'].get(self.task_id, {})
+        if not self.task_data:
             self._task_not_found()
-        self.task_data = self.settings['tasks'][self.task_id]
 
     def _task_not_found(self):
         self._exit_error(f'Task with ID {self.task_id} not found.', status=404)
 
+    def get_progress_log(self):
+        return ProgressLog(self.settings['tasks'], self.task_id, self.get_task_dir(self.task_id),
+                           hub=self.settings.get('event_hub'))
+
+    def get_output(self):
+        """
+        The output of the task in the requested 'format', the first output if
+        none is requested. Records the access, the retention evicts the least
+        recently downloaded tasks first.
+        """
+        if 'evicted' in self.task_data:
+            self._exit_error(f'The files of task {self.task_id} were removed.', status=410)
+        self.settings['tasks'].update(self.task_id, {'last_access': time.time()})
+        outputs = self.task_data.get('outputs') or [{'target_format': self.task_data.get('target_format'),
+                                                     'output_file': self.task_data.get('output_file')}]
+        target_format = self.get_query_argument('format', None)
+        if target_format is None:
+            return outputs[0]
+        for output in outputs:
+            if output['target_format'] == target_format:
+                return output
+        self._exit_error(f'No output in format {target_format}.', status=404)
+
 
 class VideoTaskUIBaseHandler(VideoTaskBaseHandler, VideoUIMixin):
 
     def _task_not_found(self):
         self.render('tasks/show_task.html', task_id=self.task_id, status=None)
 
+    def render_task(self, messages=()):
+        # task data written before tasks had several outputs has no outputs field, evicted is only set once the
+        # retention removed the task files, uploads kept the client's file name before source_file_name existed
+        self.render('tasks/show_task.html', **dict({'outputs': [], 'evicted': None, 'source_file_name': None},
+                                                   messages=list(messages), **self.task_data))
+
 
 from . import api
 from . import ui
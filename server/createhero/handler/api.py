@@ -1,92 +1,228 @@
 from . import VideoReformatBaseHandler, VideoTaskBaseHandler
+from ..journal import TaskJournal
+from ..multipart import HashingFileWriter, MultipartError, MultipartParser
+from ..scheduler import RunQueue
 from ..util import VideoReformatTask
 
 from bs4 import BeautifulSoup
-import json
+from tornado.ioloop import IOLoop
+from tornado.web import stream_request_body
 import math
 import os
 import shutil
 import re
+import time
+import urllib.parse as up
 import uuid
 
 
+@stream_request_body
 class VideoReformatHandler(VideoReformatBaseHandler):
     """
-    Creates a reformating request. Reads in the original video file from the
-    request data or downloads it from the provided URL. Then places the video
-    source file into the local filesystem, creates a task, queues the reformatting
-    for processing and responds with a task ID.
+    Creates a reformating request. The multipart body is parsed while it
+    arrives and the video source file is streamed straight into the task
+    directory, hashing it on the way. Then creates a task, queues the
+    reformatting for processing and responds with a task ID.
     """
 
+    UPLOAD_NAME = 'input'
+
     def _get_accept_content_type(self):
         # to include files, form must be of type multipart/form-data
         return 'multipart/form-data'
 
+    def prepare(self):
+        super().prepare()
+        self.upload = None
+        # a body that cannot be parsed is read to the end and dropped, post answers with the error
+        self.upload_error = None
+        if self.request.method != 'POST':
+            return
+        self.request.connection.set_max_body_size(self.settings['max_upload_size'])
+        try:
+            boundary = MultipartParser.boundary_from_content_type(self.request.headers.get('Content-Type', ''))
+        except MultipartError as e:
+            self._exit_error(str(e), status=400)
+        # create a task ID and the directory the upload is streamed to
+        self.task_id = str(uuid.uuid4())
+        os.mkdir(self.get_task_dir(self.task_id))
+        self.upload = MultipartParser(boundary, self._open_upload_file)
+
+    def _open_upload_file(self, name, filename):
+        if name != 'videofile' or 'videofile' in self.upload.files:
+            return None
+        # the task directory also holds the state of the task, so the video is stored under a fixed name,
+        # only its extension is taken from the client, the outputs get the same one
+        extension = os.path.splitext(filename or '')[1].lower()
+        if not re.fullmatch(r'\.[a-z0-9]{1,8}', extension):
+            extension = '.mp4'
+        return HashingFileWriter(os.path.join(self.get_task_dir(self.task_id), self.UPLOAD_NAME + extension))
+
+    def data_received(self, chunk):
+        if self.upload_error is not None:
+            return
+        try:
+            self.upload.feed(chunk)
+        except MultipartError as e:
+            self.upload_error = str(e)
+            self._discard_upload()
+
+    def on_connection_close(self):
+        super().on_connection_close()
+        if getattr(self, 'upload', None) is not None and not self.upload.finished:
+            self._discard_upload()
+
+    def _discard_upload(self):
+        self.upload.abort()
+        task_dir = self.get_task_dir(self.task_id)
+        if os.path.isdir(task_dir):
+            shutil.rmtree(task_dir)
+
     def _validate_request(self):
         # super()._validate_request()
         self.args = {}
+        if self.upload_error is not None:
+            self._exit_error(self.upload_error, status=400)
+        try:
+            self.upload.close()
+        except MultipartError as e:
+            self._exit_error(str(e), status=400)
+        # make the parsed form fields available to get_argument
+        for name, values in self.upload.fields.items():
+            self.request.body_arguments.setdefault(name, []).extend(values)
+            self.request.arguments.setdefault(name, []).extend(values)
         self.target_quality = self.get_argument('target_quality', 'high')
         self.action = self.get_argument('action', 'resize')
         self.target_size = self.get_argument('target_size', 'adjusted')
-        self.target_format = self.get_argument('target_format', None)
+        # several target formats are given as repeated or comma separated values
+        self.target_formats = []
+        for value in self.get_arguments('target_format'):
+            for target_format in value.split(','):
+                target_format = target_format.strip()
+                if target_format and target_format not in self.target_formats:
+                    self.target_formats.append(target_format)
+        self.target_format = self.target_formats[0] if self.target_formats else None
         if 'flip' in self.action and not self.target_format:
             self._exit_error('No target format specified.', status=400)
         self.task_name = self.get_argument('taskname', '')
-        if 'videofile' not in self.request.files:
+        # scheduling class, and the client whose tasks share the workers fairly with other clients
+        self.priority = self.get_argument('priority', 'normal')
+        if self.priority not in RunQueue.PRIORITIES:
+            self._exit_error(f'Unknown priority {self.priority}, use one of {", ".join(RunQueue.PRIORITIES)}.',
+                             status=400)
+        self.client = self.get_argument('client', '') or self.request.remote_ip
+        if 'videofile' not in self.upload.files:
             self._exit_error('No video file provided.', status=400)
-        if not self.request.files['videofile']:
+        if not self.upload.files['videofile'][0]['writer'].size:
             self._exit_error('Video file not complete.', status=400)
 
-    def _post_task(self):
-        """ Creates a new task directory and places the submitted video there. """
-        self._validate_request()
-        # receive video file and put into filesystem
-        # extract file and filename
-        file_obj = self.request.files['videofile'][0]
-        self.input_filename = file_obj['filename']
-
-        # create a task ID, create the directory and place the file there
-        task_id = str(uuid.uuid4())
-        task_dir = self.get_task_dir(task_id)
-        os.mkdir(task_dir)
+    async def _post_task(self):
+        """ Creates the task for the video streamed into the task directory. """
+        try:
+            self._validate_request()
+        except Exception:
+            self._discard_upload()
+            raise
+        task_id = self.task_id
+        file_obj = self.upload.files['videofile'][0]
+        self.input_filename = os.path.basename(file_obj['writer'].path)
 
-        with open(os.path.join(task_dir, self.input_filename), 'wb') as input_file:
-            input_file.write(file_obj['body'])
         if not self.task_name:
             self.task_name = 'task_' + task_id
+        created = time.time()
         # save task_data
         task_data = {
             'task_name': self.task_name,
             'input_file_name': self.input_filename,
+            # the name of the video on the client, shown in the UI
+            'source_file_name': file_obj['filename'],
+            'input_file_size': file_obj['writer'].size,
+            'input_hash': file_obj['writer'].hexdigest,
             'task_id': task_id,
+            'created': created,
+            # the body was streamed in before the handler method is called
+            'timings': [{'stage': 'upload', 'start': created - self.request.request_time(), 'end': created}],
             'action': self.action,
             'target_quality': self.target_quality,
             'target_size': self.target_size,
+            'priority': self.priority,
+            'client': self.client,
             'status': VideoReformatTask.STATUS_SUBMITTED
         }
         if 'flip' in self.action:
             task_data['target_format'] = self.target_format
-
-        self.settings['tasks'][task_id] = task_data
-        with open(os.path.join(task_dir, 'task_data'), 'w') as f:
-            json.dump(task_data, f)
-
-        # put task on queue
-        self.settings['task_queue'].put(task_id)
+            if len(self.target_formats) > 1:
+                task_data['target_formats'] = self.target_formats
+
+        # the store, the cache and the storage wait for locks and copy files, not on the IOLoop
+        cached_outputs = await IOLoop.current().run_in_executor(None, self._store_task, task_data,
+                                                                file_obj['writer'].path)
+
+        if cached_outputs is not None:
+            task = VideoReformatTask(task_id, self.settings['working_directory'], self.settings['tasks'],
+                                     self.settings.get('event_hub'))
+            task.use_cached_result(cached_outputs)
+        else:
+            # put task on queue
+            await self._enqueue_task(task_id)
         # return with task id
         return {
             'task_id': task_id,
             'task_name': self.task_name,
-            'status': VideoReformatTask.STATUS_SUBMITTED
+            'status': self.settings['tasks'].get_field(task_id, 'status')
         }
 
-    def get(self):
-        """ Get a list of available tasks. """
-        self._exit_success(list(self.settings['tasks'].keys()))
+    def _store_task(self, task_data, input_path):
+        """
+        Saves the new task and its input, returns the cached results of an
+        identical task, one per format, or None if there are none.
+        """
+        task_id = task_data['task_id']
+        cache = self.settings.get('result_cache')
+        cached_outputs = None
+        if cache is not None:
+            # keep the input once per content, and look for the results of identical tasks, one per format
+            cache.store_input(task_data['input_hash'], input_path)
+            graph_file = VideoReformatTask.graph_file_for(task_data)
+            task_data['result_keys'] = [cache.result_key(task_data['input_hash'], graph_file,
+                                                         dict(task_data, target_format=target_format))
+                                        for target_format in (self.target_formats or [None])]
+            cached_outputs = [cache.get_result(key) if key else None for key in task_data['result_keys']]
+            if None in cached_outputs:
+                cached_outputs = None
+
+        self.settings['tasks'][task_id] = task_data
+        TaskJournal(self.get_task_dir(task_id)).update(task_data)
 
-    def post(self):
+        if self.settings.get('storage') is not None:
+            # worker nodes fetch the input from the storage
+            self.settings['storage'].put(task_id, task_data['input_file_name'], input_path)
+        return cached_outputs
+
+    def get(self):
+        """
+        Lists the tasks a page at a time, filtered and sorted as described in
+        _list_tasks. Returns the summary of each task, or the comma separated
+        'fields', and the cursor of the next page, null on the last one.
+        """
+        fields = ['task_id', 'task_name', 'status', 'action', 'created']
+        if self.get_query_argument('fields', None):
+            fields = ['task_id'] + [field.strip() for field in self.get_query_argument('fields').split(',')
+                                    if field.strip()]
+        tasks, cursor = self._list_tasks(fields)
+        self._exit_success({'tasks': tasks, 'next_cursor': cursor})
+
+    async def post(self):
         """ Creates a new task directory and places the submitted video there. """
-        self._exit_success(self._post_task(), status=201)
+        metrics = self.settings.get('metrics')
+        if metrics is not None:
+            # the body was streamed in before post is called
+            metrics.observe('createhero_stage_seconds', self.request.request_time(), stage='upload')
+        result = await self._post_task()
+        if metrics is not None:
+            metrics.inc('createhero_bytes_total', self.upload.files['videofile'][0]['writer'].size,
+                        direction='upload')
+        self._exit_success(result, status=201)
 
 
 class VideoReformatResultHandler(VideoTaskBaseHandler):
@@ -96,7 +232,7 @@ class VideoReformatResultHandler(VideoTaskBaseHandler):
     may be downloaded by adding a key only parameter 'download' to the call.
     """
 
-    def get(self, task_id):
+    async def get(self, task_id):
         """ Gets result information """
         # 1) find task in task list
         # 2) extract task status
@@ -104,17 +240,30 @@ class VideoReformatResultHandler(VideoTaskBaseHandler):
         # 3) report either status or results if available (via download URL)
         if self.get_query_argument('download', None) is None:
             task_status = {'status': status, 'task_name': self.task_data['task_name']}
-            if status == VideoReformatTask.STATUS_SUCCESS:
+            if 'progress_stats' in self.task_data:
+                task_status['progress'] = self.task_data['progress_stats']
+            if 'timings' in self.task_data:
+                task_status['timings'] = self.task_data['timings']
+            if status in (VideoReformatTask.STATUS_SUBMITTED, VideoReformatTask.STATUS_INIT):
+                # waiting to be claimed or for a slot, running tasks are not scheduled anymore
+                schedule = self.settings['run_queue'].schedule(self.settings['executor_status'].get('size', 1))
+                if task_id in schedule:
+                    task_status['queue'] = schedule[task_id]
+            if 'evicted' in self.task_data:
+                task_status['evicted'] = self.task_data['evicted']
+            elif status == VideoReformatTask.STATUS_SUCCESS:
                 dl_path = self.settings['deploy_path'] + '/tasks/' + task_id + '?download'
                 task_status.update({'download_url': dl_path})
+                if len(self.task_data.get('outputs', [])) > 1:
+                    task_status['download_urls'] = {
+                        output['target_format']: dl_path + '&format=' + up.quote(output['target_format'])
+                        for output in self.task_data['outputs']}
             self._exit_success(task_status)
 
         # 4) OR if get parameter download is set, respond with video file
         # (in case of success)
         if status == VideoReformatTask.STATUS_SUCCESS:
-            self._send_file(self.task_data['output_file'], 'rb')
-            self.set_status(200)
-            self.finish()
+            await self._stream_file(self.get_output()['output_file'], 'video/mp4')
             return
         self.set_status(204)
         self.finish()
@@ -131,8 +280,12 @@ class VideoReformatResultHandler(VideoTaskBaseHandler):
         self.finish()
 
     def delete_task_dir(self, task_id):
+        """ Removes the task directory, the task record and the queue entry of the task. """
         if task_id not in self.settings['tasks']:
             return False, f'Task ID "{task_id}" unknown.'
+        # an executor working on the task finds it gone and drops it
+        del self.settings['tasks'][task_id]
+        self.settings['run_queue'].finish(task_id, completed=False)
         task_dir = self.get_task_dir(task_id)
         if not os.path.isdir(task_dir):
             return True, f'No data for task "{task_id}"'
@@ -140,6 +293,111 @@ class VideoReformatResultHandler(VideoTaskBaseHandler):
         return True, ''
 
 
+class VideoReformatTraceHandler(VideoTaskBaseHandler):
+    """
+    Exports the stage timings of a task as Chrome trace, to be opened in
+    chrome://tracing or Perfetto. The stages are drawn on the task lane, the
+    queue wait and the audio extraction, which overlaps with autoflip, on
+    lanes of their own and the segment chunks, which run in parallel, on one
+    lane per segment.
+    """
+    LANES = {'queue': (1, 'queue'), 'extract': (2, 'audio')}
+
+    def get(self, task_id):
+        timings = self.task_data.get('timings', [])
+        if not timings:
+            self._exit_error(f'No timings recorded for task {task_id}.', status=404)
+        origin = min(timing['start'] for timing in timings)
+        lanes = {0: 'task'}
+        events = []
+        for timing in timings:
+            details = {name: value for name, value in timing.items() if name not in ('stage', 'start', 'end')}
+            lane, lane_name = self.LANES.get(timing['stage'], (0, 'task'))
+            if 'segment' in details:
+                lane, lane_name = 3 + details['segment'], f'segment {details["segment"]}'
+            lanes[lane] = lane_name
+            events.append({'name': timing['stage'], 'cat': 'stage', 'ph': 'X', 'pid': 1, 'tid': lane,
+                           'ts': round((timing['start'] - origin) * 1e6),
+                           'dur': round((timing['end'] - timing['start']) * 1e6), 'args': details})
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': self.task_data['task_name']}})
+        events += [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': lane, 'args': {'name': name}}
+                   for lane, name in sorted(lanes.items())]
+        self._exit_success({'traceEvents': events, 'displayTimeUnit': 'ms',
+                            'otherData': {'task_id': task_id, 'started': origin}})
+
+
+class VideoReformatProgressHandler(VideoTaskBaseHandler):
+    """
+    Returns the progress log lines of a task following the sequence number
+    given as 'after' cursor, together with the cursor to use for the next call.
+    """
+
+    def get(self, task_id):
+        try:
+            after = int(self.get_query_argument('after', 0))
+            limit = min(int(self.get_query_argument('limit', 500)), 5000)
+        except ValueError:
+            self._exit_error('Parameters after and limit must be integers.', status=400)
+        entries, cursor, reset = self.get_progress_log().read(after, limit)
+        self._exit_success({
+            'status': self.task_data['status'],
+            'cursor': cursor,
+            'reset': reset,
+            'lines': [{'seq': seq, 'line': line} for seq, line in entries]
+        })
+
+
+class WorkerPoolHandler(VideoReformatBaseHandler):
+    """ Reports the size of the worker pool and which slots are busy with which task. """
+
+    def get(self):
+        status = dict(self.settings['executor_status'])
+        if not status:
+            self._exit_error('Task executor not running.', status=503)
+        self._exit_success(status)
+
+
+class StorageHandler(VideoReformatBaseHandler):
+    """ Reports the disk usage of the task artifacts and how much a retention collection would reclaim. """
+
+    async def get(self):
+        retention = self.settings.get('retention')
+        if retention is None:
+            self._exit_error('Retention not configured.', status=503)
+        self._exit_success(await IOLoop.current().run_in_executor(None, retention.report))
+
+
+class MetricsHandler(VideoReformatBaseHandler):
+    """
+    Exposes the metrics of all server processes in the Prometheus text
+    format, the counters and histograms added up across processes and the
+    gauges read from the run queue, the task index and the worker pool.
+    """
+
+    def _get_response_content_type(self):
+        return 'text/plain; version=0.0.4'
+
+    def _gauges(self):
+        gauges = {'createhero_tasks': [({'status': status}, count)
+                                       for status, count in self.settings['tasks'].count_by_status().items()]}
+        depth, oldest = self.settings['run_queue'].depth()
+        gauges['createhero_queue_depth'] = [({}, depth)]
+        gauges['createhero_queue_oldest_seconds'] = [({}, round(time.time() - oldest, 1) if oldest else 0)]
+        status = dict(self.settings['executor_status'])
+        if status:
+            gauges['createhero_worker_slots'] = [({'state': 'busy'}, status['busy']),
+                                                 ({'state': 'free'}, status['free'])]
+        return gauges
+
+    async def get(self):
+        metrics = self.settings.get('metrics')
+        if metrics is None:
+            self._exit_error('Metrics not configured.', status=503)
+        text = await IOLoop.current().run_in_executor(None, lambda: metrics.render(self._gauges()))
+        self.set_header('Content-Type', self._get_response_content_type())
+        self.finish(text)
+
+
 class VideoCaptionHandler(VideoTaskBaseHandler):
     """
     Responds with captions for the given task and language.
@@ -163,13 +421,10 @@ class VideoCaptionHandler(VideoTaskBaseHandler):
         # to include files, form must be of type multipart/form-data
         return 'multipart/form-data'
 
-    def get(self, task_id):
+    async def get(self, task_id):
         self._validate_get()
         captions_file = self.task_data['captions'][self.language]['file_path']
-        self.set_header('Content-Type', 'text/vtt')
-        self._send_file(captions_file)
-        self.set_status(200)
-        self.finish()
+        await self._stream_file(captions_file, 'text/vtt')
 
     def post(self, task_id):
         """ This receives the Final Cut XML file, extracts the captions and creates a WebVTT file from them."""
@@ -215,11 +470,9 @@ class VideoCaptionHandler(VideoTaskBaseHandler):
             'captions_label': self.lang_dict[self.args['language']],
             'captions_source': f'api/tasks/{self.task_id}/captions?language={self.args["language"]}'
         }
-        # update managed dict
-        self.settings['tasks'][self.task_id] = self.task_data
-        task_dir = os.path.join(self.settings['working_directory'], self.task_id)
-        with open(os.path.join(task_dir, 'task_data'), 'w') as f:
-            json.dump(self.task_data, f)
+        # update the task store
+        self.settings['tasks'].update(self.task_id, {'captions': self.task_data['captions']})
+        TaskJournal(self.get_task_dir(self.task_id)).update({'captions': self.task_data['captions']})
 
         with open(self.task_data['captions'][self.args['language']]['file_path'], 'w') as vtt_file:
             vtt_file.write(f'WEBVTT Kind: captions; Language: {self.args["language"]}\n\n')
@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import queue
+import shutil
+import tempfile
+
+from tornado.testing import AsyncHTTPTestCase
+
+from createhero.app import CreateHeroAPI
+from createhero.scheduler import RunQueue
+from createhero.store import TaskStore
+
+BOUNDARY = 'boundary7MA4YWxk'
+
+
+def _body(parts):
+    """ A multipart body of (name, filename or None, content) parts. """
+    body = b''
+    for name, filename, content in parts:
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        body += f'--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n\r\n'.encode() + content + b'\r\n'
+    return body + f'--{BOUNDARY}--\r\n'.encode()
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class StubEventHub(object):
+
+    def __init__(self):
+        self.events = []
+
+    def publish(self, task_id, event):
+        self.events.append((task_id, event))
+
+
+class HandlerTestCase(AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tasks = TaskStore(os.path.join(self.directory, 'tasks.db'))
+        self.run_queue = RunQueue(os.path.join(self.directory, 'tasks.db'))
+        self.task_queue = queue.Queue()
+        # uncaught exceptions of handlers are logged here
+        self.errors = RecordingHandler()
+        logging.getLogger('tornado.application').addHandler(self.errors)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        logging.getLogger('tornado.application').removeHandler(self.errors)
+        shutil.rmtree(self.directory)
+
+    def get_app(self):
+        root_dir = os.path.join(os.path.dirname(__file__), '..', '..')
+        return CreateHeroAPI({
+            'deploy_path': '',
+            'working_directory': self.directory,
+            'tasks': self.tasks,
+            'task_queue': self.task_queue,
+            'run_queue': self.run_queue,
+            'event_hub': StubEventHub(),
+            'executor_status': {},
+            'max_upload_size': 2 ** 20,
+            'template_path': os.path.join(root_dir, 'templates'),
+            'static_path': os.path.join(root_dir, 'static')
+        })
+
+    def task_dirs(self):
+        return [entry.name for entry in os.scandir(self.directory) if entry.is_dir()]
+
+
+class VideoReformatHandlerTest(HandlerTestCase):
+
+    def post(self, body):
+        return self.fetch('/api/tasks', method='POST', body=body,
+                          headers={'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'})
+
+    def test_post(self):
+        response = self.post(_body([('taskname', None, b'clip'), ('videofile', 'Clip.MOV', b'video')]))
+        self.assertEqual(response.code, 201)
+        task_id = json.loads(response.body)['task_id']
+        self.assertEqual(self.task_dirs(), [task_id])
+        self.assertEqual(self.tasks.get_field(task_id, 'input_file_name'), 'input.mov')
+        self.assertEqual(self.tasks.get_field(task_id, 'source_file_name'), 'Clip.MOV')
+        self.assertEqual(self.task_queue.get_nowait(), task_id)
+        self.assertEqual(self.run_queue.queued(), {task_id})
+
+    def test_malformed_body(self):
+        body = _body([('videofile', 'clip.mp4', b'video' * 100)])
+        # the delimiter after the file part does not end in a line break
+        response = self.post(body.replace(f'--{BOUNDARY}--'.encode(), f'--{BOUNDARY}xx'.encode()))
+        self.assertEqual(response.code, 400)
+        self.assertIn('Malformed multipart delimiter', json.loads(response.body)['error'])
+        self.assertEqual(self.task_dirs(), [])
+        self.assertEqual(len(self.tasks), 0)
+        self.assertEqual(self.errors.records, [])
+
+    def test_incomplete_body(self):
+        body = _body([('videofile', 'clip.mp4', b'video')])
+        response = self.post(body[:-20])
+        self.assertEqual(response.code, 400)
+        self.assertEqual(self.task_dirs(), [])
+
+    def test_no_boundary(self):
+        response = self.fetch('/api/tasks', method='POST', body=b'x',
+                              headers={'Content-Type': 'multipart/form-data'})
+        self.assertEqual(response.code, 400)
+        self.assertEqual(self.task_dirs(), [])
+
+
+class VideoReformatResultHandlerTest(HandlerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        output_file = os.path.join(self.directory, 't1', 'output.mp4')
+        os.makedirs(os.path.dirname(output_file))
+        with open(output_file, 'wb') as f:
+            f.write(b'0123456789')
+        self.tasks['t1'] = {'task_id': 't1', 'task_name': 'clip', 'status': 'success', 'output_file': output_file}
+
+    def download(self, byte_range):
+        return self.fetch('/api/tasks/t1?download', headers={'Range': byte_range})
+
+    def test_range(self):
+        response = self.download('bytes=2-4')
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, b'234')
+        self.assertEqual(response.headers['Content-Range'], 'bytes 2-4/10')
+
+    def test_suffix_range(self):
+        response = self.download('bytes=-3')
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, b'789')
+
+    def test_range_beyond_end_is_cut(self):
+        response = self.download('bytes=8-20')
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, b'89')
+
+    def test_invalid_range_is_ignored(self):
+        for byte_range in ('bytes=5-2', 'bytes=a-b', 'items=0-1'):
+            with self.subTest(byte_range=byte_range):
+                response = self.download(byte_range)
+                self.assertEqual(response.code, 200)
+                self.assertEqual(response.body, b'0123456789')
+
+    def test_unsatisfiable_range(self):
+        for byte_range in ('bytes=10-', 'bytes=20-30'):
+            with self.subTest(byte_range=byte_range):
+                response = self.download(byte_range)
+                self.assertEqual(response.code, 416)
+                self.assertEqual(response.headers['Content-Range'], 'bytes */10')
@@ -1,12 +1,16 @@
+import html
 import json
 
 from . import VideoReformatUIBaseHandler, VideoTaskUIBaseHandler, VideoUIMixin
 from .api import VideoReformatHandler, VideoCaptionHandler, VideoReformatResultHandler
+from ..journal import TaskJournal
+from ..progress import ProgressLog
 from ..util import VideoReformatTask
 
 import logging
 import os
-from tornado.websocket import WebSocketHandler
+from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketClosedError, WebSocketHandler
 import urllib.parse as up
 
 
@@ -17,37 +21,34 @@ class VideoReformatPostTaskUIHandler(VideoReformatHandler, VideoUIMixin):
         """ Render the input form. """
         self.render('post/post_task.html')
 
-    def post(self):
+    async def post(self):
         # validate the request and generate a uuid task_id, using the API method
-        task = self._post_task()
+        task = await self._post_task()
         self.redirect(f'{self.settings["deploy_path"]}/tasks/{task["task_id"]}')
 
 
 class VideoReformatTasksUIHandler(VideoReformatUIBaseHandler):
 
     def get(self):
-        self.render('tasks/show_tasks.html', tasks=list(self.settings['tasks'].values()))
+        self.render_tasks()
 
 
 class VideoReformatTaskUIHandler(VideoTaskUIBaseHandler):
 
-    def get(self, task_id):
+    async def get(self, task_id):
         if self.get_query_argument('download', None) is not None \
                 and self.task_data['status'] == VideoReformatTask.STATUS_SUCCESS:
-            self.set_header('Content-Type', 'video/mp4')
-            self.set_header('Content-Disposition',
-                            f'attachment; filename={os.path.basename(self.task_data["output_file"])}')
-            self._send_file(self.task_data['output_file'], 'rb')
-            self.finish()
+            output_file = self.get_output()['output_file']
+            self.set_header('Content-Disposition', f'attachment; filename={os.path.basename(output_file)}')
+            await self._stream_file(output_file, 'video/mp4')
         else:
-            self.render('tasks/show_task.html', **self.task_data)
+            self.render_task()
 
 
 class VideoReformatTaskDeleteHandler(VideoReformatResultHandler, VideoUIMixin):
 
     def get(self, task_id):
         success, msg = self.delete_task_dir(task_id)
-        del self.settings['tasks'][task_id]
         messages = []
         if not success:
             messages.append({'type': 'danger', 'message': msg})
@@ -55,24 +56,49 @@ class VideoReformatTaskDeleteHandler(VideoReformatResultHandler, VideoUIMixin):
             messages.append({'type': 'warning', 'message': msg})
         else:
             messages.append({'type': 'success', 'message': f'Deleted data for task ID {task_id}'})
-        self.render('tasks/show_tasks.html', tasks=list(self.settings['tasks'].values()), messages=messages)
+        self.render_tasks(messages)
 
 
 class VideoReformatTaskRestartHandler(VideoTaskUIBaseHandler):
+    RESTARTABLE = (VideoReformatTask.STATUS_STOPPED, VideoReformatTask.STATUS_SUCCESS)
 
-    def get(self, task_id):
-        self.task_data['progress'] = []
-        self.task_data['status'] = VideoReformatTask.STATUS_SUBMITTED
-        self.settings['tasks'][task_id] = self.task_data
-        self.settings['task_queue'].put(task_id)
-        self.render('tasks/show_task.html', **self.task_data)
+    async def get(self, task_id):
+        if 'evicted' in self.task_data:
+            self.render_task([{'type': 'danger', 'message': 'The input of this task was removed, '
+                                                            'it cannot be restarted.'}])
+            return
+        if self.task_data['status'] not in self.RESTARTABLE:
+            # a task still queued or running would run twice
+            self.set_status(409)
+            self.render_task([{'type': 'danger', 'message': f'The task is {self.task_data["status"]}, only stopped '
+                                                            f'or finished tasks can be restarted.'}])
+            return
+        # a prepared task resumes from the checkpoints of the stopped run
+        self.task_data['status'] = VideoReformatTask.STATUS_INIT if 'probe' in self.task_data \
+            else VideoReformatTask.STATUS_SUBMITTED
+        self.task_data['progress_start'] = self.get_progress_log().reset()
+        self.task_data['timings'] = VideoReformatTask.kept_timings(self.task_data)
+        changed = {field: self.task_data[field] for field in ('status', 'progress_start', 'timings')}
+        self.settings['tasks'].update(task_id, changed)
+        # replayed after a crash, the task must not fall back to its previous status
+        TaskJournal(self.get_task_dir(task_id)).update(changed)
+        self.settings['event_hub'].publish(task_id, {'type': 'status', 'status': self.task_data['status']})
+        await self._enqueue_task(task_id)
+        self.render_task()
 
 
 class VideoReformatTaskProgressSocket(WebSocketHandler):
     """
-    UI socket for monitoring a task, returns stdout messages and the download
-    link when ready.
+    UI socket for monitoring a task. After a 'subscribe' command carrying the
+    client's cursor, status changes, progress stats and new stdout lines are
+    pushed as they are published by the executor. Events arriving while a
+    message is still being written are coalesced into the next one, a client
+    that falls too far behind is caught up from the progress log instead.
+    The 'progress' command answers a single poll.
     """
+    PROGRESS_BATCH = 1000
+    MAX_PENDING = 5000
+    DONE = (VideoReformatTask.STATUS_STOPPED, VideoReformatTask.STATUS_SUCCESS)
 
     def check_origin(self, origin):
         parsed_origin = up.urlparse(origin)
@@ -83,25 +109,112 @@ class VideoReformatTaskProgressSocket(WebSocketHandler):
         if task_id not in self.settings['tasks']:
             self.close(404, reason=f'No task with ID {task_id} found.')
         self.task_id = task_id
+        self.progress = ProgressLog(self.settings['tasks'], task_id,
+                                    os.path.join(self.settings['working_directory'], task_id))
         self.log = logging.getLogger("WebSocketHandler")
+        self.subscribed = False
+        self.cursor = 0
+        self.status = None
+        self.stats = None
+        self._pending = []
+        self._catch_up = False
+        self._changed = False
+        self._sending = False
 
     def on_message(self, message):
-        task = self.settings['tasks'][self.task_id]
         try:
             mo = json.loads(message)
         except json.decoder.JSONDecodeError as e:
             self.log.error(f'Could not parse message {message}')
             return
+        if 'subscribe' in mo['command']:
+            self._subscribe(int(mo.get('cursor', 0)))
+            return
+        task = self.settings['tasks'].get_fields(self.task_id, ('status', 'progress_stats'))
         answer = {}
+        backlog = False
         if 'progress' in mo['command']:
-            answer['data'] = ''.join(list(map(lambda _in: _in.strip() + '<br/>', task['progress'])))
-        if task['status'] == VideoReformatTask.STATUS_STOPPED or task['status'] == VideoReformatTask.STATUS_SUCCESS:
+            # only send the lines the client has not seen yet
+            entries, answer['cursor'], answer['reset'] = self.progress.read(int(mo.get('cursor', 0)),
+                                                                            self.PROGRESS_BATCH)
+            answer['data'] = self._render(entries)
+            backlog = len(entries) == self.PROGRESS_BATCH
+        answer['stats'] = task.get('progress_stats')
+        if not backlog and task['status'] in self.DONE:
             answer['type'] = 'complete'
         else:
             answer['type'] = 'progress'
         self.write_message(json.dumps(answer))
-        
+
+    def _render(self, entries):
+        return ''.join(html.escape(line) + '<br/>' for _, line in entries)
+
+    def _subscribe(self, cursor):
+        if not self.subscribed:
+            # subscribe before reading the backlog, so no event gets lost in between
+            self.settings['event_hub'].subscribe(self.task_id, self.on_event)
+            self.subscribed = True
+        self.cursor = cursor
+        task = self.settings['tasks'].get_fields(self.task_id, ('status', 'progress_stats'))
+        self.status = task.get('status')
+        self.stats = task.get('progress_stats')
+        self._catch_up = True
+        self._flush_soon()
+
+    def on_event(self, event):
+        if event['type'] == 'status':
+            self.status = event['status']
+            self._changed = True
+        elif event['type'] == 'stats':
+            self.stats = event['stats']
+            self._changed = True
+        elif event['type'] == 'reset' or event.get('gap') or self._catch_up \
+                or len(self._pending) >= self.MAX_PENDING:
+            # read from the log instead of buffering the events
+            self._pending = []
+            self._catch_up = True
+        else:
+            self._pending.extend(event['entries'])
+        self._flush_soon()
+
+    def _flush_soon(self):
+        if not self._sending:
+            self._sending = True
+            IOLoop.current().spawn_callback(self._flush)
+
+    async def _flush(self):
+        try:
+            while self._catch_up or self._pending or self._changed:
+                answer = {'reset': False}
+                self._changed = False
+                if self._catch_up:
+                    self._pending = []
+                    entries, self.cursor, answer['reset'] = self.progress.read(self.cursor, self.PROGRESS_BATCH)
+                    self._catch_up = len(entries) == self.PROGRESS_BATCH
+                else:
+                    entries = [entry for entry in self._pending if entry[0] > self.cursor]
+                    self._pending = []
+                    if entries and entries[0][0] != self.cursor + 1:
+                        # lost some events on the way
+                        self._catch_up = True
+                        continue
+                    if entries:
+                        self.cursor = entries[-1][0]
+                answer['cursor'] = self.cursor
+                answer['data'] = self._render(entries)
+                answer['stats'] = self.stats
+                done = self.status in self.DONE and not self._catch_up
+                answer['type'] = 'complete' if done else 'progress'
+                # further events are coalesced while this message is written
+                await self.write_message(json.dumps(answer))
+        except WebSocketClosedError:
+            pass
+        finally:
+            self._sending = False
+
     def on_close(self) -> None:
+        if getattr(self, 'subscribed', False):
+            self.settings['event_hub'].unsubscribe(self.task_id, self.on_event)
         self.log.info("websocket has been closed")
 
 
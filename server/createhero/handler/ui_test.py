@@ -0,0 +1,46 @@
+import os
+
+from createhero.handler.api_test import HandlerTestCase
+from createhero.journal import TaskJournal
+from createhero.util import VideoReformatTask
+
+
+class VideoReformatTaskRestartHandlerTest(HandlerTestCase):
+
+    def _add_task(self, status, task_id='t1', **fields):
+        task_dir = os.path.join(self.directory, task_id)
+        os.makedirs(task_dir)
+        task_data = dict({'task_id': task_id, 'task_name': 'clip', 'action': 'resize', 'status': status,
+                          'input_file_name': 'input.mp4', 'input_file_size': 5, 'target_quality': 'high',
+                          'target_size': 'original', 'created': 1.0,
+                          'timings': [{'stage': 'upload', 'start': 0.0, 'end': 1.0},
+                                      {'stage': 'autoflip', 'start': 2.0, 'end': 3.0}]}, **fields)
+        self.tasks[task_id] = task_data
+        TaskJournal(task_dir).update(task_data)
+
+    def test_restart_stopped_task(self):
+        self._add_task(VideoReformatTask.STATUS_STOPPED, probe={'duration': 10})
+        response = self.fetch('/tasks/t1/restart')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.tasks.get_field('t1', 'status'), VideoReformatTask.STATUS_INIT)
+        self.assertEqual(self.task_queue.get_nowait(), 't1')
+        self.assertEqual(self.run_queue.queued(), {'t1'})
+        journaled = TaskJournal(os.path.join(self.directory, 't1')).load()
+        self.assertEqual(journaled['status'], VideoReformatTask.STATUS_INIT)
+        self.assertEqual([timing['stage'] for timing in journaled['timings']], ['upload'])
+        self.assertEqual(journaled['progress_start'], self.tasks.get_field('t1', 'progress_start'))
+
+    def test_restart_unprepared_task(self):
+        self._add_task(VideoReformatTask.STATUS_STOPPED)
+        self.assertEqual(self.fetch('/tasks/t1/restart').code, 200)
+        self.assertEqual(self.tasks.get_field('t1', 'status'), VideoReformatTask.STATUS_SUBMITTED)
+
+    def test_restart_unfinished_task(self):
+        for status in (VideoReformatTask.STATUS_SUBMITTED, VideoReformatTask.STATUS_INIT,
+                       VideoReformatTask.STATUS_RUNNING):
+            with self.subTest(status=status):
+                self._add_task(status, task_id=status, probe={'duration': 10})
+                self.assertEqual(self.fetch(f'/tasks/{status}/restart').code, 409)
+                self.assertEqual(self.tasks.get_field(status, 'status'), status)
+                self.assertEqual(TaskJournal(os.path.join(self.directory, status)).load()['status'], status)
+                self.assertTrue(self.task_queue.empty())
@@ -0,0 +1,151 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+
+SYNC_INTERVAL = 1.0
+
+# journals appended to since the last sync, by path
+_unsynced = {}
+_sync_scheduled = False
+
+
+def _sync():
+    """ Flushes all journals written since the last call to disk. """
+    global _sync_scheduled
+    _sync_scheduled = False
+    for path, fd in list(_unsynced.items()):
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            logging.getLogger('TaskJournal').warning(f'could not sync {path}: {e}')
+        finally:
+            os.close(fd)
+    _unsynced.clear()
+
+
+def _schedule_sync():
+    global _sync_scheduled
+    if _sync_scheduled:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # no event loop to batch on, sync right away
+        _sync()
+        return
+    _sync_scheduled = True
+    loop.call_later(SYNC_INTERVAL, _sync)
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class TaskJournal(object):
+    """
+    Crash safe persistence of the task data in the task directory. Changes
+    are appended as JSON lines to task_data.journal, the appends of all
+    journals of a process are synced to disk together at most once per
+    SYNC_INTERVAL. Compaction folds the journal into the task_data snapshot,
+    which is replaced atomically, and truncates the journal.
+
+    Several processes may append to the same journal, each line is written
+    with a single write under an exclusive lock, which compaction holds too.
+    A line torn by a crash ends the replay.
+    """
+    COMPACT_SIZE = 256 * 1024
+
+    def __init__(self, task_dir):
+        self.snapshot_path = os.path.join(task_dir, 'task_data')
+        self.path = self.snapshot_path + '.journal'
+        self.log = logging.getLogger('TaskJournal')
+        self._state = None
+        self._torn = False
+
+    def exists(self):
+        return os.path.exists(self.snapshot_path) or os.path.exists(self.path)
+
+    def _read(self):
+        state = {}
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            self.log.error(f'corrupt snapshot {self.snapshot_path}, replaying the journal only')
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        self.log.warning(f'torn entry in {self.path}, ignoring the rest')
+                        self._torn = True
+                        break
+                    state.update(entry.get('set', {}))
+                    for field in entry.get('unset', ()):
+                        state.pop(field, None)
+        except FileNotFoundError:
+            pass
+        return state
+
+    def load(self):
+        """ The task data as of the snapshot and all journal entries. """
+        self._state = self._read()
+        if self._torn:
+            # later appends must not end up behind the torn line
+            self.compact()
+        return dict(self._state)
+
+    def update(self, fields, unset=()):
+        """ Appends setting the given fields and removing the unset ones. """
+        if not fields and not unset:
+            return
+        entry = {'set': fields}
+        if unset:
+            entry['unset'] = list(unset)
+        line = (json.dumps(entry) + '\n').encode()
+        fd = _unsynced.get(self.path)
+        if fd is None:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            _unsynced[self.path] = fd
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            os.write(fd, line)
+            size = os.fstat(fd).st_size
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        if self._state is not None:
+            self._state.update(fields)
+            for field in unset:
+                self._state.pop(field, None)
+        _schedule_sync()
+        if size > self.COMPACT_SIZE:
+            self.compact()
+
+    def compact(self):
+        """ Writes the current state as new snapshot and empties the journal. """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self._state = self._read()
+            self._torn = False
+            tmp = self.snapshot_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.snapshot_path)
+            _fsync_dir(os.path.dirname(self.snapshot_path))
+            # replaying entries already in the snapshot is harmless, so a crash before this is fine
+            os.ftruncate(fd, 0)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
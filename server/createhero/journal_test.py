@@ -0,0 +1,91 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from createhero import journal
+from createhero.journal import TaskJournal
+
+
+class TaskJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.task_dir = tempfile.mkdtemp()
+        self.journal = TaskJournal(self.task_dir)
+
+    def tearDown(self):
+        journal._sync()
+        shutil.rmtree(self.task_dir)
+
+    def _append_raw(self, data):
+        journal._sync()
+        with open(self.journal.path, 'ab') as f:
+            f.write(data)
+
+    def test_load_missing(self):
+        self.assertFalse(self.journal.exists())
+        self.assertEqual(self.journal.load(), {})
+
+    def test_load_replays_updates(self):
+        self.journal.update({'status': 'submitted', 'progress': 'x'})
+        self.journal.update({'status': 'running'}, unset=['progress'])
+        self.assertTrue(self.journal.exists())
+        self.assertEqual(TaskJournal(self.task_dir).load(), {'status': 'running'})
+
+    def test_update_without_changes_writes_nothing(self):
+        self.journal.update({})
+        self.assertFalse(self.journal.exists())
+
+    def test_load_applies_journal_over_snapshot(self):
+        with open(self.journal.snapshot_path, 'w') as f:
+            json.dump({'status': 'submitted', 'task_name': 'a'}, f)
+        self.journal.update({'status': 'running'})
+        self.assertEqual(TaskJournal(self.task_dir).load(), {'status': 'running', 'task_name': 'a'})
+
+    def test_load_corrupt_snapshot(self):
+        with open(self.journal.snapshot_path, 'w') as f:
+            f.write('{"status": ')
+        self.journal.update({'status': 'running'})
+        self.assertEqual(TaskJournal(self.task_dir).load(), {'status': 'running'})
+
+    def test_torn_line_ends_replay(self):
+        self.journal.update({'status': 'submitted'})
+        self._append_raw(b'{"set": {"status": "runn')
+        reader = TaskJournal(self.task_dir)
+        self.assertEqual(reader.load(), {'status': 'submitted'})
+        # the torn line is compacted away, later appends are replayed again
+        self.assertEqual(os.path.getsize(reader.path), 0)
+        reader.update({'status': 'success'})
+        self.assertEqual(TaskJournal(self.task_dir).load(), {'status': 'success'})
+
+    def test_compact(self):
+        self.journal.update({'status': 'submitted', 'progress': 'x'})
+        self.journal.update({'status': 'running'}, unset=['progress'])
+        self.journal.compact()
+        journal._sync()
+        self.assertEqual(os.path.getsize(self.journal.path), 0)
+        with open(self.journal.snapshot_path, 'r') as f:
+            self.assertEqual(json.load(f), {'status': 'running'})
+        self.assertFalse(os.path.exists(self.journal.snapshot_path + '.tmp'))
+        self.assertEqual(TaskJournal(self.task_dir).load(), {'status': 'running'})
+
+    def test_compact_picks_up_appends_of_other_writers(self):
+        self.journal.load()
+        TaskJournal(self.task_dir).update({'task_name': 'b'})
+        self.journal.update({'status': 'running'})
+        self.journal.compact()
+        self.assertEqual(TaskJournal(self.task_dir).load(), {'task_name': 'b', 'status': 'running'})
+
+    def test_compacts_when_journal_grows(self):
+        self.journal.COMPACT_SIZE = 1024
+        for i in range(100):
+            self.journal.update({'line': 'x' * 20, 'count': i})
+        journal._sync()
+        self.assertLess(os.path.getsize(self.journal.path), 1024)
+        self.assertTrue(os.path.exists(self.journal.snapshot_path))
+        self.assertEqual(TaskJournal(self.task_dir).load(), {'line': 'x' * 20, 'count': 99})
+
+
+if __name__ == '__main__':
+    unittest.main()
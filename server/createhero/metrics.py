@@ -0,0 +1,192 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+
+FLUSH_INTERVAL = 10.0
+
+# name: (type, help, histogram buckets in seconds)
+METRICS = {
+    'createhero_task_seconds': (
+        'histogram', 'Time from submission to the result of successful tasks.',
+        (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)),
+    'createhero_stage_seconds': (
+        'histogram', 'Duration of the processing stages of tasks.',
+        (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)),
+    'createhero_http_request_seconds': (
+        'histogram', 'Latency of the HTTP handlers per route.',
+        (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)),
+    'createhero_bytes_total': (
+        'counter', 'Bytes of video uploaded and downloaded.', None),
+    'createhero_subprocess_failures_total': (
+        'counter', 'Subprocesses and graph runs that failed or were killed after their timeout.', None),
+    'createhero_queue_depth': (
+        'gauge', 'Tasks waiting in the run queue.', None),
+    'createhero_queue_oldest_seconds': (
+        'gauge', 'Time the longest waiting task has been queued.', None),
+    'createhero_tasks': (
+        'gauge', 'Tasks per status.', None),
+    'createhero_worker_slots': (
+        'gauge', 'Worker slots of the executor on this node, busy and free.', None),
+}
+
+
+def _labels(labels):
+    """ The label set in exposition format, also the key it is kept under. """
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"' for name, value in sorted(labels.items()))
+
+
+def _sample(name, labels, value):
+    return f'{name}{{{labels}}} {value}' if labels else f'{name} {value}'
+
+
+class Metrics(object):
+    """
+    Counters and histograms of one server process, in Prometheus terms. Every
+    process keeps its own and writes them to <directory>/<host>-<pid>.json at
+    most once per FLUSH_INTERVAL, a scrape of any process adds up the files
+    of all processes, the forked HTTP workers as well as worker nodes sharing
+    the state directory. Gauges are not kept, they are read from the shared
+    state when scraped.
+
+    The files of exited processes are removed when a process of the same
+    host starts or scrapes, the totals only count the running processes. The
+    counters start over with a restart, which Prometheus takes for a reset.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.host = socket.gethostname()
+        self.path = os.path.join(directory, f'{self.host}-{os.getpid()}.json')
+        self.log = logging.getLogger('Metrics')
+        # the retention and the queue IPC run in threads
+        self._lock = threading.Lock()
+        self._flush_scheduled = False
+        self._values = {}
+        self._prune()
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _prune(self):
+        """ Removes the files of the processes of this host that exited, the PIDs of other hosts are unknown here. """
+        for entry in os.scandir(self.directory):
+            host, _, pid = entry.name.partition('.json')[0].rpartition('-')
+            if host != self.host or not pid.isdigit() or int(pid) == os.getpid() or self._alive(int(pid)):
+                continue
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def inc(self, name, value=1, **labels):
+        """ Adds to a counter. """
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + value
+        self._schedule_flush()
+
+    def observe(self, name, value, **labels):
+        """ Adds a sample to a histogram, kept as count per bucket, then sum and count. """
+        buckets = METRICS[name][2]
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            key = _labels(labels)
+            if key not in series:
+                series[key] = [0] * (len(buckets) + 3)
+            counts = series[key]
+            counts[next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))] += 1
+            counts[-2] += value
+            counts[-1] += 1
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_scheduled:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # not on the IOLoop, the next update or scrape there writes it
+            return
+        self._flush_scheduled = True
+        loop.call_later(FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        """ Writes the metrics of this process, replacing its file atomically. """
+        self._flush_scheduled = False
+        with self._lock:
+            data = json.dumps(self._values)
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            self.log.warning(f'could not write {self.path}: {e}')
+
+    def collect(self):
+        """ The counters and histograms of all running processes, added up. """
+        self.flush()
+        self._prune()
+        total = {}
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            for name, series in self._read(entry.path).items():
+                if name not in METRICS:
+                    continue
+                merged = total.setdefault(name, {})
+                for key, value in series.items():
+                    if isinstance(value, list):
+                        previous = merged.get(key, [0] * len(value))
+                        merged[key] = [a + b for a, b in zip(previous, value)]
+                    else:
+                        merged[key] = merged.get(key, 0) + value
+        return total
+
+    def render(self, gauges=None):
+        """
+        The metrics of all processes in the Prometheus text format, with the
+        given gauges, a list of (labels, value) per gauge name.
+        """
+        values = self.collect()
+        for name, samples in (gauges or {}).items():
+            values[name] = {_labels(labels): value for labels, value in samples}
+        lines = []
+        for name, (kind, description, buckets) in METRICS.items():
+            if name not in values:
+                continue
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+            for key, value in sorted(values[name].items()):
+                if kind != 'histogram':
+                    lines.append(_sample(name, key, value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], value):
+                    cumulative += count
+                    lines.append(_sample(f'{name}_bucket', ','.join(filter(None, [key, f'le="{bound}"'])),
+                                         cumulative))
+                lines.append(_sample(f'{name}_sum', key, round(value[-2], 6)))
+                lines.append(_sample(f'{name}_count', key, value[-1]))
+        return '\n'.join(lines) + '\n'
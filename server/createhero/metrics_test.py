@@ -0,0 +1,51 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from createhero.metrics import Metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _exited_pid(self):
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        return process.pid
+
+    def _write(self, name, values):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            json.dump(values, f)
+
+    def test_collect_adds_up_processes(self):
+        metrics = Metrics(self.directory)
+        metrics.inc('createhero_bytes_total', 10, direction='upload')
+        # a running process of this host and one of another host
+        self._write(f'{metrics.host}-{os.getppid()}.json', {'createhero_bytes_total': {'direction="upload"': 5}})
+        self._write('other-host-1.json', {'createhero_bytes_total': {'direction="upload"': 1}})
+        self.assertEqual(metrics.collect(), {'createhero_bytes_total': {'direction="upload"': 16}})
+
+    def test_files_of_exited_processes_are_removed(self):
+        metrics = Metrics(self.directory)
+        pid = self._exited_pid()
+        self._write(f'{metrics.host}-{pid}.json', {'createhero_bytes_total': {'direction="upload"': 5}})
+        self._write(f'{metrics.host}-{pid}.json.tmp', {})
+        metrics.inc('createhero_bytes_total', 10, direction='upload')
+        self.assertEqual(metrics.collect(), {'createhero_bytes_total': {'direction="upload"': 10}})
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(metrics.path)])
+
+    def test_starts_over_in_a_reused_pid(self):
+        metrics = Metrics(self.directory)
+        self._write(os.path.basename(metrics.path), {'createhero_bytes_total': {'direction="upload"': 5}})
+        self.assertEqual(Metrics(self.directory).collect(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
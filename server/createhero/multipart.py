@@ -0,0 +1,185 @@
+import hashlib
+import os
+
+
+class MultipartError(Exception):
+    pass
+
+
+class HashingFileWriter(object):
+    """ Writes an uploaded file to disk chunk by chunk and hashes the content along the way. """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._file = open(path, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class MultipartParser(object):
+    """
+    Incremental parser for multipart/form-data request bodies. The body is fed
+    in arbitrary chunks as it arrives. Plain form fields are collected in
+    memory, file parts are handed to the writer returned by file_factory, so
+    memory usage does not depend on the size of the uploaded files.
+    """
+    STATE_PREAMBLE = 0
+    STATE_HEADERS = 1
+    STATE_BODY = 2
+    STATE_DONE = 3
+
+    def __init__(self, boundary, file_factory, max_field_size=65536):
+        self._delimiter = b'--' + boundary
+        self._part_delimiter = b'\r\n' + self._delimiter
+        self._file_factory = file_factory
+        self._max_field_size = max_field_size
+        self._buffer = b''
+        self._state = self.STATE_PREAMBLE
+        self._part = None
+        self.fields = {}
+        self.files = {}
+
+    @staticmethod
+    def boundary_from_content_type(content_type):
+        for field in content_type.split(';')[1:]:
+            key, _, value = field.strip().partition('=')
+            if key.lower() == 'boundary' and value:
+                if value.startswith('"') and value.endswith('"'):
+                    value = value[1:-1]
+                return value.encode('latin1')
+        raise MultipartError('No multipart boundary found.')
+
+    @property
+    def finished(self):
+        return self._state == self.STATE_DONE
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        while self._step():
+            pass
+
+    def close(self):
+        """ Finishes parsing, raises if the body ended in the middle of a part. """
+        self.abort()
+        if not self.finished:
+            raise MultipartError('Multipart body incomplete.')
+
+    def abort(self):
+        """ Stops parsing, closing the writer of the file part in progress. """
+        if self._part is not None and self._part['writer'] is not None:
+            self._part['writer'].close()
+            self._part['writer'] = None
+
+    def _step(self):
+        """ Consumes as much of the buffer as possible, returns True if another step may progress. """
+        if self._state == self.STATE_PREAMBLE:
+            idx = self._buffer.find(self._delimiter)
+            if idx < 0:
+                # keep enough bytes to detect a delimiter split across chunks
+                self._buffer = self._buffer[-len(self._delimiter):]
+                return False
+            return self._after_delimiter(idx + len(self._delimiter))
+        if self._state == self.STATE_HEADERS:
+            idx = self._buffer.find(b'\r\n\r\n')
+            if idx < 0:
+                if len(self._buffer) > self._max_field_size:
+                    raise MultipartError('Multipart headers too large.')
+                return False
+            self._start_part(self._buffer[:idx].decode('utf-8', errors='replace'))
+            self._buffer = self._buffer[idx + 4:]
+            self._state = self.STATE_BODY
+            return True
+        if self._state == self.STATE_BODY:
+            idx = self._buffer.find(self._part_delimiter)
+            if idx < 0:
+                # everything except a possible partial delimiter belongs to the part
+                keep = len(self._part_delimiter) - 1
+                if len(self._buffer) > keep:
+                    self._part_data(self._buffer[:-keep])
+                    self._buffer = self._buffer[-keep:]
+                return False
+            if len(self._buffer) < idx + len(self._part_delimiter) + 2:
+                # wait for the bytes telling whether this was the last part
+                self._part_data(self._buffer[:idx])
+                self._buffer = self._buffer[idx:]
+                return False
+            self._part_data(self._buffer[:idx])
+            self._end_part()
+            return self._after_delimiter(idx + len(self._part_delimiter))
+        return False
+
+    def _after_delimiter(self, offset):
+        """ Decides whether the delimiter at offset ends the body or starts the next part. """
+        if len(self._buffer) < offset + 2:
+            return False
+        tail = self._buffer[offset:offset + 2]
+        if tail == b'--':
+            self._buffer = b''
+            self._state = self.STATE_DONE
+            return False
+        if tail != b'\r\n':
+            raise MultipartError('Malformed multipart delimiter.')
+        self._buffer = self._buffer[offset + 2:]
+        self._state = self.STATE_HEADERS
+        return True
+
+    def _start_part(self, header_block):
+        headers = {}
+        for line in header_block.split('\r\n'):
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        params = {}
+        for field in headers.get('content-disposition', '').split(';')[1:]:
+            key, _, value = field.strip().partition('=')
+            params[key.lower()] = value.strip('"')
+        if 'name' not in params:
+            raise MultipartError('Multipart part without name.')
+        self._part = {
+            'name': params['name'],
+            'filename': params.get('filename'),
+            'content_type': headers.get('content-type', 'application/octet-stream'),
+            'writer': None,
+            'data': b''
+        }
+        if self._part['filename'] is not None:
+            self._part['filename'] = os.path.basename(self._part['filename'])
+            self._part['writer'] = self._file_factory(self._part['name'], self._part['filename'])
+
+    def _part_data(self, data):
+        if not data:
+            return
+        if self._part['filename'] is not None:
+            # file parts without a writer are dropped
+            if self._part['writer'] is not None:
+                self._part['writer'].write(data)
+            return
+        self._part['data'] += data
+        if len(self._part['data']) > self._max_field_size:
+            raise MultipartError(f'Form field {self._part["name"]} too large.')
+
+    def _end_part(self):
+        part = self._part
+        self._part = None
+        if part['filename'] is None:
+            self.fields.setdefault(part['name'], []).append(part['data'])
+            return
+        if part['writer'] is None:
+            return
+        part['writer'].close()
+        self.files.setdefault(part['name'], []).append({
+            'filename': part['filename'],
+            'content_type': part['content_type'],
+            'writer': part['writer']
+        })
@@ -0,0 +1,123 @@
+import unittest
+
+from createhero.multipart import MultipartError, MultipartParser
+
+BOUNDARY = b'----boundary7MA4YWxk'
+
+
+class MemoryWriter(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = b''
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        self.closed = True
+
+
+def _body(parts):
+    """ A multipart body of (name, filename or None, content) parts. """
+    body = b''
+    for name, filename, content in parts:
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        body += b'--' + BOUNDARY + b'\r\n'
+        body += f'Content-Disposition: {disposition}\r\n'.encode()
+        if filename is not None:
+            body += b'Content-Type: video/mp4\r\n'
+        body += b'\r\n' + content + b'\r\n'
+    return body + b'--' + BOUNDARY + b'--\r\n'
+
+
+class MultipartParserTest(unittest.TestCase):
+    # the file content contains a line break and something close to the delimiter
+    PARTS = [
+        ('task_name', None, b'my task'),
+        ('video', 'clip.mp4', b'\x00\x01\r\n--' + BOUNDARY[:-1] + b'\r\n\r\nend'),
+        ('target_size', None, b'original'),
+    ]
+
+    def _parse(self, chunks):
+        writers = []
+
+        def file_factory(name, filename):
+            writers.append(MemoryWriter(filename))
+            return writers[-1]
+
+        parser = MultipartParser(BOUNDARY, file_factory)
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.close()
+        return parser, writers
+
+    def _check(self, parser, writers):
+        self.assertTrue(parser.finished)
+        self.assertEqual(parser.fields, {'task_name': [b'my task'], 'target_size': [b'original']})
+        self.assertEqual(len(writers), 1)
+        self.assertEqual(writers[0].data, self.PARTS[1][2])
+        self.assertTrue(writers[0].closed)
+        self.assertEqual(parser.files['video'][0]['filename'], 'clip.mp4')
+        self.assertEqual(parser.files['video'][0]['content_type'], 'video/mp4')
+
+    def test_single_chunk(self):
+        self._check(*self._parse([_body(self.PARTS)]))
+
+    def test_split_at_every_offset(self):
+        body = _body(self.PARTS)
+        for i in range(len(body) + 1):
+            with self.subTest(split=i):
+                self._check(*self._parse([body[:i], body[i:]]))
+
+    def test_byte_by_byte(self):
+        body = _body(self.PARTS)
+        self._check(*self._parse([body[i:i + 1] for i in range(len(body))]))
+
+    def test_preamble_is_skipped(self):
+        body = b'this is the preamble\r\n' + _body(self.PARTS)
+        self._check(*self._parse([body[:10], body[10:30], body[30:]]))
+
+    def test_filename_path_is_stripped(self):
+        parser, writers = self._parse([_body([('video', '../../etc/clip.mp4', b'data')])])
+        self.assertEqual(writers[0].filename, 'clip.mp4')
+
+    def test_incomplete_body(self):
+        body = _body(self.PARTS)
+        with self.assertRaises(MultipartError):
+            self._parse([body[:-len(BOUNDARY) - 10]])
+
+    def test_abort_closes_file_in_progress(self):
+        writers = []
+        parser = MultipartParser(BOUNDARY, lambda name, filename: writers.append(MemoryWriter(filename)) or writers[-1])
+        parser.feed(_body(self.PARTS[1:2])[:-30])
+        parser.abort()
+        self.assertTrue(writers[0].closed)
+        self.assertFalse(parser.finished)
+
+    def test_malformed_delimiter(self):
+        with self.assertRaises(MultipartError):
+            self._parse([b'--' + BOUNDARY + b'xx'])
+
+    def test_part_without_name(self):
+        body = b'--' + BOUNDARY + b'\r\nContent-Disposition: form-data\r\n\r\nvalue\r\n--' + BOUNDARY + b'--\r\n'
+        with self.assertRaises(MultipartError):
+            self._parse([body])
+
+    def test_field_too_large(self):
+        parser = MultipartParser(BOUNDARY, lambda name, filename: MemoryWriter(filename), max_field_size=16)
+        with self.assertRaises(MultipartError):
+            parser.feed(_body([('task_name', None, b'x' * 100)]))
+
+    def test_boundary_from_content_type(self):
+        self.assertEqual(MultipartParser.boundary_from_content_type('multipart/form-data; boundary=abc'), b'abc')
+        self.assertEqual(MultipartParser.boundary_from_content_type('multipart/form-data; BOUNDARY="a b"'), b'a b')
+        with self.assertRaises(MultipartError):
+            MultipartParser.boundary_from_content_type('multipart/form-data')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import asyncio
+import json
+import logging
+import os
+
+
+class ProbeError(Exception):
+    pass
+
+
+def _parse_rate(rate):
+    """ Parses ffprobe frame rates like '30000/1001'. """
+    try:
+        numerator, _, denominator = rate.partition('/')
+        return float(numerator) / float(denominator or 1)
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return None
+
+
+def summarize_probe(ffprobe_output):
+    """ Reduces the ffprobe JSON to the fields the task pipeline works with. """
+    media_format = ffprobe_output.get('format', {})
+    streams = ffprobe_output.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), {})
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), {})
+    duration = float(media_format.get('duration') or video.get('duration') or 0) or None
+    fps = _parse_rate(video.get('avg_frame_rate')) or _parse_rate(video.get('r_frame_rate'))
+    frame_count = int(video['nb_frames']) if video.get('nb_frames') else None
+    if frame_count is None and duration and fps:
+        frame_count = int(round(duration * fps))
+    return {
+        'duration': duration,
+        'fps': fps,
+        'frame_count': frame_count,
+        'width': video.get('width'),
+        'height': video.get('height'),
+        'video_codec': video.get('codec_name'),
+        'audio_codec': audio.get('codec_name'),
+        'format_name': media_format.get('format_name'),
+        'bit_rate': int(media_format['bit_rate']) if media_format.get('bit_rate') else None,
+        'size': int(media_format['size']) if media_format.get('size') else None
+    }
+
+
+def _cache_key(path, content_hash):
+    if content_hash is None:
+        stat = os.stat(path)
+        content_hash = f'{stat.st_size:x}-{stat.st_mtime_ns:x}'
+    return content_hash
+
+
+async def probe_media(path, cache_dir, content_hash=None):
+    """
+    Probes the media file with a single ffprobe call. The summary is cached in
+    cache_dir under the content hash of the file (or its size and mtime if no
+    hash is known), so restarts and later pipeline stages reuse it.
+    """
+    cache_file = os.path.join(cache_dir, f'probe_{_cache_key(path, content_hash)}.json')
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        pass
+    process = await asyncio.create_subprocess_exec('ffprobe', '-v', 'error', '-print_format', 'json',
+                                                   '-show_format', '-show_streams', path,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    output, errors = await process.communicate()
+    if process.returncode != 0:
+        raise ProbeError(f'ffprobe failed on {path}: {errors.decode(errors="replace").strip()}')
+    summary = summarize_probe(json.loads(output))
+    with open(cache_file + '.tmp', 'w') as f:
+        json.dump(summary, f)
+    os.replace(cache_file + '.tmp', cache_file)
+    logging.getLogger(__name__).debug(f'probed {path}: {summary}')
+    return summary
+
+
+async def probe_keyframes(path, cache_dir, content_hash=None):
+    """
+    Lists the timestamps of the video keyframes in seconds. Only the packet
+    flags are read, nothing gets decoded. Cached like the probe summary.
+    """
+    cache_file = os.path.join(cache_dir, f'keyframes_{_cache_key(path, content_hash)}.json')
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        pass
+    process = await asyncio.create_subprocess_exec('ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                                                   '-show_entries', 'packet=pts_time,flags',
+                                                   '-of', 'csv=p=0', path,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    output, errors = await process.communicate()
+    if process.returncode != 0:
+        raise ProbeError(f'ffprobe failed on {path}: {errors.decode(errors="replace").strip()}')
+    keyframes = []
+    for line in output.decode(errors='replace').splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags:
+            try:
+                keyframes.append(float(pts_time))
+            except ValueError:
+                continue
+    keyframes.sort()
+    with open(cache_file + '.tmp', 'w') as f:
+        json.dump(keyframes, f)
+    os.replace(cache_file + '.tmp', cache_file)
+    return keyframes
@@ -0,0 +1,179 @@
+import itertools
+import os
+import re
+import time
+
+
+class ProgressLog(object):
+    """
+    Progress log of a task. Every line gets a monotonically increasing
+    sequence number. The full log is appended to a file in the task directory,
+    only the last `capacity` lines are kept in the shared task store, so
+    readers can cheaply fetch the lines after the cursor they last saw. New
+    lines are published on the event hub, if one is given.
+    """
+    FILE_NAME = 'progress.log'
+
+    def __init__(self, store, task_id, task_dir, capacity=1000, hub=None):
+        self.store = store
+        self.hub = hub
+        self.task_id = task_id
+        self.path = os.path.join(task_dir, self.FILE_NAME)
+        self.capacity = capacity
+        self._seq = None
+        self._file = None
+
+    @property
+    def start_seq(self):
+        """ First sequence number of the current run, lines before it belong to a run that was restarted. """
+        return self.store.get_field(self.task_id, 'progress_start', 1)
+
+    @property
+    def last_seq(self):
+        if self._seq is None:
+            self._seq = max(self.store.last_progress_seq(self.task_id), self._last_seq_from_file(),
+                            self.start_seq - 1)
+        return self._seq
+
+    @staticmethod
+    def _parse(line):
+        """ The (seq, line) entry of a log file line, None for a line torn by a crash. """
+        seq, tab, text = line.rstrip('\n').partition('\t')
+        if not tab or not seq.isdigit():
+            return None
+        return int(seq), text
+
+    def _last_seq_from_file(self):
+        try:
+            with open(self.path, 'r', errors='replace', newline='\n') as f:
+                f.seek(max(0, os.path.getsize(self.path) - 4096))
+                entries = [self._parse(line) for line in f.read().split('\n')]
+        except FileNotFoundError:
+            return 0
+        return max((entry[0] for entry in entries if entry is not None), default=0)
+
+    def append(self, line):
+        self.extend([line])
+
+    def extend(self, lines):
+        if not lines:
+            return
+        first = self.last_seq + 1
+        # a line break inside a line would tear its entry in the log file
+        entries = [(first + i, line.rstrip('\r\n').replace('\n', ' ')) for i, line in enumerate(lines)]
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.writelines(f'{seq}\t{line}\n' for seq, line in entries)
+        self._file.flush()
+        self.store.append_progress(self.task_id, entries, self.capacity)
+        self._seq = entries[-1][0]
+        if self.hub is not None:
+            self.hub.publish(self.task_id, {'type': 'progress', 'entries': entries})
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def reset(self):
+        """ Starts a new run, readers skip everything logged so far. """
+        start = self.last_seq + 1
+        self.store.update(self.task_id, {'progress_start': start})
+        if self.hub is not None:
+            self.hub.publish(self.task_id, {'type': 'reset', 'start': start})
+        return start
+
+    def read(self, after=0, limit=500):
+        """
+        Returns the (seq, line) entries following the cursor, the new cursor
+        and whether the cursor belonged to a previous run.
+        """
+        start = self.start_seq
+        reset = 0 < after < start
+        after = max(after, start - 1)
+        entries = self.store.read_progress(self.task_id, after, limit)
+        if not entries or entries[0][0] != after + 1:
+            # the cursor fell out of the ring, fall back to the log file
+            entries = self._read_file(after, limit) or entries
+        cursor = entries[-1][0] if entries else after
+        return entries, cursor, reset
+
+    def _read_file(self, after, limit):
+        try:
+            # output lines may contain carriage returns, only newlines end the lines of the log
+            with open(self.path, 'r', errors='replace', newline='\n') as f:
+                entries = (entry for entry in map(self._parse, f) if entry is not None)
+                return list(itertools.islice(itertools.dropwhile(lambda e: e[0] <= after, entries), limit))
+        except FileNotFoundError:
+            return []
+
+
+class ProgressStats(object):
+    """
+    Structured progress of an autoflip run. Autoflip logs every scene it has
+    cropped (with GLOG_vmodule=scene_cropping_calculator=1), the end of the
+    last scene and the frame rate of the input give the frames processed,
+    which together with the probed frame count yields percent, speed and ETA.
+    Segmented runs feed the output of every chunk as its own part.
+    """
+    SCENE_PATTERN = re.compile(r'Processed a scene from ([\d.]+) sec to ([\d.]+) sec')
+    SMOOTHING = 0.3
+
+    def __init__(self, frames_total, video_fps):
+        self.frames_total = frames_total
+        self.video_fps = video_fps
+        self.frames_processed = 0
+        self.fps = None
+        self._parts = {}
+        # frames processed by an earlier run, they do not count for the rate
+        self._resumed = 0
+        self.started = time.monotonic()
+        self._last_update = self.started
+
+    def feed(self, line, part=0):
+        """ Parses an output line of the given part, returns True if it changed the stats. """
+        m = self.SCENE_PATTERN.search(line)
+        if not m or not self.video_fps:
+            return False
+        return self.update(int(float(m.group(2)) * self.video_fps) + 1, part)
+
+    def update(self, frames, part=0):
+        """ Sets the frames the given part has processed so far, returns True if it changed the stats. """
+        self._parts[part] = max(self._parts.get(part, 0), frames)
+        frames = min(sum(self._parts.values()), self.frames_total or float('inf'))
+        now = time.monotonic()
+        if frames <= self.frames_processed or now <= self._last_update:
+            return False
+        current_fps = (frames - self.frames_processed) / (now - self._last_update)
+        self.fps = current_fps if self.fps is None else \
+            self.SMOOTHING * current_fps + (1 - self.SMOOTHING) * self.fps
+        self.frames_processed = frames
+        self._last_update = now
+        return True
+
+    def resume(self, frames, part=0):
+        """ Counts the frames of a part an earlier run processed as done. """
+        self._parts[part] = frames
+        self.frames_processed = min(sum(self._parts.values()), self.frames_total or float('inf'))
+        self._resumed = self.frames_processed
+
+    def complete(self):
+        self.frames_processed = self.frames_total or self.frames_processed
+
+    def to_dict(self):
+        elapsed = time.monotonic() - self.started
+        stats = {
+            'frames_processed': self.frames_processed,
+            'frames_total': self.frames_total,
+            'percent': None,
+            'fps': round(self.fps, 2) if self.fps else None,
+            'eta': None,
+            'elapsed': round(elapsed, 1)
+        }
+        if self.frames_total:
+            stats['percent'] = round(100 * self.frames_processed / self.frames_total, 1)
+            if self.frames_processed > self._resumed:
+                # the overall rate is steadier than the per scene one for the remaining time
+                average_fps = (self.frames_processed - self._resumed) / elapsed
+                stats['eta'] = round((self.frames_total - self.frames_processed) / average_fps, 1)
+        return stats
@@ -0,0 +1,166 @@
+from .journal import TaskJournal
+
+import logging
+import os
+import shutil
+import time
+
+# statuses of tasks whose files are not needed by the executor anymore
+FINISHED = ('success', 'stopped')
+ARTIFACT_FIELDS = ('status', 'created', 'last_access', 'evicted', 'input_file', 'outputs', 'output_file',
+                   'output_file_no_audio', 'audio_file', 'input_file_no_audio')
+
+
+def held_size(path):
+    """
+    Bytes freed by removing the file, 0 if it does not exist or is hard linked
+    elsewhere (like a task file shared with the result cache).
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 0
+    return stat.st_size if stat.st_nlink == 1 else 0
+
+
+def remove_file(path):
+    """ Removes the file if it exists, returns the bytes freed. """
+    size = held_size(path)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+def intermediate_files(task_data):
+    """ Files of a task that are only needed while it runs. """
+    outputs = task_data.get('outputs') or [task_data]
+    files = [output.get('output_file_no_audio') for output in outputs]
+    files += [task_data.get('audio_file'), task_data.get('input_file_no_audio')]
+    return [path for path in files if path]
+
+
+def artifact_files(task_data):
+    """ Input and output files of a task, kept until it expires. """
+    outputs = task_data.get('outputs') or [task_data]
+    files = [task_data.get('input_file')] + [output.get('output_file') for output in outputs]
+    return [path for path in files if path]
+
+
+class RetentionManager(object):
+    """
+    Keeps the task artifacts in the working directory within a disk quota.
+    Intermediates are removed as soon as a task succeeds (see
+    VideoReformatTask.finish), inputs and outputs of finished tasks are
+    evicted once they are older than the TTL, or least recently downloaded
+    first while the artifacts exceed the quota. The task records stay, the
+    eviction time is recorded in their 'evicted' field and their downloads
+    answer 410 from then on.
+
+    Only bytes a task holds alone count, files shared with the result cache
+    are accounted there.
+
+    Collections stat and delete the files of many tasks and run in a thread,
+    the evicted tasks are marked afterwards, on the IOLoop, as the task
+    journals are only written there.
+    """
+
+    def __init__(self, tasks, data_dir, quota=0, ttl=0):
+        self.tasks = tasks
+        self.data_dir = data_dir
+        # bytes and seconds, 0 disables the limit
+        self.quota = quota
+        self.ttl = ttl
+        self.log = logging.getLogger('RetentionManager')
+
+    def _finished_tasks(self):
+        task_ids = self.tasks.find(FINISHED)
+        return zip(task_ids, self.tasks.get_many(task_ids, ARTIFACT_FIELDS))
+
+    def plan(self, now=None):
+        """
+        Works out what a collection would remove right now. Returns the disk
+        usage and the plan: leftover intermediates per task, and the tasks to
+        evict with the bytes they hold.
+        """
+        now = now or time.time()
+        used = 0
+        intermediates = []
+        candidates = []
+        for task_id, task in self._finished_tasks():
+            if task.get('evicted'):
+                continue
+            leftovers = [(path, held_size(path)) for path in intermediate_files(task)
+                         if task.get('status') == 'success' and os.path.exists(path)]
+            if leftovers:
+                intermediates.append((task_id, leftovers))
+            size = sum(held_size(path) for path in artifact_files(task)) + sum(size for _, size in leftovers)
+            used += size
+            candidates.append((task.get('last_access') or task.get('created') or 0, task_id, size))
+        candidates.sort()
+        evictions = []
+        remaining = used - sum(size for _, leftovers in intermediates for _, size in leftovers)
+        for last_used, task_id, size in candidates:
+            expired = self.ttl and last_used < now - self.ttl
+            if expired or (self.quota and remaining > self.quota):
+                evictions.append((task_id, size))
+                remaining -= size
+        return used, intermediates, evictions
+
+    def report(self):
+        """ Disk usage of the task artifacts and the bytes a collection would reclaim. """
+        used, intermediates, evictions = self.plan()
+        intermediate_bytes = sum(size for _, leftovers in intermediates for _, size in leftovers)
+        return {
+            'quota': self.quota,
+            'ttl': self.ttl,
+            'used': used,
+            'reclaimable': intermediate_bytes + sum(size for _, size in evictions),
+            'reclaimable_intermediates': intermediate_bytes,
+            'tasks_to_evict': len(evictions)
+        }
+
+    def collect(self):
+        """
+        Removes leftover intermediates and the files of expired or least
+        recently used tasks. Returns the bytes freed and the IDs of the tasks
+        whose files were removed, to be marked with mark_evicted.
+        """
+        _, intermediates, evictions = self.plan()
+        freed = 0
+        evicted = []
+        for task_id, leftovers in intermediates:
+            freed += sum(remove_file(path) for path, _ in leftovers)
+        for task_id, _ in evictions:
+            removed = self.evict(task_id)
+            if removed is not None:
+                freed += removed
+                evicted.append(task_id)
+        if freed or evictions:
+            self.log.info(f'freed {freed} bytes, evicted {len(evicted)} tasks')
+        return freed, evicted
+
+    def evict(self, task_id):
+        """
+        Removes the inputs, outputs and intermediates of a finished task.
+        Returns the bytes freed, None if the task was restarted meanwhile.
+        """
+        task = self.tasks.get_fields(task_id, ARTIFACT_FIELDS)
+        if task.get('status') not in FINISHED:
+            return None
+        freed = sum(remove_file(path) for path in artifact_files(task) + intermediate_files(task))
+        segments_dir = os.path.join(self.data_dir, task_id, 'segments')
+        if os.path.isdir(segments_dir):
+            shutil.rmtree(segments_dir)
+        self.log.debug(f'[{task_id}] evicted, {freed} bytes freed')
+        return freed
+
+    def mark_evicted(self, task_ids):
+        """ Records the eviction in the records and journals of the tasks, from the IOLoop. """
+        for task_id in task_ids:
+            fields = {'evicted': time.time(), 'input_file_size': 0, 'output_file_size': 0}
+            self.tasks.update(task_id, fields)
+            task_dir = os.path.join(self.data_dir, task_id)
+            if os.path.isdir(task_dir):
+                TaskJournal(task_dir).update(fields)
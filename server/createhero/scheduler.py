@@ -0,0 +1,181 @@
+from .store import SQLiteStore
+
+import heapq
+import time
+
+
+class RunQueue(SQLiteStore):
+    """
+    Queue of the unfinished tasks, shared by the HTTP workers adding tasks
+    and reporting queue positions and the executors processing them, on this
+    node or on worker nodes sharing the state directory.
+
+    An executor claims a task with a lease it renews while working on it.
+    Tasks whose lease expired, as their executor died, are claimed again.
+    Within an executor, the tasks it claimed wait for worker slots in the
+    same order.
+
+    Waiting tasks are ranked by a score in seconds, lowest first: the
+    estimated run time, scaled up by the number of tasks the same client
+    already runs, plus PRIORITY_STEP per priority class below 'high', minus
+    the time waited times the aging factor. Short jobs overtake long ones,
+    while every waiting job keeps moving forward.
+
+    Run times are estimated from the probed duration and resolution times
+    the number of outputs, at a rate learned from the finished tasks.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS run_queue ('
+        'task_id TEXT PRIMARY KEY, client TEXT, priority INTEGER NOT NULL, cost REAL NOT NULL, '
+        'enqueued REAL NOT NULL, started REAL, worker TEXT, lease_expires REAL)',
+        'CREATE TABLE IF NOT EXISTS run_rate (id INTEGER PRIMARY KEY CHECK (id = 0), seconds_per_cost REAL)'
+    )
+    PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+    # task fields the cost, priority and client are taken from
+    TASK_FIELDS = ('probe', 'video_length', 'outputs', 'target_formats', 'priority', 'client')
+    PRIORITY_STEP = 3600
+    # seconds per pixel second of a single output, updated as tasks finish
+    DEFAULT_RATE = 1e-7
+    RATE_WEIGHT = 0.2
+    DEFAULT_RESOLUTION = 1920 * 1080
+
+    def __init__(self, path, aging=1.0, journal_mode='wal'):
+        super().__init__(path, journal_mode)
+        self.aging = aging
+
+    @classmethod
+    def cost(cls, task_data):
+        """
+        Pixel seconds to process for the task, summed over its outputs. Until
+        the task is prepared, the outputs are the requested target formats.
+        """
+        probe = task_data.get('probe') or {}
+        duration = probe.get('duration') or task_data.get('video_length') or 100
+        pixels = (probe.get('width') or 0) * (probe.get('height') or 0) or cls.DEFAULT_RESOLUTION
+        return duration * pixels * len(task_data.get('outputs') or task_data.get('target_formats') or [None])
+
+    def rate(self):
+        row = self.conn.execute('SELECT seconds_per_cost FROM run_rate WHERE id = 0').fetchone()
+        return row[0] if row else self.DEFAULT_RATE
+
+    def push(self, task_id, task_data):
+        """
+        Adds a task, or updates the cost estimate of a queued task once it is
+        prepared. A task queued before keeps its waiting time and lease.
+        """
+        row = (task_data.get('client'), self.PRIORITIES.get(task_data.get('priority'), self.PRIORITIES['normal']),
+               self.cost(task_data))
+        self._write([('INSERT OR IGNORE INTO run_queue (task_id, priority, cost, enqueued) VALUES (?, 0, 0, ?)',
+                      [(task_id, time.time())]),
+                     ('UPDATE run_queue SET client = ?, priority = ?, cost = ? WHERE task_id = ?',
+                      [row + (task_id,)])])
+
+    def start(self, task_id):
+        self._write([('UPDATE run_queue SET started = ? WHERE task_id = ?', [(time.time(), task_id)])])
+
+    def queued(self):
+        return {row[0] for row in self.conn.execute('SELECT task_id FROM run_queue')}
+
+    def claim(self, worker, lease):
+        """
+        Leases the best ranked task not leased by another executor to the
+        worker for lease seconds, returns its ID or None if there is none.
+        """
+        def body(conn):
+            now = time.time()
+            rows = self._rows()
+            claimable = [row[0] for row in rows if row[6] is None or row[7] < now]
+            ranked = self._ranked(rows, now, self.rate(), claimable)
+            task_id = ranked[0][0] if ranked else None
+            if task_id is not None:
+                conn.execute('UPDATE run_queue SET worker = ?, lease_expires = ?, started = NULL WHERE task_id = ?',
+                             (worker, now + lease, task_id))
+            return task_id
+        return self._transaction(body)
+
+    def renew(self, worker, lease):
+        """ Extends the leases of all tasks of the worker. """
+        self._write([('UPDATE run_queue SET lease_expires = ? WHERE worker = ?', [(time.time() + lease, worker)])])
+
+    def release(self, worker):
+        """ Gives up the leases of the worker, its tasks can be claimed right away. """
+        self._write([('UPDATE run_queue SET worker = NULL, lease_expires = NULL, started = NULL WHERE worker = ?',
+                      [(worker,)])])
+
+    def finish(self, task_id, completed=True, worker=None):
+        """
+        Removes the task, a completed run refines the run time estimate. With
+        a worker given, only if the task is still leased to it.
+        """
+        row = self.conn.execute('SELECT cost, started, worker FROM run_queue WHERE task_id = ?', (task_id,)).fetchone()
+        if row is None or (worker is not None and row[2] != worker):
+            return
+        statements = [('DELETE FROM run_queue WHERE task_id = ?', [(task_id,)])]
+        if completed and row[0] and row[1]:
+            observed = (time.time() - row[1]) / row[0]
+            rate = self.rate() * (1 - self.RATE_WEIGHT) + observed * self.RATE_WEIGHT
+            statements.append(('INSERT OR REPLACE INTO run_rate (id, seconds_per_cost) VALUES (0, ?)', [(rate,)]))
+        self._write(statements)
+
+    def prune(self, task_ids, before):
+        """ Drops the tasks queued before the given time that are not among the given ones. """
+        task_ids = set(task_ids)
+        stale = [(row[0],) for row in self.conn.execute('SELECT task_id FROM run_queue WHERE enqueued < ?', (before,))
+                 if row[0] not in task_ids]
+        if stale:
+            self._write([('DELETE FROM run_queue WHERE task_id = ?', stale)])
+
+    def depth(self):
+        """ Number of tasks waiting for a slot and the time the longest waiting of them was queued. """
+        now = time.time()
+        waiting = [row[4] for row in self._rows() if not self._running(row, now)]
+        return len(waiting), min(waiting, default=None)
+
+    def _rows(self):
+        return self.conn.execute('SELECT task_id, client, priority, cost, enqueued, started, worker, lease_expires '
+                                 'FROM run_queue').fetchall()
+
+    @staticmethod
+    def _running(row, now):
+        return row[5] is not None and row[7] is not None and row[7] >= now
+
+    def _ranked(self, rows, now, rate, candidates):
+        """ The rows of the candidate tasks, best ranked first. """
+        running = {}
+        for row in rows:
+            if self._running(row, now):
+                running[row[1]] = running.get(row[1], 0) + 1
+
+        def score(row):
+            client, priority, cost, enqueued = row[1:5]
+            return (cost * rate * (1 + running.get(client, 0)) + priority * self.PRIORITY_STEP
+                    - (now - enqueued) * self.aging)
+
+        candidates = set(candidates)
+        return sorted((row for row in rows if row[0] in candidates), key=score)
+
+    def next(self, task_ids):
+        """ The one of the given waiting tasks to run next, None if none of them is queued. """
+        ranked = self._ranked(self._rows(), time.time(), self.rate(), task_ids)
+        return ranked[0][0] if ranked else None
+
+    def schedule(self, slots):
+        """
+        Queue position (1 based) and estimated start time of every waiting
+        task, assuming the current ranking holds and the slots free up as
+        estimated.
+        """
+        now = time.time()
+        rate = self.rate()
+        rows = self._rows()
+        slots = max(1, slots)
+        free_at = [max(now, row[5] + row[3] * rate) for row in rows if self._running(row, now)]
+        free_at = sorted(free_at)[:slots] + [now] * max(0, slots - len(free_at))
+        heapq.heapify(free_at)
+        schedule = {}
+        waiting = [row[0] for row in rows if not self._running(row, now)]
+        for position, row in enumerate(self._ranked(rows, now, rate, waiting), 1):
+            start = heapq.heappop(free_at)
+            schedule[row[0]] = {'position': position, 'estimated_start': start}
+            heapq.heappush(free_at, start + row[3] * rate)
+        return schedule
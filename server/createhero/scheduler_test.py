@@ -0,0 +1,152 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from createhero.scheduler import RunQueue
+
+
+class RunQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = RunQueue(os.path.join(self.directory, 'queue.db'))
+        self.now = 1000000.0
+        patcher = mock.patch.object(time, 'time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _push(self, task_id, duration=100, **fields):
+        self.queue.push(task_id, dict(probe={'duration': duration, 'width': 1920, 'height': 1080}, **fields))
+
+    def test_claim_empty(self):
+        self.assertIsNone(self.queue.claim('w1', 60))
+
+    def test_claim_leases_each_task_once(self):
+        self._push('a')
+        self._push('b')
+        claimed = {self.queue.claim('w1', 60), self.queue.claim('w2', 60)}
+        self.assertEqual(claimed, {'a', 'b'})
+        self.assertIsNone(self.queue.claim('w3', 60))
+
+    def test_claim_prefers_short_tasks(self):
+        self._push('long', duration=3600)
+        self._push('short', duration=10)
+        self.assertEqual(self.queue.claim('w1', 60), 'short')
+
+    def test_cost_counts_target_formats(self):
+        single = RunQueue.cost({'video_length': 100})
+        self.assertEqual(RunQueue.cost({'video_length': 100, 'target_formats': ['1:1', '9:16', '16:9']}), 3 * single)
+        # once prepared, the outputs count
+        self.assertEqual(RunQueue.cost({'video_length': 100, 'target_formats': ['1:1', '9:16'],
+                                        'outputs': [{}, {}]}), 2 * single)
+
+    def test_claim_prefers_single_format(self):
+        self._push('three', duration=100, target_formats=['1:1', '9:16', '16:9'])
+        self._push('one', duration=150)
+        self.assertEqual(self.queue.claim('w1', 60), 'one')
+
+    def test_claim_priority(self):
+        self._push('normal', duration=10)
+        self._push('high', duration=600, priority='high')
+        self.assertEqual(self.queue.claim('w1', 60), 'high')
+
+    def test_waiting_ages(self):
+        self._push('long', duration=3600)
+        self.now += 3600
+        self._push('short', duration=10)
+        self.assertEqual(self.queue.claim('w1', 60), 'long')
+
+    def test_expired_lease_is_claimed_again(self):
+        self._push('a')
+        self.assertEqual(self.queue.claim('w1', 60), 'a')
+        self.now += 59
+        self.assertIsNone(self.queue.claim('w2', 60))
+        self.now += 2
+        self.assertEqual(self.queue.claim('w2', 60), 'a')
+
+    def test_renew_extends_lease(self):
+        self._push('a')
+        self.queue.claim('w1', 60)
+        self.now += 50
+        self.queue.renew('w1', 60)
+        self.now += 50
+        self.assertIsNone(self.queue.claim('w2', 60))
+        self.now += 11
+        self.assertEqual(self.queue.claim('w2', 60), 'a')
+
+    def test_renew_of_other_worker(self):
+        self._push('a')
+        self.queue.claim('w1', 60)
+        self.now += 50
+        self.queue.renew('w2', 60)
+        self.now += 11
+        self.assertEqual(self.queue.claim('w2', 60), 'a')
+
+    def test_release(self):
+        self._push('a')
+        self.queue.claim('w1', 60)
+        self.queue.release('w1')
+        self.assertEqual(self.queue.claim('w2', 60), 'a')
+
+    def test_finish_of_expired_lease_by_previous_worker(self):
+        self._push('a')
+        self.queue.claim('w1', 60)
+        self.now += 61
+        self.queue.claim('w2', 60)
+        self.queue.finish('a', worker='w1')
+        self.assertEqual(self.queue.queued(), {'a'})
+        self.queue.finish('a', worker='w2')
+        self.assertEqual(self.queue.queued(), set())
+
+    def test_finish_unknown_task(self):
+        self.queue.finish('missing')
+        self.assertEqual(self.queue.queued(), set())
+
+    def test_finish_updates_rate(self):
+        self._push('a')
+        self.queue.claim('w1', 60)
+        self.queue.start('a')
+        self.now += 100
+        self.queue.finish('a', worker='w1')
+        observed = 100 / RunQueue.cost({'probe': {'duration': 100, 'width': 1920, 'height': 1080}})
+        expected = RunQueue.DEFAULT_RATE * (1 - RunQueue.RATE_WEIGHT) + observed * RunQueue.RATE_WEIGHT
+        self.assertAlmostEqual(self.queue.rate(), expected)
+
+    def test_push_keeps_waiting_time_and_lease(self):
+        self._push('a', duration=10)
+        self.queue.claim('w1', 60)
+        self.now += 10
+        self._push('a', duration=20)
+        self.assertEqual(self.queue._rows()[0][4], 1000000.0)
+        self.assertIsNone(self.queue.claim('w2', 60))
+
+    def test_depth_and_schedule(self):
+        self._push('a', duration=10)
+        self._push('b', duration=20)
+        self.now += 5
+        self._push('c', duration=30)
+        self.assertEqual(self.queue.depth(), (3, 1000000.0))
+        self.queue.claim('w1', 60)
+        self.queue.start('a')
+        self.assertEqual(self.queue.depth(), (2, 1000000.0))
+        schedule = self.queue.schedule(1)
+        self.assertEqual({task_id: entry['position'] for task_id, entry in schedule.items()}, {'b': 1, 'c': 2})
+        self.assertLess(schedule['b']['estimated_start'], schedule['c']['estimated_start'])
+
+    def test_prune(self):
+        self._push('a')
+        self._push('b')
+        self.now += 10
+        self._push('c')
+        self.queue.prune(['b'], self.now)
+        self.assertEqual(self.queue.queued(), {'b', 'c'})
+
+
+if __name__ == '__main__':
+    unittest.main()
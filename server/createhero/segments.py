@@ -0,0 +1,68 @@
+import bisect
+
+
+def plan_segments(keyframes, duration, segment_duration, overlap=0.0):
+    """
+    Splits a video of the given duration into segments of roughly
+    segment_duration seconds. Segments start at keyframes, so the chunks can
+    be cut and joined again without re-encoding. Encoders set extra keyframes
+    at scene cuts, so a keyframe off the regular interval is preferred when it
+    is about as close to the target as the regular one.
+
+    With an overlap, every segment but the first is read from the keyframe at
+    least overlap seconds before its start. Autoflip sees that lead-in to
+    settle the crop path, it is trimmed when the chunks are joined.
+    Returns a list of dicts with index, start, end, input_start and lead_in.
+    """
+    keyframes = sorted(k for k in keyframes if 0 < k < duration)
+    min_length = segment_duration / 2
+    boundaries = [0.0]
+    while True:
+        target = boundaries[-1] + segment_duration
+        if duration - target < min_length:
+            break
+        lo = bisect.bisect_left(keyframes, boundaries[-1] + min_length)
+        hi = bisect.bisect_right(keyframes, duration - min_length)
+        candidates = keyframes[lo:hi]
+        if not candidates:
+            break
+        nearest = min(candidates, key=lambda k: abs(k - target))
+        cuts = [k for k in candidates if abs(k - target) <= abs(nearest - target) + min_length / 4
+                and _is_irregular(keyframes, k)]
+        boundaries.append(min(cuts, key=lambda k: abs(k - target)) if cuts else nearest)
+    boundaries.append(duration)
+
+    segments = []
+    for index, (start, end) in enumerate(zip(boundaries, boundaries[1:])):
+        input_start = start
+        if overlap and index > 0:
+            earlier = bisect.bisect_right(keyframes, start - overlap)
+            input_start = keyframes[earlier - 1] if earlier else 0.0
+        segments.append({
+            'index': index,
+            'start': start,
+            'end': end,
+            'input_start': input_start,
+            'lead_in': start - input_start
+        })
+    return segments
+
+
+def _is_irregular(keyframes, keyframe):
+    """ True if the keyframe breaks the interval of its neighbours, which hints at a scene cut. """
+    i = bisect.bisect_left(keyframes, keyframe)
+    if i < 2 or i + 1 >= len(keyframes):
+        return False
+    before = keyframes[i - 1] - keyframes[i - 2]
+    after = keyframes[i + 1] - keyframes[i]
+    return abs((keyframe - keyframes[i - 1]) - before) > before / 10 and \
+        abs((keyframe - keyframes[i - 1]) - after) > after / 10
+
+
+def write_concat_list(path, files, inpoints):
+    """ Writes an ffmpeg concat demuxer list, every file is read from its inpoint on. """
+    with open(path, 'w') as f:
+        for filename, inpoint in zip(files, inpoints):
+            f.write("file '{}'\n".format(filename.replace("'", "'\\''")))
+            if inpoint:
+                f.write(f'inpoint {inpoint:.3f}\n')
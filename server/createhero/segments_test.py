@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from createhero.segments import plan_segments, write_concat_list
+
+
+class PlanSegmentsTest(unittest.TestCase):
+
+    def _bounds(self, segments):
+        return [(s['start'], s['end']) for s in segments]
+
+    def _check_contiguous(self, segments, duration):
+        self.assertEqual(segments[0]['start'], 0.0)
+        self.assertEqual(segments[-1]['end'], duration)
+        for index, (segment, following) in enumerate(zip(segments, segments[1:])):
+            self.assertEqual(segment['index'], index)
+            self.assertEqual(segment['end'], following['start'])
+
+    def test_regular_keyframes(self):
+        keyframes = [float(k) for k in range(0, 100, 2)]
+        segments = plan_segments(keyframes, 100.0, 30)
+        self.assertEqual(self._bounds(segments), [(0.0, 30.0), (30.0, 60.0), (60.0, 100.0)])
+        self._check_contiguous(segments, 100.0)
+
+    def test_no_keyframes(self):
+        self.assertEqual(self._bounds(plan_segments([], 100.0, 30)), [(0.0, 100.0)])
+
+    def test_shorter_than_segment(self):
+        self.assertEqual(self._bounds(plan_segments([2.0, 4.0, 6.0], 20.0, 30)), [(0.0, 20.0)])
+
+    def test_last_segment_not_too_short(self):
+        keyframes = [float(k) for k in range(0, 70, 2)]
+        segments = plan_segments(keyframes, 70.0, 30)
+        self.assertEqual(self._bounds(segments), [(0.0, 30.0), (30.0, 70.0)])
+
+    def test_keyframes_outside_video_ignored(self):
+        segments = plan_segments([-1.0, 0.0, 30.0, 100.0, 150.0], 100.0, 30)
+        self.assertEqual(self._bounds(segments), [(0.0, 30.0), (30.0, 100.0)])
+
+    def test_unsorted_keyframes(self):
+        keyframes = [float(k) for k in range(98, 0, -2)]
+        self.assertEqual(self._bounds(plan_segments(keyframes, 100.0, 30)),
+                         [(0.0, 30.0), (30.0, 60.0), (60.0, 100.0)])
+
+    def test_sparse_keyframes(self):
+        segments = plan_segments([45.0], 100.0, 30)
+        self.assertEqual(self._bounds(segments), [(0.0, 45.0), (45.0, 100.0)])
+
+    def test_prefers_scene_cut(self):
+        # regular keyframes every 4 seconds, a scene cut at 33 is preferred over the regular 28 and 32
+        keyframes = sorted([float(k) for k in range(0, 100, 4)] + [33.0])
+        segments = plan_segments(keyframes, 100.0, 30)
+        self.assertEqual(segments[1]['start'], 33.0)
+        self._check_contiguous(segments, 100.0)
+
+    def test_without_overlap(self):
+        for segment in plan_segments([float(k) for k in range(0, 100, 2)], 100.0, 30):
+            self.assertEqual(segment['input_start'], segment['start'])
+            self.assertEqual(segment['lead_in'], 0)
+
+    def test_overlap(self):
+        keyframes = [float(k) for k in range(0, 100, 4)]
+        segments = plan_segments(keyframes, 100.0, 30, overlap=5)
+        self.assertEqual(segments[0]['input_start'], 0.0)
+        self.assertEqual(segments[0]['lead_in'], 0.0)
+        for segment in segments[1:]:
+            self.assertIn(segment['input_start'], keyframes)
+            self.assertGreaterEqual(segment['lead_in'], 5)
+            self.assertEqual(segment['input_start'] + segment['lead_in'], segment['start'])
+
+    def test_overlap_before_first_keyframe(self):
+        segments = plan_segments([30.0], 60.0, 30, overlap=40)
+        self.assertEqual(segments[1]['input_start'], 0.0)
+        self.assertEqual(segments[1]['lead_in'], 30.0)
+
+
+class WriteConcatListTest(unittest.TestCase):
+
+    def test_quotes_and_inpoints(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'concat.txt')
+        write_concat_list(path, ['a.mp4', "it's.mp4"], [0, 1.25])
+        with open(path, 'r') as f:
+            self.assertEqual(f.read(), "file 'a.mp4'\nfile 'it'\\''s.mp4'\ninpoint 1.250\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
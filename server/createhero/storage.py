@@ -0,0 +1,50 @@
+from .cache import link_file
+
+import abc
+import os
+
+
+class Storage(abc.ABC):
+    """
+    Where the inputs and results of tasks are kept, as seen from the nodes
+    processing them. Workers fetch the input into their working directory
+    before processing and put the results back, the HTTP workers serve the
+    results from the path put returned.
+    """
+
+    @abc.abstractmethod
+    def fetch(self, task_id, name, target):
+        """ Copies the stored file of the task to the local target path. """
+
+    @abc.abstractmethod
+    def put(self, task_id, name, source):
+        """ Stores the local source file as file of the task, returns the path it is served from. """
+
+
+class LocalStorage(Storage):
+    """
+    Storage in a directory with one subdirectory per task, the working
+    directory of the HTTP workers. Worker nodes mount it at the same path, a
+    worker using it as working directory reads and writes it in place.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, task_id, name):
+        return os.path.join(self.root, task_id, name)
+
+    @staticmethod
+    def _transfer(source, target):
+        if os.path.abspath(source) == os.path.abspath(target):
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        link_file(source, target)
+
+    def fetch(self, task_id, name, target):
+        self._transfer(self.path(task_id, name), target)
+
+    def put(self, task_id, name, source):
+        target = self.path(task_id, name)
+        self._transfer(source, target)
+        return target
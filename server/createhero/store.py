@@ -0,0 +1,285 @@
+import base64
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+
+class SQLiteStore(object):
+    """
+    Base for the SQLite backed state shared between processes. The database
+    runs in WAL mode, every process (and thread) opens its own connection on
+    first use, which keeps the store safe to use across fork. Subclasses list
+    their tables in SCHEMA.
+
+    WAL needs all connections on one host, as they share an index in memory.
+    A database on a network filesystem shared with other hosts uses the
+    rollback journal ('delete') instead, in all processes of all hosts.
+
+    Writes also run on the IOLoop, so a connection waits only BUSY_TIMEOUT
+    for the lock of another one. A write finding the database locked is
+    rolled back and retried after a random pause, WRITE_ATTEMPTS times.
+    """
+    SCHEMA = ()
+    JOURNAL_MODES = ('wal', 'delete')
+    BUSY_TIMEOUT = 0.25
+    WRITE_ATTEMPTS = 8
+
+    def __init__(self, path, journal_mode='wal'):
+        if journal_mode not in self.JOURNAL_MODES:
+            raise ValueError(f'unsupported journal mode {journal_mode}')
+        self.path = path
+        self.journal_mode = journal_mode
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT, isolation_level=None)
+            conn.execute(f'PRAGMA journal_mode={self.journal_mode.upper()}')
+            if self.journal_mode == 'wal':
+                # commits are durable with the next checkpoint, the WAL keeps the database consistent
+                conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def _transaction(self, body):
+        """ Runs body(conn) in a write transaction and returns its result, retried while the database is locked. """
+        for attempt in range(self.WRITE_ATTEMPTS):
+            conn = self.conn
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                result = body(conn)
+                conn.execute('COMMIT')
+                return result
+            except BaseException as e:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                if (not isinstance(e, sqlite3.OperationalError) or 'locked' not in str(e)
+                        or attempt == self.WRITE_ATTEMPTS - 1):
+                    raise
+            time.sleep(random.uniform(0, self.BUSY_TIMEOUT))
+
+    def _write(self, statements):
+        """ Runs (sql, rows) statements in a single transaction. """
+        def body(conn):
+            for sql, rows in statements:
+                conn.executemany(sql, rows)
+        self._transaction(body)
+
+
+class TaskStore(SQLiteStore):
+    """
+    Task records shared between the forked HTTP workers and the executor.
+    Records are stored with one row per field, so single fields can be read
+    and updated without copying the whole record.
+
+    The store can be used like the dict it replaces, reading or assigning a
+    task ID gets or replaces the full record.
+
+    The store persists across restarts. A summary row per task in task_index
+    is kept up to date in the same transaction as the fields, so finding the
+    tasks to resume or listing tasks never has to touch the full records.
+    Missing summary fields are indexed as '' or 0, so every row sorts and
+    pages the same way.
+    """
+    SUMMARY_FIELDS = ('task_name', 'status', 'action', 'created')
+    SUMMARY_DEFAULTS = {'task_name': '', 'status': '', 'action': '', 'created': 0}
+    SORT_FIELDS = ('created', 'updated', 'task_name', 'status')
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS task_fields ('
+        'task_id TEXT NOT NULL, field TEXT NOT NULL, value TEXT, '
+        'PRIMARY KEY (task_id, field)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS progress ('
+        'task_id TEXT NOT NULL, seq INTEGER NOT NULL, line TEXT, '
+        'PRIMARY KEY (task_id, seq)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS task_index ('
+        'task_id TEXT PRIMARY KEY, task_name TEXT, status TEXT, action TEXT, created REAL, updated REAL)',
+        'CREATE INDEX IF NOT EXISTS task_index_status ON task_index (status)',
+        'CREATE INDEX IF NOT EXISTS task_index_created ON task_index (created, task_id)',
+        'CREATE INDEX IF NOT EXISTS task_index_updated ON task_index (updated, task_id)',
+        'CREATE INDEX IF NOT EXISTS task_index_name ON task_index (task_name, task_id)'
+    )
+
+    def clear(self):
+        self._write([('DELETE FROM task_fields', [()]), ('DELETE FROM progress', [()]),
+                     ('DELETE FROM task_index', [()])])
+
+    def _index_statements(self, task_id, fields):
+        """ Statements updating the summary row with the summary fields among the given ones. """
+        summary = [field for field in self.SUMMARY_FIELDS if field in fields]
+        if not summary:
+            return []
+        assignments = ''.join(f'{field} = ?, ' for field in summary)
+        return [('INSERT OR IGNORE INTO task_index (task_id) VALUES (?)', [(task_id,)]),
+                (f'UPDATE task_index SET {assignments}updated = ? WHERE task_id = ?',
+                 [tuple(self.SUMMARY_DEFAULTS[field] if fields[field] is None else fields[field]
+                        for field in summary) + (time.time(), task_id)])]
+
+    def __contains__(self, task_id):
+        return self.conn.execute('SELECT 1 FROM task_index WHERE task_id = ?', (task_id,)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM task_index').fetchone()[0]
+
+    def __getitem__(self, task_id):
+        record = self.get_fields(task_id)
+        if not record:
+            raise KeyError(task_id)
+        return record
+
+    def __setitem__(self, task_id, task_data):
+        self._write([
+            ('DELETE FROM task_fields WHERE task_id = ?', [(task_id,)]),
+            ('INSERT INTO task_fields (task_id, field, value) VALUES (?, ?, ?)',
+             [(task_id, field, json.dumps(value)) for field, value in task_data.items()]),
+            ('DELETE FROM task_index WHERE task_id = ?', [(task_id,)])
+        ] + self._index_statements(task_id, dict(self.SUMMARY_DEFAULTS, **task_data)))
+
+    def __delitem__(self, task_id):
+        self._write([('DELETE FROM task_fields WHERE task_id = ?', [(task_id,)]),
+                     ('DELETE FROM progress WHERE task_id = ?', [(task_id,)]),
+                     ('DELETE FROM task_index WHERE task_id = ?', [(task_id,)])])
+
+    def get(self, task_id, default=None):
+        return self.get_fields(task_id) or default
+
+    def keys(self):
+        return [row[0] for row in self.conn.execute('SELECT task_id FROM task_index ORDER BY task_id')]
+
+    def find(self, statuses):
+        """ IDs of the tasks in one of the given statuses, read from the index. """
+        statuses = list(statuses)
+        return [row[0] for row in self.conn.execute(
+            f'SELECT task_id FROM task_index WHERE status IN ({",".join("?" * len(statuses))}) ORDER BY created',
+            statuses)]
+
+    def count_by_status(self):
+        """ Number of tasks per status, read from the index. """
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM task_index GROUP BY status').fetchall())
+
+    def reindex(self):
+        """ Rebuilds the summary rows from the task fields. """
+        records = {}
+        for task_id, field, value in self.conn.execute('SELECT task_id, field, value FROM task_fields WHERE field IN '
+                                                       f'({",".join("?" * len(self.SUMMARY_FIELDS))})',
+                                                       self.SUMMARY_FIELDS):
+            records.setdefault(task_id, {})[field] = json.loads(value)
+        statements = [('DELETE FROM task_index', [()])]
+        for task_id in self.conn.execute('SELECT DISTINCT task_id FROM task_fields').fetchall():
+            statements += self._index_statements(task_id[0], dict(self.SUMMARY_DEFAULTS, **records.get(task_id[0], {})))
+        self._write(statements)
+
+    def page(self, limit, cursor=None, statuses=None, created_after=None, created_before=None, name=None,
+             sort='created', descending=True):
+        """
+        IDs of one page of tasks from the index, filtered by status, creation
+        time and a substring of the task name, ordered by one of SORT_FIELDS
+        and the task ID. Returns the IDs and the cursor of the next page, None
+        on the last one. The cursor holds the position of the last row, so the
+        pages stay stable while tasks are added or removed.
+        """
+        if sort not in self.SORT_FIELDS:
+            raise ValueError(f'cannot sort by {sort}')
+        conditions, params = [], []
+        if statuses:
+            statuses = list(statuses)
+            conditions.append(f'status IN ({",".join("?" * len(statuses))})')
+            params += statuses
+        if created_after is not None:
+            conditions.append('created >= ?')
+            params.append(created_after)
+        if created_before is not None:
+            conditions.append('created < ?')
+            params.append(created_before)
+        if name:
+            conditions.append("task_name LIKE ? ESCAPE '\\'")
+            params.append('%' + name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        order = '<' if descending else '>'
+        if cursor is not None:
+            try:
+                value, task_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            except (TypeError, ValueError):
+                raise ValueError('invalid cursor')
+            conditions.append(f'({sort} {order} ? OR ({sort} = ? AND task_id {order} ?))')
+            params += [value, value, task_id]
+        direction = 'DESC' if descending else 'ASC'
+        rows = self.conn.execute(
+            f'SELECT task_id, {sort} FROM task_index WHERE {" AND ".join(conditions) or "1"} '
+            f'ORDER BY {sort} {direction}, task_id {direction} LIMIT ?', params + [limit + 1]).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = base64.urlsafe_b64encode(json.dumps([rows[-1][1], rows[-1][0]]).encode()).decode()
+        return [row[0] for row in rows], next_cursor
+
+    def get_many(self, task_ids, fields=None, exclude=()):
+        """ Reads the given fields of several tasks, in the order of the IDs. """
+        task_ids = list(task_ids)
+        if not task_ids:
+            return []
+        records = {task_id: {} for task_id in task_ids}
+        sql, params = self._field_filter(f'SELECT task_id, field, value FROM task_fields '
+                                         f'WHERE task_id IN ({",".join("?" * len(task_ids))})', fields, exclude)
+        for task_id, field, value in self.conn.execute(sql, task_ids + params):
+            records[task_id][field] = json.loads(value)
+        return [records[task_id] for task_id in task_ids]
+
+    def values(self, exclude=()):
+        records = {}
+        sql, params = self._field_filter('SELECT task_id, field, value FROM task_fields WHERE 1', None, exclude)
+        for task_id, field, value in self.conn.execute(sql, params):
+            records.setdefault(task_id, {})[field] = json.loads(value)
+        return list(records.values())
+
+    @staticmethod
+    def _field_filter(sql, fields, exclude):
+        params = []
+        if fields is not None:
+            fields = list(fields)
+            sql += f' AND field IN ({",".join("?" * len(fields))})'
+            params += fields
+        if exclude:
+            sql += f' AND field NOT IN ({",".join("?" * len(exclude))})'
+            params += list(exclude)
+        return sql, params
+
+    def get_field(self, task_id, field, default=None):
+        row = self.conn.execute('SELECT value FROM task_fields WHERE task_id = ? AND field = ?',
+                                (task_id, field)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def get_fields(self, task_id, fields=None, exclude=()):
+        """ Reads the given fields of a task, or all fields except the excluded ones. """
+        sql, params = self._field_filter('SELECT field, value FROM task_fields WHERE task_id = ?', fields, exclude)
+        return {field: json.loads(value) for field, value in self.conn.execute(sql, [task_id] + params)}
+
+    def update(self, task_id, fields, unset=()):
+        """ Sets the given fields of a task and removes the unset ones, leaving all other fields untouched. """
+        if not fields and not unset:
+            return
+        self._write([('INSERT OR REPLACE INTO task_fields (task_id, field, value) VALUES (?, ?, ?)',
+                      [(task_id, field, json.dumps(value)) for field, value in fields.items()]),
+                     ('DELETE FROM task_fields WHERE task_id = ? AND field = ?', [(task_id, field) for field in unset])]
+                    + self._index_statements(task_id, dict(fields, **{field: None for field in unset})))
+
+    def append_progress(self, task_id, entries, capacity):
+        """ Adds (seq, line) entries to the progress ring of a task, dropping all but the last capacity lines. """
+        self._write([
+            ('INSERT OR REPLACE INTO progress (task_id, seq, line) VALUES (?, ?, ?)',
+             [(task_id, seq, line) for seq, line in entries]),
+            ('DELETE FROM progress WHERE task_id = ? AND seq <= ?', [(task_id, entries[-1][0] - capacity)])
+        ])
+
+    def read_progress(self, task_id, after, limit):
+        return self.conn.execute('SELECT seq, line FROM progress WHERE task_id = ? AND seq > ? '
+                                 'ORDER BY seq LIMIT ?', (task_id, after, limit)).fetchall()
+
+    def last_progress_seq(self, task_id):
+        row = self.conn.execute('SELECT MAX(seq) FROM progress WHERE task_id = ?', (task_id,)).fetchone()
+        return row[0] or 0
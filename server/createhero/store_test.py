@@ -0,0 +1,54 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from createhero.store import TaskStore
+
+
+class TaskStoreWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.tasks = TaskStore(os.path.join(self.directory, 'tasks.db'))
+        self.tasks['t1'] = {'status': 'submitted'}
+
+    def _lock(self):
+        """ Another connection holding the write lock. """
+        conn = sqlite3.connect(self.tasks.path, isolation_level=None, check_same_thread=False)
+        conn.execute('BEGIN IMMEDIATE')
+        self.addCleanup(conn.close)
+        return conn
+
+    def test_write_retried_while_locked(self):
+        conn = self._lock()
+        threading.Timer(0.4, conn.execute, ['ROLLBACK']).start()
+        self.tasks.update('t1', {'status': 'running'})
+        self.assertEqual(self.tasks.get_field('t1', 'status'), 'running')
+
+    def test_write_gives_up(self):
+        self._lock()
+        with mock.patch.object(TaskStore, 'WRITE_ATTEMPTS', 2), mock.patch.object(TaskStore, 'BUSY_TIMEOUT', 0.05):
+            store = TaskStore(self.tasks.path)
+            start = time.time()
+            with self.assertRaises(sqlite3.OperationalError):
+                store.update('t1', {'status': 'running'})
+            # bounded by the attempts, not waiting for the lock to be released
+            self.assertLess(time.time() - start, 1)
+        self.assertFalse(store.conn.in_transaction)
+
+    def test_failed_write_is_rolled_back(self):
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.tasks._write([('INSERT INTO task_fields (task_id, field, value) VALUES (?, ?, ?)',
+                                [('t1', 'name', '"a"'), ('t1', 'name', '"b"')])])
+        self.assertFalse(self.tasks.conn.in_transaction)
+        self.assertIsNone(self.tasks.get_field('t1', 'name'))
+
+
+if __name__ == '__main__':
+    unittest.main()
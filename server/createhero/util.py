@@ -1,44 +1,21 @@
-import subprocess
-import threading
+from .cache import link_file
+from .fanout import fan_out_graph_file
+from .graph_runner import GraphUnavailable
+from .journal import TaskJournal
+from .probe import ProbeError, probe_keyframes, probe_media
+from .progress import ProgressLog, ProgressStats
+from .retention import intermediate_files, remove_file
+from .segments import plan_segments, write_concat_list
+
+import asyncio
+from contextlib import contextmanager
+import copy
 import os
-import queue
-import json
 import logging
-import re
+import shutil
 import time
 
 
-class AsynchronousFileReader(threading.Thread):
-    """
-    Helper class to implement asynchronous reading of a file
-    in a separate thread. Pushes read lines on a queue to
-    be consumed in another thread.
-    """
-
-    def __init__(self, fd, q):
-        assert isinstance(q, queue.Queue)
-        assert callable(fd.readline)
-        threading.Thread.__init__(self)
-        self._fd = fd
-        self._queue = q
-        self.log = logging.getLogger(__name__)
-
-    def set_source(self, fd):
-        assert callable(fd.readline)
-        self._fd = fd
-
-    def run(self):
-        """ The body of the tread: read lines and put them on the queue. """
-        self.log.debug('file reader running...')
-        for line in iter(self._fd.readline, b''):
-            # self.log.debug(f'putting on queue: {line}')
-            self._queue.put(line.decode())
-
-    def eof(self):
-        """ Check whether there is no more content to expect. """
-        return not self.is_alive() and self._queue.empty()
-
-
 class VideoReformatTask(object):
     FORMAT_1x1 = '1:1'
     FORMAT_16x9 = '16:9'
@@ -50,23 +27,63 @@ class VideoReformatTask(object):
     STATUS_SUCCESS = 'success'
     STATUS_STOPPED = 'stopped'
 
-    def __init__(self, task_id, working_base_dir, task_lib):
+    # take the audio straight from the input when muxing, or extract it to a file first
+    AUDIO_DIRECT = 'direct'
+    AUDIO_EXTRACT = 'extract'
+    # audio codecs that can be stream copied into the mp4 output
+    MP4_AUDIO_CODECS = ('aac', 'mp3', 'alac', 'ac3', 'eac3')
+
+    AUTOFLIP_BINARY = '/mediapipe/bazel-bin/mediapipe/examples/desktop/autoflip/run_autoflip'
+    AUTOFLIP_GRAPHS = '/mediapipe/mediapipe/examples/desktop/autoflip'
+    # bytes of subprocess output read at once
+    OUTPUT_CHUNK = 65536
+
+    def __init__(self, task_id, working_base_dir, task_lib, event_hub=None, options=None):
+        """
+        Options are the executor wide settings: audio_mode, the segment length
+        (segment_duration, 0 runs autoflip on the whole video) and lead-in
+        (segment_overlap) in seconds for splitting long videos into chunks, and
+        the graph_runner running graphs in-process instead of run_autoflip, the
+        result_cache successful results are added to, the storage the input
+        is fetched from and the results are put to, and the metrics the stage
+        durations and failures are counted in.
+        """
         self.log = logging.getLogger(__name__)
         self.task_id = task_id
         self.working_base_dir = working_base_dir
         self.task_lib = task_lib
-        self.duration = 100
+        self.event_hub = event_hub
+        options = options or {}
+        self.audio_mode = options.get('audio_mode', self.AUDIO_DIRECT)
+        self.segment_duration = options.get('segment_duration', 0)
+        self.segment_overlap = options.get('segment_overlap', 0)
+        self.graph_runner = options.get('graph_runner')
+        self.result_cache = options.get('result_cache')
+        self.storage = options.get('storage')
+        self.metrics = options.get('metrics')
+        if self.storage is not None and task_id in self.task_lib:
+            # worker nodes process the task in their own working directory, the input is fetched into it
+            os.makedirs(self.get_task_directory(), exist_ok=True)
+        self.journal = TaskJournal(self.get_task_directory())
         if task_id not in self.task_lib:
             self.task_data = {}
+            self._stored = {}
             self.read_status()
         else:
             self.task_data = self.task_lib[self.task_id]
+            # the fields as in the task store, store_task_data only writes the ones changed since
+            self._stored = copy.deepcopy(self.task_data)
+        self.duration = self.task_data.get('video_length', 100)
+        self.progress = ProgressLog(self.task_lib, self.task_id, self.get_task_directory(), hub=self.event_hub)
 
         if 'action' not in self.task_data:
             self.task_data['action'] = 'resize'
 
-        if 'progress' not in self.task_data:
-            self.task_data['progress'] = []
+        if 'progress' in self.task_data:
+            # task data written before the progress log existed
+            if not os.path.exists(self.progress.path):
+                self.progress.extend(self.task_data['progress'])
+            del self.task_data['progress']
 
         if 'target_quality' not in self.task_data:
             self.task_data['target_quality'] = 'high'
@@ -74,23 +91,21 @@ class VideoReformatTask(object):
         if 'target_size' not in self.task_data:
             self.task_data['target_size'] = 'original'
 
-        if self.task_data['status'] == self.STATUS_SUBMITTED:
-            self.initialize()
-            self.prepare()
-            self.set_status(self.STATUS_INIT)
         self.store_task_data()
 
-    def update_tasklib(self):
-        self.task_lib[self.task_id] = self.task_data
+    def update_tasklib(self, *fields):
+        """ Publishes the given fields to the shared task store and appends them to the journal. """
+        fields = {field: self.task_data[field] for field in fields}
+        self.task_lib.update(self.task_id, fields)
+        self.journal.update(fields)
+        self._stored.update(copy.deepcopy(fields))
 
     def get_task_directory(self):
         return os.path.join(self.working_base_dir, self.task_id)
 
     def read_status(self):
-        data_file = os.path.join(self.get_task_directory(), 'task_data')
-        if os.path.exists(data_file):
-            with open(data_file, 'r') as f:
-                self.task_data.update(json.load(f))
+        if self.journal.exists():
+            self.task_data.update(self.journal.load())
             # self.log.debug(f'read task data: {self.task_data}')
             if 'input_file' in self.task_data and os.path.isfile(self.task_data['input_file']):
                 self.task_data['input_file_size'] = os.path.getsize(self.task_data['input_file'])
@@ -102,7 +117,9 @@ class VideoReformatTask(object):
                     self.task_data['output_file_name'] = self.task_data['output_file'].split('/')[-1]
             else:
                 self.task_data['output_file_size'] = 0
-            self.update_tasklib()
+            # not in the store yet, publish the record as journaled
+            self.task_lib.update(self.task_id, self.task_data)
+            self._stored = copy.deepcopy(self.task_data)
         elif os.path.isdir(self.get_task_directory()):
             source_files = [f.name for f in os.scandir(self.get_task_directory()) if
                             f.is_file() and ('mp3' in f.name or 'mp4' in f.name)]
@@ -118,123 +135,572 @@ class VideoReformatTask(object):
             self.set_status(self.STATUS_SUBMITTED)
         if 'task_name' not in self.task_data:
             self.task_data['task_name'] = 'task_' + self.task_id
+        if 'created' not in self.task_data and os.path.isdir(self.get_task_directory()):
+            self.task_data['created'] = os.path.getmtime(self.get_task_directory())
 
     def set_status(self, status):
         self.task_data['status'] = status
         self.log.debug(f'setting task_data status to {status}')
-        self.update_tasklib()
+        self.update_tasklib('status')
+        if self.event_hub is not None:
+            self.event_hub.publish(self.task_id, {'type': 'status', 'status': status})
 
     def store_task_data(self):
-        with open(os.path.join(self.get_task_directory(), 'task_data'), 'w') as f:
-            json.dump(self.task_data, f)
-        self.update_tasklib()
+        """
+        Journals and publishes the fields the task changed since they were last
+        stored. Fields other processes set meanwhile, like captions, are left
+        as they are.
+        """
+        changed = {field: value for field, value in self.task_data.items()
+                   if field not in self._stored or self._stored[field] != value}
+        removed = [field for field in self._stored if field not in self.task_data]
+        self.journal.update(changed, removed)
+        self.task_lib.update(self.task_id, changed, removed)
+        self._stored = copy.deepcopy(self.task_data)
+
+    def target_formats(self):
+        """ Output formats of the task, a single None for actions without a target format. """
+        if 'flip' not in self.task_data['action']:
+            return [None]
+        return self.task_data.get('target_formats') or [self.task_data['target_format']]
+
+    def get_outputs(self):
+        """ One dict per output format, the first output also is the output_file of the task. """
+        if self.task_data.get('outputs'):
+            return self.task_data['outputs']
+        # task data written before tasks had several outputs
+        return [{
+            'target_format': self.task_data.get('target_format'),
+            'output_file_name': self.task_data.get('output_file_name'),
+            'output_file': self.task_data.get('output_file'),
+            'output_file_no_audio': self.task_data.get('output_file_no_audio')
+        }]
 
     def initialize(self):
         input_file_name, input_ext = os.path.splitext(self.task_data['input_file_name'])
-        output_file_name_prefix = input_file_name + '_' + self.task_data['target_quality'] + '_quality'
-        output_file_name_prefix += '_' + self.task_data['target_size'] + '_size'
-        if 'flip' in self.task_data['action']:
-            output_file_name_prefix += self.task_data['target_format'].replace(':', '_')
-        output_file_name = output_file_name_prefix + input_ext
-        self.task_data['output_file_name'] = output_file_name
         input_file = os.path.join(self.get_task_directory(), self.task_data['input_file_name'])
         self.task_data['input_file'] = input_file
         self.task_data['input_file_size'] = os.path.getsize(input_file)
-        output_file = os.path.join(self.get_task_directory(), output_file_name)
-        self.task_data['output_file'] = output_file
+        outputs = []
+        for target_format in self.target_formats():
+            output_file_name_prefix = input_file_name + '_' + self.task_data['target_quality'] + '_quality'
+            output_file_name_prefix += '_' + self.task_data['target_size'] + '_size'
+            if target_format is not None:
+                output_file_name_prefix += target_format.replace(':', '_')
+            outputs.append({
+                'target_format': target_format,
+                'output_file_name': output_file_name_prefix + input_ext,
+                'output_file': os.path.join(self.get_task_directory(), output_file_name_prefix + input_ext),
+                'output_file_no_audio': os.path.join(self.get_task_directory(),
+                                                     output_file_name_prefix + '_no_audio' + input_ext)
+            })
+        self.task_data['outputs'] = outputs
+        for field in ('output_file_name', 'output_file', 'output_file_no_audio'):
+            self.task_data[field] = outputs[0][field]
 
         audio_file = os.path.join(self.get_task_directory(), input_file_name + '.mp3')
         self.task_data['audio_file'] = audio_file
         input_no_audio = os.path.join(self.get_task_directory(), input_file_name + '_no_audio' + input_ext)
         self.task_data['input_file_no_audio'] = input_no_audio
-        output_no_audio = os.path.join(self.get_task_directory(),
-                                       output_file_name_prefix + '_no_audio' + input_ext)
-        self.task_data['output_file_no_audio'] = output_no_audio
-
-    def prepare(self):
-        # extract audio from source
-        extract_process = subprocess.run(['ffmpeg', '-nostats', '-loglevel', '0', '-i', self.task_data['input_file'],
-                                          '-vn', '-f', 'adts', self.task_data['audio_file']],
-                                         capture_output=True, text=True)
-        self.task_data['progress'].extend(extract_process.stdout.splitlines(keepends=True))
-        self.update_tasklib()
-
-        # get video length
-        vid_length_process = subprocess.Popen(['ffmpeg', '-i', self.task_data['input_file']],
-                                              stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-        extract_duration_process = subprocess.Popen(['grep', 'Duration'],
-                                                    stdin=vid_length_process.stdout, stdout=subprocess.PIPE)
-        vid_length_process.wait()
-        dur_string = extract_duration_process.stdout.readline().decode().strip()
-        m = re.match(r'Duration: (\d{2}):(\d{2}):(\d{2})\.(\d{2}),.*', dur_string)
-        if m.groups():
-            (hours, minutes, seconds, hundredths) = map(int, m.groups())
-            self.duration = hours * 3600 + minutes * 60 + seconds + hundredths / 100
+
+    async def _run_process(self, command, env=None, timeout=None, line_callback=None):
+        """
+        Runs the command as asyncio subprocess, stderr routed to stdout. Output
+        lines are added to the task progress while they arrive and handed to the
+        line callback. Returns the exit code, the process gets killed if it
+        exceeds the given timeout or the call is cancelled.
+        """
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.STDOUT, env=env)
+        try:
+            await asyncio.wait_for(self._read_output(process, line_callback), timeout)
+        except asyncio.TimeoutError:
+            self.log.warning(f'[{self.task_id}] {command[0]} exceeded {timeout}s, killing it')
+            process.kill()
+        except asyncio.CancelledError:
+            # nobody waits for the result anymore
+            process.kill()
+            await process.wait()
+            raise
+        status = await process.wait()
+        if status != 0:
+            self.count_failure(os.path.basename(command[0]))
+        return status
+
+    def count_failure(self, program):
+        if self.metrics is not None:
+            self.metrics.inc('createhero_subprocess_failures_total', program=program)
+
+    @contextmanager
+    def stage(self, name, **details):
+        """
+        Times a processing stage of the task, recorded in task_data['timings']
+        with the details given. The start is wall clock time to line the stages
+        up with the ones of other processes, the duration is measured on the
+        monotonic clock.
+        """
+        start = time.time()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - started
+            self.add_timing(dict(details, stage=name, start=start, end=start + duration))
+            if self.metrics is not None:
+                self.metrics.observe('createhero_stage_seconds', duration, stage=name)
+
+    @staticmethod
+    def kept_timings(task_data):
+        """ The timings a new run of the task starts with, the stages of an earlier run do not belong to it. """
+        return [timing for timing in task_data.get('timings', []) if timing['stage'] == 'upload']
+
+    def add_timing(self, timing):
+        self.task_data.setdefault('timings', []).append(timing)
+        self.update_tasklib('timings')
+
+    def record_queue_wait(self):
+        """
+        Records the time since the task was queued, or since its last stage
+        ended if that was later, as queue wait.
+        """
+        now = time.time()
+        since = max([self.task_data.get('enqueued') or self.task_data.get('created') or now] +
+                    [timing['end'] for timing in self.task_data.get('timings', [])])
+        if now > since:
+            self.add_timing({'stage': 'queue', 'start': since, 'end': now})
+
+    async def _read_output(self, process, line_callback=None):
+        """
+        Reads the output a chunk at a time, the lines of a chunk are added to
+        the progress log together.
+        """
+        partial = b''
+        while True:
+            data = await process.stdout.read(self.OUTPUT_CHUNK)
+            if not data:
+                break
+            lines = (partial + data).split(b'\n')
+            partial = lines.pop()
+            if len(partial) > self.OUTPUT_CHUNK:
+                # no line end in sight, log what is there
+                lines.append(partial)
+                partial = b''
+            self._log_output(lines, line_callback)
+        if partial:
+            self._log_output([partial], line_callback)
+        await process.wait()
+
+    def _log_output(self, lines, line_callback=None):
+        lines = [line.decode(errors='replace') + '\n' for line in lines]
+        self.progress.extend(lines)
+        if line_callback is not None:
+            for line in lines:
+                line_callback(line)
+
+    async def prepare(self):
+        """
+        Preparation stage of a submitted task, awaited by the executor before
+        the task waits for a worker slot. Only probes the input, the audio
+        extraction of the extract mode overlaps with the autoflip run instead.
+        """
+        if self.task_data['status'] != self.STATUS_SUBMITTED:
+            return
+        self.task_data['timings'] = self.kept_timings(self.task_data)
+        self.record_queue_wait()
+        if self.storage is not None:
+            input_file = os.path.join(self.get_task_directory(), self.task_data['input_file_name'])
+            if not os.path.exists(input_file):
+                with self.stage('fetch'):
+                    self.storage.fetch(self.task_id, self.task_data['input_file_name'], input_file)
+        self.initialize()
+        self.task_data['audio_mode'] = self.audio_mode
+        # a fresh run, nothing of an earlier one is reused
+        self.task_data['checkpoints'] = {}
+        self.task_data.pop('segments', None)
+
+        # get video length, frame rate and frame count
+        try:
+            with self.stage('probe'):
+                probe = await probe_media(self.task_data['input_file'], self.get_task_directory(),
+                                          self.task_data.get('input_hash'))
+        except ProbeError as e:
+            self.log.warning(f'[{self.task_id}] {e}')
+            self.count_failure('ffprobe')
+            probe = {}
+        self.task_data['probe'] = probe
+        if probe.get('duration'):
+            self.duration = probe['duration']
             self.task_data['video_length'] = self.duration
-            self.update_tasklib()
-        # strip audio off of input source
-        # stripoff_process = subprocess.run(['ffmpeg', '-i', self.task_data['input_file'], '-c:v', 'copy', '-an', self.task_data['input_file_no_audio']], capture_output=True, text=True)
-        # self.task_data['progress'].extend(stripoff_process.stdout.splitlines(keepends=True))
-        # self.update_tasklib()
+        if probe.get('fps'):
+            self.task_data['video_fps'] = probe['fps']
+        if probe.get('frame_count'):
+            self.task_data['frames_total'] = probe['frame_count']
+        self.set_status(self.STATUS_INIT)
+        self.store_task_data()
 
-    async def start(self):
+    def reclaim(self):
+        """
+        Takes over a task an executor stopped working on, a crashed one or this
+        one before a restart. An interrupted run starts over from the prepared
+        state, a task prepared on another node is prepared again, as its paths
+        point into the working directory of that node.
+        """
+        if self.task_data['status'] == self.STATUS_RUNNING:
+            self.set_status(self.STATUS_INIT)
+        if self.task_data['status'] == self.STATUS_INIT and not os.path.exists(self.task_data.get('input_file', '')):
+            self.set_status(self.STATUS_SUBMITTED)
+
+    def checkpoint(self, stage, value=True):
+        """
+        Records a completed stage right away, so a run resumed after a crash
+        or restart skips it. Checkpoints are kept until the task is prepared
+        again.
+        """
+        self.task_data.setdefault('checkpoints', {})[stage] = value
+        self.update_tasklib('checkpoints')
+
+    def passed(self, stage, *files):
+        """ Whether the stage completed in an earlier run and the files it produced are still there. """
+        return bool(self.task_data.get('checkpoints', {}).get(stage)) and all(os.path.exists(f) for f in files)
+
+    async def extract_audio(self):
+        """ Extracts the audio track to the intermediate audio file, returns the exit code. """
+        if self.passed('audio', self.task_data['audio_file']):
+            return 0
+        with self.stage('extract'):
+            status = await self._run_process(['ffmpeg', '-nostats', '-loglevel', '0', '-y', '-i',
+                                              self.task_data['input_file'], '-vn', '-f', 'adts',
+                                              self.task_data['audio_file']])
+        if status == 0:
+            self.checkpoint('audio')
+        return status
+
+    async def start(self, pool=None):
+        """
+        Runs autoflip and finishes the task. Long videos are split into
+        segments when enabled, the chunks run in parallel on the additional
+        slots they get from the worker pool.
+        """
         if self.task_data['status'] != self.STATUS_INIT:
             return "Task not yet initialized."
+        self.record_queue_wait()
+        extraction = None
+        if self.task_data.get('audio_mode', self.AUDIO_EXTRACT) == self.AUDIO_EXTRACT:
+            # only the final mux needs the audio, extract it while autoflip runs
+            extraction = asyncio.ensure_future(self.extract_audio())
+        self.stats = ProgressStats(self.task_data.get('frames_total'), self.task_data.get('video_fps'))
+        self.set_status(self.STATUS_RUNNING)
+        self.publish_stats()
+        cropped_files = [output['output_file_no_audio'] for output in self.get_outputs()]
+        try:
+            if self.passed('cropped', *cropped_files):
+                self.log.info(f'[{self.task_id}] resuming with the cropped videos of an earlier run')
+                self.stats.complete()
+                status = 0
+            else:
+                segments = await self._plan_segments()
+                if segments:
+                    status = await self._run_segments(segments, pool)
+                else:
+                    with self.stage('autoflip'):
+                        status = await self._run_autoflip(self.task_data['input_file'], cropped_files,
+                                                          timeout=4 * self.duration)
+                if status == 0:
+                    self.checkpoint('cropped')
+            if extraction is not None:
+                extraction_status = await extraction
+                status = status or extraction_status
+        finally:
+            if extraction is not None and not extraction.done():
+                # the run failed, the audio is not needed anymore
+                extraction.cancel()
+                await asyncio.gather(extraction, return_exceptions=True)
+        await self.finish(status)
+
+    @classmethod
+    def graph_file_for(cls, task_data):
         # find graph description
-        graph_filename = f'{self.task_data["target_size"]}.pbtxt'
-        graph_path = os.path.join('scenarios', self.task_data['action'], graph_filename)
-        # prepare call to subprocess
-        command = ['/mediapipe/bazel-bin/mediapipe/examples/desktop/autoflip/run_autoflip',
-                   f'--calculator_graph_config_file=/mediapipe/mediapipe/examples/desktop/autoflip/{graph_path}',
-                   f'--input_side_packets=input_video_path={self.task_data["input_file"]},'
-                   f'output_video_path={self.task_data["output_file_no_audio"]}'
-                   ]
-        if self.task_data['target_quality'] and 'adjusted' in self.task_data['target_size']:
-            command[-1] += f',target_height={self.task_data["target_quality"]}'
+        graph_filename = f'{task_data["target_size"]}.pbtxt'
+        return os.path.join(cls.AUTOFLIP_GRAPHS, 'scenarios', task_data['action'], graph_filename)
+
+    def _graph_file(self):
+        graph_file = self.graph_file_for(self.task_data)
+        count = len(self.get_outputs())
+        if count > 1:
+            # one decoding and analysis pass, branching into the crop and encoder of every format
+            return fan_out_graph_file(graph_file, count, os.path.join(self.working_base_dir, '.graphs'))
+        return graph_file
 
+    def _side_packets(self, input_file, output_files):
+        side_packets = {'input_video_path': input_file}
+        outputs = self.get_outputs()
+        if len(outputs) == 1:
+            side_packets['output_video_path'] = output_files[0]
+        else:
+            for i, output_file in enumerate(output_files):
+                side_packets[f'output_video_path_{i}'] = output_file
+        if self.task_data['target_quality'] and 'adjusted' in self.task_data['target_size']:
+            side_packets['target_height'] = self.task_data['target_quality']
         if 'flip' in self.task_data['action']:
-            command[-1] += f',aspect_ratio={self.task_data["target_format"]}'
+            if len(outputs) == 1:
+                side_packets['aspect_ratio'] = outputs[0]['target_format']
+            else:
+                for i, output in enumerate(outputs):
+                    side_packets[f'aspect_ratio_{i}'] = output['target_format']
+        return side_packets
+
+    async def _run_autoflip(self, input_file, output_files, timeout, part=0):
+        """
+        Runs the scenario graph on the input, writing one file per output
+        format. Runs in a graph worker if there is a graph runner, otherwise
+        as run_autoflip subprocess. Returns the exit code.
+        """
+        side_packets = self._side_packets(input_file, output_files)
+        if self.graph_runner is not None and self.graph_runner.supports(self._graph_file()):
+            self.log.debug(f'[{self.task_id}] running graph {self._graph_file()} with {side_packets}')
+            try:
+                status = await self.graph_runner.run(self._graph_file(), side_packets, timeout=timeout,
+                                                     on_progress=lambda frames: self._on_graph_progress(frames, part))
+                if status != 0:
+                    self.count_failure('graph_runner')
+                return status
+            except GraphUnavailable as e:
+                self.log.warning(f'[{self.task_id}] falling back to run_autoflip, {e}')
+        # prepare call to subprocess
+        command = [self.AUTOFLIP_BINARY, f'--calculator_graph_config_file={self._graph_file()}',
+                   '--input_side_packets=' + ','.join(f'{name}={value}' for name, value in side_packets.items())]
         self.log.debug(f'[{self.task_id}] starting command {command}')
+        return await self._run_process(command, env=self._autoflip_env(), timeout=timeout,
+                                       line_callback=lambda line: self._on_autoflip_output(line, part))
+
+    @staticmethod
+    def _autoflip_env():
         # Launch the command as subprocess, route stderr to stdout
         my_env = os.environ.copy()
         my_env['GLOG_logtostderr'] = "1"
-        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=my_env)
-        self.process_start_time = time.time()
-        log_reader_queue = queue.Queue()
-        log_reader = AsynchronousFileReader(self.process.stdout, log_reader_queue)
-        log_reader.start()
-        self.log.debug('log reader is running')
-        self.set_status(self.STATUS_RUNNING)
-        self.log.debug(f'[{self.task_id}] process started')
-        while not self.is_finished():
-            while not log_reader_queue.empty():
-                cur_line = log_reader_queue.get()
-                self.task_data['progress'].append(cur_line)
-                # make changes available in managed dict but do not write
-                self.update_tasklib()
-
-    def is_finished(self):
-        status = self.process.poll()
-        cur_duration = time.time() - self.process_start_time
-        if cur_duration > 4 * self.duration:
-            self.process.kill()
-            status = 1
-        if status is not None:
-            # rejoin video and audio
-            join_process = subprocess.run(['ffmpeg', '-nostats', '-loglevel', '0', '-i',
-                                           self.task_data['output_file_no_audio'], '-i', self.task_data['audio_file'],
-                                           '-c', 'copy', '-map', '0:v:0', '-map', '1:a:0',
-                                           self.task_data['output_file']], capture_output=True, text=True)
-            self.task_data['progress'].extend(join_process.stdout.splitlines(keepends=True))
-            # Close subprocess' file descriptors.
-            if self.process.stdout:
-                self.process.stdout.close()
-            if status == 0:
-                self.set_status(self.STATUS_SUCCESS)
-                self.task_data['output_file_size'] = os.path.getsize(self.task_data['output_file'])
+        # the scene cropper logs every processed scene, which drives the progress stats
+        my_env['GLOG_vmodule'] = "scene_cropping_calculator=1"
+        return my_env
+
+    async def _plan_segments(self):
+        """
+        Splits the input at keyframes if segmenting is enabled and the video is
+        long enough. A resumed run keeps the segments it started with, the
+        checkpoints refer to them.
+        """
+        if self.task_data.get('segments'):
+            return self.task_data['segments']
+        if not self.segment_duration or self.duration < 2 * self.segment_duration:
+            return None
+        try:
+            keyframes = await probe_keyframes(self.task_data['input_file'], self.get_task_directory(),
+                                              self.task_data.get('input_hash'))
+        except ProbeError as e:
+            self.log.warning(f'[{self.task_id}] not segmenting, {e}')
+            self.count_failure('ffprobe')
+            return None
+        segments = plan_segments(keyframes, self.duration, self.segment_duration, self.segment_overlap)
+        if len(segments) < 2:
+            return None
+        self.task_data['segments'] = segments
+        self.update_tasklib('segments')
+        self.log.info(f'[{self.task_id}] processing {len(segments)} segments')
+        return segments
+
+    def _segment_file(self, kind, segment, output=None):
+        suffix = '' if output is None else f'_{output}'
+        return os.path.join(self.get_task_directory(), 'segments', f'{kind}_{segment["index"]:04d}{suffix}.mp4')
+
+    async def _run_segments(self, segments, pool=None):
+        """
+        Runs autoflip on every segment, then joins the cropped chunks. The
+        worker slot of the task processes chunks right away, helpers waiting
+        for further pool slots join in when they get one. Returns the exit code.
+        """
+        os.makedirs(os.path.join(self.get_task_directory(), 'segments'), exist_ok=True)
+        done = set(self.task_data.get('checkpoints', {}).get('segments', []))
+        pending = []
+        for segment in segments:
+            if segment['index'] in done and all(os.path.exists(path) for path in self._segment_outputs(segment)):
+                if self.stats.video_fps:
+                    self.stats.resume(int((segment['end'] - segment['start']) * self.stats.video_fps),
+                                      segment['index'])
             else:
-                self.set_status(self.STATUS_STOPPED)
-            self.update_tasklib()
-            self.store_task_data()
-            return True
-        return False
+                pending.append(segment)
+        if len(pending) < len(segments):
+            self.log.info(f'[{self.task_id}] resuming, {len(segments) - len(pending)} segments done before')
+        failed = []
+        working = set()
+
+        async def run_chunks():
+            while pending and not failed:
+                segment = pending.pop(0)
+                try:
+                    with self.stage('segment', segment=segment['index']):
+                        status = await self._run_segment(segment)
+                except Exception:
+                    # a helper getting the slot freed by the error must not start on another chunk
+                    failed.append(None)
+                    raise
+                if status != 0:
+                    failed.append(status)
+                else:
+                    done.add(segment['index'])
+                    self.checkpoint('segments', sorted(done))
+
+        async def help_with_chunks(helper):
+            async with pool.slot(f'{self.task_id}#{helper}'):
+                working.add(helper)
+                await run_chunks()
+
+        async def own_chunks():
+            await run_chunks()
+            # helpers that never got a slot are not needed anymore
+            for i, helper in enumerate(helpers, 1):
+                if i not in working:
+                    helper.cancel()
+
+        with self.stage('autoflip'):
+            # the slot of the task starts on the first chunk
+            runners = [asyncio.ensure_future(own_chunks())]
+            helpers = []
+            if pool is not None:
+                helpers = [asyncio.ensure_future(help_with_chunks(i)) for i in range(1, len(pending))]
+            runners += helpers
+            try:
+                # all done, or one of them raised
+                finished, _ = await asyncio.wait(runners, return_when=asyncio.FIRST_EXCEPTION)
+            finally:
+                # after an error, none of the helpers keeps its slot or goes on cutting chunks
+                for runner in runners:
+                    runner.cancel()
+                await asyncio.gather(*runners, return_exceptions=True)
+            for runner in runners:
+                if runner in finished and not runner.cancelled() and runner.exception() is not None:
+                    raise runner.exception()
+        if failed:
+            return failed[0]
+        with self.stage('join'):
+            return await self._join_segments(segments)
+
+    async def _run_segment(self, segment):
+        chunk = self._segment_file('input', segment)
+        length = segment['end'] - segment['input_start']
+        # the chunk starts at a keyframe, so it can be cut without re-encoding
+        status = await self._run_process(['ffmpeg', '-nostats', '-loglevel', '0', '-y',
+                                          '-ss', f'{segment["input_start"]:.3f}', '-i', self.task_data['input_file'],
+                                          '-t', f'{length:.3f}', '-map', '0:v:0', '-c', 'copy',
+                                          '-avoid_negative_ts', 'make_zero', chunk])
+        if status != 0:
+            return status
+        return await self._run_autoflip(chunk, self._segment_outputs(segment), timeout=max(4 * length, 120),
+                                        part=segment['index'])
+
+    def _segment_outputs(self, segment):
+        return [self._segment_file('output', segment, i) for i in range(len(self.get_outputs()))]
+
+    async def _join_segments(self, segments):
+        """ Concatenates the cropped chunks of every output without re-encoding, dropping the lead-ins. """
+        for i, output in enumerate(self.get_outputs()):
+            list_file = os.path.join(self.get_task_directory(), 'segments', f'concat_{i}.txt')
+            write_concat_list(list_file, [self._segment_file('output', s, i) for s in segments],
+                              [s['lead_in'] for s in segments])
+            status = await self._run_process(['ffmpeg', '-nostats', '-loglevel', '0', '-y', '-f', 'concat',
+                                              '-safe', '0', '-i', list_file, '-c', 'copy',
+                                              output['output_file_no_audio']])
+            if status != 0:
+                return status
+        return 0
+
+    def _on_autoflip_output(self, line, part=0):
+        if self.stats.feed(line, part):
+            self.publish_stats()
+
+    def _on_graph_progress(self, frames, part=0):
+        self.progress.append(f'{frames} frames encoded\n')
+        if self.stats.update(frames, part):
+            self.publish_stats()
+
+    def publish_stats(self):
+        self.task_data['progress_stats'] = self.stats.to_dict()
+        self.update_tasklib('progress_stats')
+        if self.event_hub is not None:
+            self.event_hub.publish(self.task_id, {'type': 'stats', 'stats': self.task_data['progress_stats']})
+
+    async def mux_audio(self, output):
+        """ Adds the audio track to the cropped video of the output, producing its final output file. """
+        probe = self.task_data.get('probe') or {}
+        # tasks prepared before the audio mode existed have their audio extracted
+        if self.task_data.get('audio_mode', self.AUDIO_EXTRACT) == self.AUDIO_EXTRACT:
+            audio_source, audio_codec = self.task_data['audio_file'], 'copy'
+        elif probe and probe.get('audio_codec') is None:
+            # silent input, the cropped video already is the output
+            os.replace(output['output_file_no_audio'], output['output_file'])
+            return 0
+        else:
+            audio_source = self.task_data['input_file']
+            audio_codec = 'copy' if probe.get('audio_codec') in self.MP4_AUDIO_CODECS else 'aac'
+        return await self._run_process(['ffmpeg', '-nostats', '-loglevel', '0', '-y',
+                                        '-i', output['output_file_no_audio'], '-i', audio_source,
+                                        '-map', '0:v:0', '-map', '1:a:0?', '-c:v', 'copy', '-c:a', audio_codec,
+                                        output['output_file']])
+
+    async def finish(self, status):
+        outputs = self.get_outputs()
+        with self.stage('mux'):
+            for output in outputs:
+                if status != 0:
+                    break
+                status = await self.mux_audio(output)
+        if status == 0:
+            self.stats.complete()
+            self.publish_stats()
+            result_keys = self.task_data.get('result_keys') or []
+            for output, result_key in zip(outputs, result_keys + [None] * len(outputs)):
+                if self.storage is not None:
+                    output['output_file'] = self.storage.put(self.task_id, output['output_file_name'],
+                                                             output['output_file'])
+                output['output_file_size'] = os.path.getsize(output['output_file'])
+                if self.result_cache is not None and result_key:
+                    self.result_cache.add_result(result_key, output['output_file'])
+            self.task_data['output_file'] = outputs[0]['output_file']
+            self.task_data['output_file_size'] = outputs[0]['output_file_size']
+            self.set_status(self.STATUS_SUCCESS)
+            if self.metrics is not None and self.task_data.get('created'):
+                self.metrics.observe('createhero_task_seconds', time.time() - self.task_data['created'])
+            self.remove_intermediates()
+        else:
+            self.set_status(self.STATUS_STOPPED)
+        self.progress.close()
+        self.store_task_data()
+        self.journal.compact()
+
+    def abort(self):
+        """ Stops the task after its run failed with an error, it can be restarted like any stopped task. """
+        self.set_status(self.STATUS_STOPPED)
+        self.progress.close()
+        self.store_task_data()
+        self.journal.compact()
+
+    def remove_intermediates(self):
+        """ Deletes the files only needed while the task runs, once it succeeded. """
+        freed = sum(remove_file(path) for path in intermediate_files(self.task_data))
+        segments_dir = os.path.join(self.get_task_directory(), 'segments')
+        if os.path.isdir(segments_dir):
+            shutil.rmtree(segments_dir)
+        self.task_data['checkpoints'] = {}
+        self.log.debug(f'[{self.task_id}] removed intermediates, {freed} bytes freed')
+
+    def use_cached_result(self, cached_outputs):
+        """ Finishes a submitted task right away with the results of identical earlier tasks, one per output. """
+        self.initialize()
+        for output, cached_output in zip(self.get_outputs(), cached_outputs):
+            link_file(cached_output, output['output_file'])
+            output['output_file_size'] = os.path.getsize(output['output_file'])
+        self.task_data['output_file_size'] = self.get_outputs()[0]['output_file_size']
+        self.task_data['cached'] = True
+        self.progress.append('Identical task found, using the cached result\n')
+        self.set_status(self.STATUS_SUCCESS)
+        self.progress.close()
+        self.store_task_data()
+        self.journal.compact()
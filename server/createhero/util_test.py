@@ -0,0 +1,112 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from createhero.app import WorkerPool
+from createhero.progress import ProgressStats
+from createhero.store import TaskStore
+from createhero.util import VideoReformatTask
+
+
+class VideoReformatTaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.tasks = TaskStore(os.path.join(self.directory, 'tasks.db'))
+
+    def _task(self, options=None, **fields):
+        task_id = 't1'
+        os.makedirs(os.path.join(self.directory, task_id))
+        with open(os.path.join(self.directory, task_id, 'input.mp4'), 'wb') as f:
+            f.write(b'video')
+        self.tasks[task_id] = dict({'status': VideoReformatTask.STATUS_INIT, 'task_name': task_id,
+                                    'action': 'resize', 'input_file_name': 'input.mp4',
+                                    'target_quality': 'high', 'target_size': 'original'}, **fields)
+        task = VideoReformatTask(task_id, self.directory, self.tasks, options=options)
+        task.initialize()
+        return task
+
+    def test_failed_run_cancels_audio_extraction(self):
+        task = self._task(audio_mode=VideoReformatTask.AUDIO_EXTRACT)
+        extraction = {}
+
+        async def extract_audio():
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                extraction['cancelled'] = True
+                raise
+
+        async def run_autoflip(*args, **kwargs):
+            await asyncio.sleep(0)
+            raise OSError('run_autoflip not found')
+
+        async def run():
+            with self.assertRaises(OSError):
+                await task.start()
+            # cancelled and awaited before start returned, not when the loop shuts down
+            self.assertTrue(extraction.get('cancelled'))
+
+        with mock.patch.object(task, 'extract_audio', extract_audio), \
+                mock.patch.object(task, '_run_autoflip', run_autoflip):
+            asyncio.run(run())
+
+    def _run_segments(self, failing, pool_size=3):
+        """
+        Runs four segments, the failing one raises shortly after it started,
+        the others take long. Returns the pool, the segments started and the
+        ones still running once _run_segments raised.
+        """
+        task = self._task()
+        task.stats = ProgressStats(None, None)
+        segments = [{'index': i, 'start': 10.0 * i, 'end': 10.0 * (i + 1), 'input_start': 10.0 * i, 'lead_in': 0}
+                    for i in range(4)]
+        pool = WorkerPool(pool_size, {})
+        started, running = [], set()
+
+        async def run_segment(segment):
+            started.append(segment['index'])
+            running.add(segment['index'])
+            try:
+                await asyncio.sleep(0.05 if segment['index'] == failing else 60)
+                if segment['index'] == failing:
+                    raise OSError('run_autoflip not found')
+                return 0
+            finally:
+                running.discard(segment['index'])
+
+        async def run():
+            with self.assertRaises(OSError):
+                await task._run_segments(segments, pool)
+            return set(running)
+
+        with mock.patch.object(task, '_run_segment', run_segment):
+            still_running = asyncio.run(run())
+        return pool, started, still_running
+
+    def test_failing_chunk_stops_helpers(self):
+        pool, started, still_running = self._run_segments(failing=0)
+        self.assertEqual(sorted(started), [0, 1, 2, 3])
+        self.assertEqual(still_running, set())
+        self.assertEqual(len(pool._idle), 3)
+        self.assertEqual(pool._waiters, {})
+
+    def test_failing_chunk_of_helper_stops_the_others(self):
+        pool, started, still_running = self._run_segments(failing=2)
+        self.assertEqual(still_running, set())
+        self.assertEqual(len(pool._idle), 3)
+
+    def test_failing_chunk_cancels_helpers_waiting_for_a_slot(self):
+        pool, started, still_running = self._run_segments(failing=0, pool_size=1)
+        self.assertEqual(sorted(started), [0, 1])
+        self.assertEqual(still_running, set())
+        self.assertEqual(len(pool._idle), 1)
+        self.assertEqual(pool._waiters, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
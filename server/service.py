@@ -1,4 +1,11 @@
-from createhero.app import CreateHeroAPI, TaskExecutor
+from createhero.app import CreateHeroAPI, TaskExecutor, repair_task_index
+from createhero.cache import ResultCache
+from createhero.events import EventHub
+from createhero.metrics import Metrics
+from createhero.retention import RetentionManager
+from createhero.scheduler import RunQueue
+from createhero.storage import LocalStorage
+from createhero.store import TaskStore
 
 from adhero_utils.handlers import GenericHandler
 
@@ -10,6 +17,7 @@ import logging
 import argparse
 import multiprocessing as mp
 import os
+import socket
 import base64
 import subprocess
 # from datadog import initialize
@@ -39,8 +47,14 @@ def main():
     logger = logging.getLogger('CreateHeroAPI')
     logging.getLogger('tornado.access').setLevel(general_log_level)
 
+    parser = argparse.ArgumentParser(description='CreateHero video reformatting service')
+    parser.add_argument('--repair', action='store_true',
+                        help='rebuild the task index from the task directories and exit')
+    parser.add_argument('--worker', action='store_true',
+                        help='only process tasks, claimed from the run queue in the shared STATE_DIRECTORY')
+    args = parser.parse_args()
+
     root_dir = os.path.dirname(os.path.abspath(__file__))
-    socket_external = tornado.netutil.bind_sockets(8888)
 
     with mp.Manager() as mgr:
         mgr.register("TaskExecutor", TaskExecutor)
@@ -54,20 +68,87 @@ def main():
         settings['documentation'] = os.path.dirname(os.path.abspath(__file__)) + '/swagger.yml'
         # create shared communication dict
         settings['task_queue'] = mgr.Queue()
-        settings['tasks'] = mgr.dict()
+        settings['working_directory'] = os.environ.get('WORKING_DIRECTORY', os.path.join(root_dir, 'static', 'video'))
+        # where inputs and results are kept, worker nodes mount it at the same path and work in their own directory
+        settings['storage'] = LocalStorage(os.environ.get('STORAGE_DIRECTORY', settings['working_directory']))
+        settings['state_directory'] = os.environ.get('STATE_DIRECTORY',
+                                                     os.path.join(settings['working_directory'], '.state'))
+        os.makedirs(settings['state_directory'], exist_ok=True)
+        # 'wal' if all processes using the state directory run on this host, 'delete' if worker nodes on other
+        # hosts share it over a network filesystem, the same on all of them
+        state_journal_mode = os.environ.get('STATE_JOURNAL_MODE', 'wal').lower()
+        # shared task store, persistent across restarts
+        settings['tasks'] = TaskStore(os.path.join(settings['state_directory'], 'tasks.db'), state_journal_mode)
+        if args.repair:
+            repair_task_index(settings['tasks'], settings['working_directory'])
+            return
+        # results of identical tasks are reused, the cache is kept below the quota (bytes, 0 disables it)
+        cache_quota = int(float(os.environ.get('CACHE_QUOTA', 2e10)))
+        if cache_quota > 0:
+            settings['result_cache'] = ResultCache(os.path.join(settings['state_directory'], 'cache.db'),
+                                                   os.path.join(settings['working_directory'], '.cache'),
+                                                   cache_quota)
+        # inputs and outputs of finished tasks are evicted after the TTL (seconds) or, least recently
+        # downloaded first, while they exceed the quota (bytes), 0 disables either
+        settings['retention'] = RetentionManager(settings['tasks'], settings['working_directory'],
+                                                 int(float(os.environ.get('DISK_QUOTA', 0))),
+                                                 float(os.environ.get('ARTIFACT_TTL', 0)))
+        settings['retention_interval'] = float(os.environ.get('RETENTION_INTERVAL', 600))
+        # executors claim the queued tasks shortest job first, waiting time counts with the aging factor
+        settings['run_queue'] = RunQueue(os.path.join(settings['state_directory'], 'tasks.db'),
+                                         float(os.environ.get('QUEUE_AGING', 1.0)), state_journal_mode)
+        # executors hold leases on their tasks for this long without renewing them, and look for tasks
+        # queued on other nodes at the poll interval
+        settings['worker_id'] = os.environ.get('WORKER_ID')
+        settings['lease_duration'] = float(os.environ.get('LEASE_DURATION', 60))
+        settings['poll_interval'] = float(os.environ.get('POLL_INTERVAL', 5))
+        settings['executor_status'] = mgr.dict()
+        # size of the worker pool, 0 sizes it from the core count and the CPU share of one autoflip run
+        settings['worker_slots'] = int(os.environ.get('WORKER_SLOTS', 0))
+        settings['autoflip_cpu_share'] = float(os.environ.get('AUTOFLIP_CPU_SHARE', 4))
+        settings['prepare_concurrency'] = int(os.environ.get('PREPARE_CONCURRENCY', 2))
+        # 'direct' muxes the audio straight from the input, 'extract' writes it to an intermediate file first
+        settings['audio_mode'] = os.environ.get('AUDIO_MODE', 'direct')
+        # split videos longer than two segments into chunks processed in parallel, 0 disables it
+        settings['segment_duration'] = float(os.environ.get('SEGMENT_DURATION', 0))
+        settings['segment_overlap'] = float(os.environ.get('SEGMENT_OVERLAP', 0))
+        # 'binary' spawns run_autoflip per task, 'inprocess' runs the graphs in long-lived mediapipe workers
+        settings['autoflip_backend'] = os.environ.get('AUTOFLIP_BACKEND', 'binary')
         settings['root_dir'] = root_dir
         settings['template_path'] = os.path.join(root_dir, 'templates')
         settings['static_path'] = os.path.join(root_dir, 'static')
-        settings['working_directory'] = os.path.join(root_dir, 'static', 'video')
+        # uploads are streamed to disk, so only their size is limited, not the buffered body size
+        settings['max_upload_size'] = int(float(os.environ.get('MAX_UPLOAD_SIZE', 5.2e8)))
+        # the event sockets of the processes on this host, the state directory may be shared with other hosts
+        event_directory = os.path.join(settings['state_directory'], 'events', socket.gethostname())
+
+        if args.worker:
+            settings['worker_id'] = settings['worker_id'] or f'{socket.gethostname()}:{os.getpid()}'
+            # the cache and the retention manage the files of the HTTP node, paths on this node differ
+            settings['result_cache'] = settings['retention'] = None
+            # status events still reach the HTTP workers if they run on this host
+            settings['event_hub'] = EventHub(event_directory)
+            settings['metrics'] = Metrics(os.path.join(settings['state_directory'], 'metrics'))
+            TaskExecutor(settings).start()
+            IOLoop.current().start()
+            return
+
+        socket_external = tornado.netutil.bind_sockets(8888)
 
         #fork to child processes
         pid = tornado.process.fork_processes(2)
 
+        # every process relays task events to its own websocket subscribers
+        settings['event_hub'] = EventHub(event_directory)
+        settings['event_hub'].listen()
+        # every process counts on its own, /metrics adds up the counts of all processes
+        settings['metrics'] = Metrics(os.path.join(settings['state_directory'], 'metrics'))
+
         #construct the app
         app = CreateHeroAPI(settings)
         #pass the settings
         # app.settings.update(settings)
-        server = HTTPServer(app, max_body_size = 5.2e8)
+        server = HTTPServer(app, max_body_size = 5e7)
         server.add_sockets(socket_external)
 
         # start services in separate processes
@@ -2,8 +2,8 @@ function initiateProgressSocket(progressWindow, taskID, deployPath) {
 	let host = getBaseURL();
 	let socketPath = "wss://" + host + deployPath + "/tasks/" + taskID + "/progress";
 	let socket = new WebSocket(socketPath);
-	var intervalHandler;
-	var spinnerSpan = $('span');
+	var cursor = 0;
+	var spinnerSpan = $('<span>');
 	spinnerSpan.attr('id', 'progressSpinner')
 	spinnerSpan.addClass('spinner-grow spinner-grow-sm mr-4');
 	spinnerSpan.attr('role','status');
@@ -12,9 +12,8 @@ function initiateProgressSocket(progressWindow, taskID, deployPath) {
 	// handlers
 	socket.onopen = function(e) {
 		progressWindow.append(spinnerSpan);
-		intervalHandler = setInterval(() => {
-			socket.send(JSON.stringify({command: "progress"}));
-		}, 1500);
+		// the server pushes status changes and new lines from here on
+		socket.send(JSON.stringify({command: "subscribe", cursor: cursor}));
 	};
 	socket.onclose = function(event) {
 	  if (event.wasClean) {
@@ -24,12 +23,20 @@ function initiateProgressSocket(progressWindow, taskID, deployPath) {
 	    // event.code is usually 1006 in this case
 	    console.log('[close] Connection died');
 	  }
-	  clearInterval(intervalHandler);
 	};
 
 	socket.onmessage = function(event) {
 	    message = JSON.parse(event.data);
-        progressWindow.html(message.data);
+	    // the server only sends the lines following our cursor
+	    if (message.reset) {
+	        progressWindow.html('');
+	    }
+	    spinnerSpan.detach();
+	    progressWindow.append(message.data);
+	    cursor = message.cursor;
+	    if (message.stats) {
+	        showProgressStats($('#progress-stats'), message.stats);
+	    }
 	    switch(message.type) {
 	        case "progress":
                 progressWindow.append(spinnerSpan);
@@ -43,11 +50,25 @@ function initiateProgressSocket(progressWindow, taskID, deployPath) {
 
 }
 
+function showProgressStats(statsWindow, stats) {
+	let parts = [];
+	if (stats.percent !== null) {
+		parts.push(stats.percent + "% (" + stats.frames_processed + "/" + stats.frames_total + " frames)");
+	}
+	if (stats.fps !== null) {
+		parts.push(stats.fps + " fps");
+	}
+	if (stats.eta !== null) {
+		parts.push("ETA " + Math.round(stats.eta) + "s");
+	}
+	statsWindow.text(parts.join(", "));
+}
+
 function getBaseURL() {
 	return window.location.host;
 }
 
 $(document).ready(function () {
-$('#task-list').DataTable();
-$('.dataTables_length').addClass('bs-select');
+// the server pages, filters and sorts the task list
+$('#task-list').DataTable({paging: false, searching: false, ordering: false, info: false});
 });
\ No newline at end of file